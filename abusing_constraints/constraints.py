@@ -10,6 +10,8 @@ from django.db.models.fields.related import resolve_relation
 from django.db.models.query import QuerySet
 from django.db.utils import DEFAULT_DB_ALIAS
 
+from mogrify_queryset.literals import mogrify
+
 
 class BasicForeignKeyConstraint(BaseConstraint):
     def __init__(
@@ -250,9 +252,7 @@ class View(BaseConstraint):
         self.is_materialized = is_materialized
 
     def render_query(self, query):
-        sql, params = query.sql_with_params()
-        with connection.cursor() as cursor:
-            return cursor.mogrify(sql, params).decode("utf-8")
+        return mogrify(*query.sql_with_params())
 
     def constraint_sql(self, model, schema_editor):
         raise Exception("View must be added after model creation")
@@ -3,6 +3,8 @@ from django.db.models import Q
 from django.db.models.constraints import CheckConstraint
 from django.db.models.sql import Query
 
+from mogrify_queryset.literals import mogrify
+
 
 class ColumnCheckConstraint(CheckConstraint):
     # A dummy check constraint to simply handle validation
@@ -27,8 +29,7 @@ class ColumnCheckMixin:
         query.add_q(self.column_check)
         compiler = query.get_compiler(using=connection.alias)
         sql, params = query.where.as_sql(compiler, connection.alias)
-        with connection.cursor() as cursor:
-            return cursor.mogrify(sql, params).decode("utf-8")
+        return mogrify(sql, params, using=connection.alias)
 
     def contribute_to_class(self, cls, name, private_only=False):
         # Use a dummy constraint to simply handle validation.
@@ -0,0 +1,40 @@
+from django.contrib import admin
+from django.contrib.admin.views.main import PAGE_VAR, ChangeList
+
+from .models import Data
+from .paginator import EstimatedPaginator
+
+
+class EstimatedChangeList(ChangeList):
+    @property
+    def page(self):
+        # only used when the count is estimated, EstimatedPaginator keeps the page that get_results() fetched
+        return self.paginator.page(self.page_num)
+
+    def previous_page_url(self):
+        if self.page_num > 1:
+            return self.get_query_string({PAGE_VAR: self.page_num - 1})
+
+    def next_page_url(self):
+        if self.page.has_next():
+            return self.get_query_string({PAGE_VAR: self.page_num + 1})
+
+
+class EstimatedCountAdminMixin:
+    """
+    Changelists for large tables: the count is estimated and the full, unfiltered, count is skipped entirely.
+
+    When the count is an estimate the page numbers are replaced with "about N" & previous/next links.
+    """
+
+    paginator = EstimatedPaginator
+    show_full_result_count = False
+    change_list_template = "count_estimate/change_list.html"
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedChangeList
+
+
+@admin.register(Data)
+class DataAdmin(EstimatedCountAdminMixin, admin.ModelAdmin):
+    list_display = ["id", "value"]
@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db.models.signals import post_delete, post_save
+
+
+class EstimateCache:
+    """
+    Cache count estimates with Django's cache framework.
+
+    Entries are keyed on a fingerprint of the query's SQL & params. With normalize=True only the type of each param is
+    used, so that eg value__lt=10 & value__lt=20 share an estimate - fine for a hot list page with many filter values,
+    not so much if the filters select wildly different numbers of rows.
+
+    Entries expire after timeout seconds. For LRU bounds use a dedicated cache, eg a locmem cache with MAX_ENTRIES. Once
+    invalidate_after saves or deletes of a model have been seen in this process within burst_window seconds, all
+    estimates for the model are invalidated; writes trickling in more slowly are left to the timeout. Bulk operations
+    don't send signals & are only caught by the timeout.
+    """
+
+    key_prefix = "count_estimate"
+
+    def __init__(
+        self,
+        alias="default",
+        timeout=60,
+        normalize=False,
+        invalidate_after=100,
+        burst_window=60,
+    ):
+        self.alias = alias
+        self.timeout = timeout
+        self.normalize = normalize
+        self.invalidate_after = invalidate_after
+        self.burst_window = burst_window
+        self.models = set()
+        # model -> (when the window started, writes since)
+        self.writes = {}
+        self.lock = threading.Lock()
+        post_save.connect(self.model_changed)
+        post_delete.connect(self.model_changed)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def generation_key(self, model):
+        return f"{self.key_prefix}:generation:{model._meta.label_lower}"
+
+    def generation(self, model):
+        # Generations are random rather than a counter so that if one is evicted the old entries aren't used again
+        key = self.generation_key(model)
+        generation = self.cache.get(key)
+        if generation is None:
+            self.cache.add(key, uuid.uuid4().hex, None)
+            generation = self.cache.get(key)
+        return generation
+
+    def fingerprint(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        if self.normalize:
+            params = [type(param).__name__ for param in params]
+        return hashlib.sha1(
+            f"{queryset.db}\0{sql}\0{params!r}".encode(), usedforsecurity=False
+        ).hexdigest()
+
+    def get_or_set(self, queryset, estimate):
+        """
+        Return the cached estimate for the queryset, calling estimate() if there isn't one.
+        """
+        model = queryset.model
+        self.models.add(model)
+        try:
+            fingerprint = self.fingerprint(queryset)
+        except EmptyResultSet:
+            return estimate()
+        key = f"{self.key_prefix}:{self.generation(model)}:{fingerprint}"
+        return self.cache.get_or_set(key, estimate, self.timeout)
+
+    def invalidate(self, model):
+        self.cache.set(self.generation_key(model), uuid.uuid4().hex, None)
+
+    def model_changed(self, sender, **kwargs):
+        if sender not in self.models:
+            return
+        now = time.monotonic()
+        with self.lock:
+            started, writes = self.writes.get(sender, (now, 0))
+            if now - started >= self.burst_window:
+                started, writes = now, 0
+            writes += 1
+            if writes < self.invalidate_after:
+                self.writes[sender] = (started, writes)
+                return
+            del self.writes[sender]
+        self.invalidate(sender)
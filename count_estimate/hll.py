@@ -0,0 +1,98 @@
+"""
+HyperLogLog in SQL: each value is hashed, the low bits of the hash pick one of REGISTERS registers & each register keeps
+the maximum position of the first set bit in the rest of the hash. The registers are a sketch of the set of values,
+sketches are merged by taking the maximum of each register.
+"""
+
+import math
+
+from django.db import NotSupportedError
+from django.db.models import Aggregate, BigIntegerField, F, Func, IntegerField, Max
+
+PRECISION = 11
+REGISTERS = 2**PRECISION
+# 2 standard errors, ie 95% of estimates should be within this
+ERROR = 2 * 1.04 / math.sqrt(REGISTERS)
+# Caps the position of the first set bit to the 53 bits that aren't used for the register
+RHO_MASK = "0" * (63 - PRECISION) + "1" + "0" * PRECISION
+
+_hll_installed = {}
+
+
+def hll_installed(connection):
+    """
+    Whether the hll extension (https://github.com/citusdata/postgresql-hll) is installed.
+    """
+    if connection.alias not in _hll_installed:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'hll'")
+            _hll_installed[connection.alias] = cursor.fetchone() is not None
+    return _hll_installed[connection.alias]
+
+
+class ApproxCountDistinct(Aggregate):
+    """
+    Count(expression, distinct=True) estimated with the hll extension.
+
+    Without the extension, CountEstimateQuerySet.aggregate() & approx_count_distinct_by(), for grouped counts, estimate
+    with the pure SQL HyperLogLog in this module instead. Both are within a couple of percent.
+    """
+
+    name = "ApproxCountDistinct"
+    template = "hll_cardinality(hll_add_agg(hll_hash_any(%(expressions)s)))::bigint"
+    output_field = BigIntegerField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        if not hll_installed(connection):
+            raise NotSupportedError(
+                "ApproxCountDistinct needs the hll extension, or use "
+                "CountEstimateQuerySet.aggregate() or approx_count_distinct_by()"
+            )
+        return super().as_sql(compiler, connection, **extra_context)
+
+
+class Hash(Func):
+    template = "hashtextextended((%(expressions)s)::text, 0)"
+    output_field = BigIntegerField()
+    arity = 1
+
+
+class Rho(Func):
+    template = f"position(B'1' IN (%(expressions)s::bit(64) | B'{RHO_MASK}'))"
+    output_field = IntegerField()
+    arity = 1
+
+
+def registers(queryset, expression, *group_by):
+    """
+    Return a queryset of the non-zero registers (register, rho) of the sketch for expression, by any group_by aliases.
+
+    NULLs are ignored, like Count().
+    """
+    return (
+        queryset.alias(hll_hash=Hash(expression))
+        .filter(hll_hash__isnull=False)
+        .values(*group_by, register=F("hll_hash").bitand(REGISTERS - 1))
+        .annotate(rho=Max(Rho("hll_hash")))
+        .order_by()
+    )
+
+
+def sketch(rows):
+    """
+    Build a sketch from (register, rho) rows.
+    """
+    sketch = [0] * REGISTERS
+    for register, rho in rows:
+        sketch[register] = rho
+    return sketch
+
+
+def cardinality(sketch):
+    alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+    estimate = alpha * REGISTERS**2 / sum(2.0**-rho for rho in sketch)
+    zeros = sketch.count(0)
+    # linear counting for small cardinalities, the hash is 64 bits so there's no need for a large range correction
+    if estimate <= 2.5 * REGISTERS and zeros:
+        estimate = REGISTERS * math.log(REGISTERS / zeros)
+    return round(estimate)
@@ -0,0 +1,46 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from count_estimate.stats import ANALYZE_THRESHOLD, TableStats, estimated_models
+
+
+class Command(BaseCommand):
+    help = "ANALYZE the tables behind estimated counts once their stats have drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "models",
+            nargs="*",
+            metavar="app_label.ModelName",
+            help="Defaults to models using CountEstimateQuerySet",
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=ANALYZE_THRESHOLD,
+            help="Fraction of rows modified since the last ANALYZE",
+        )
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, models, threshold, database, dry_run, **options):
+        try:
+            models = [apps.get_model(label) for label in models] or estimated_models()
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+
+        for model in models:
+            stats = TableStats(model, database)
+            drift = "never analyzed" if stats.drift is None else f"{stats.drift:.1%}"
+            if not stats.is_stale(threshold):
+                self.stdout.write(f"{model._meta.db_table}: {drift}")
+                continue
+            if not dry_run:
+                stats.analyze()
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{model._meta.db_table}: {drift}, "
+                    f"{'would analyze' if dry_run else 'analyzed'}"
+                )
+            )
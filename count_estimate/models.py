@@ -1,5 +1,320 @@
-from django.db import models
+import functools
+import json
+from collections import defaultdict
+
+from django.contrib.postgres.fields import ArrayField
+from django.db import connections, models
+from django.db.models.constants import LOOKUP_SEP
+
+from . import hll
+from .stats import TableStats
+
+
+class EstimatedCount(int):
+    """
+    A count that was estimated rather than counted.
+
+    error is the expected relative error, if known. For estimates from stats it's the fraction of the table modified
+    since it was last analyzed, which doesn't account for the planner misjudging the selectivity of filters. For
+    HyperLogLog it's 2 standard errors. It may be given as a function to compute it when it's first needed, the stats
+    are another query.
+    """
+
+    approximate = True
+
+    def __new__(cls, value, error=None):
+        count = super().__new__(cls, value)
+        count._error = error
+        return count
+
+    @property
+    def error(self):
+        if callable(self._error):
+            self._error = self._error()
+        return self._error
+
+    @property
+    def bounds(self):
+        if self.error is not None:
+            return round(self * (1 - self.error)), round(self * (1 + self.error))
+
+
+class CountEstimateQuerySet(models.QuerySet):
+    """
+    count() returns the planner's estimate unless it's below estimate_threshold, in which case the rows are counted.
+    """
+
+    estimate_threshold = 10_000
+    # a cache.EstimateCache
+    estimate_cache = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone.estimate_threshold = self.estimate_threshold
+        clone.estimate_cache = self.estimate_cache
+        return clone
+
+    def with_estimate_threshold(self, threshold):
+        clone = self._chain()
+        clone.estimate_threshold = threshold
+        return clone
+
+    def with_estimate_cache(self, estimate_cache):
+        clone = self._chain()
+        clone.estimate_cache = estimate_cache
+        return clone
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        estimate = self.estimate()
+        if estimate < self.estimate_threshold:
+            return super().count()
+        return estimate
+
+    def is_unfiltered(self):
+        query = self.query
+        return not (
+            query.where
+            or query.is_sliced
+            or query.distinct
+            or query.combinator
+            or query.group_by
+            or query.extra
+        )
+
+    def estimate(self):
+        if self.estimate_cache is not None:
+            return self.estimate_cache.get_or_set(self, self._estimate)
+        return self._estimate()
+
+    def _estimate(self):
+        estimate = None
+        if self.is_unfiltered():
+            estimate = self.table_estimate()
+        if estimate is None:
+            estimate = self.plan_estimate()
+        return EstimatedCount(estimate, error=self.stats_error())
+
+    def stats_error(self):
+        # a module level function so that estimates can still be pickled by the cache
+        return functools.partial(stats_drift, self.model, self.db)
+
+    def table_estimate(self):
+        """
+        Estimate the number of rows in the table from its density when last analyzed (reltuples / relpages) and its
+        current size, the same as the planner does. None if the table has never been analyzed.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT
+                    CASE
+                        WHEN reltuples < 0 THEN NULL
+                        WHEN relpages = 0 THEN NULL
+                        ELSE (
+                            reltuples / relpages
+                            * (pg_relation_size(oid) / current_setting('block_size')::int)
+                        )::bigint
+                    END
+                FROM pg_class
+                WHERE oid = %s::regclass
+                """,
+                [self.model._meta.db_table],
+            )
+            return cursor.fetchone()[0]
+
+    def aggregate(self, *args, **kwargs):
+        """
+        As QuerySet.aggregate() but estimates ApproxCountDistinct from stats when unfiltered & with the pure SQL
+        HyperLogLog if the hll extension isn't installed.
+        """
+        for arg in args:
+            kwargs[arg.default_alias] = arg
+        approx = {
+            alias: aggregate
+            for alias, aggregate in kwargs.items()
+            if isinstance(aggregate, hll.ApproxCountDistinct)
+        }
+        others = {
+            alias: aggregate
+            for alias, aggregate in kwargs.items()
+            if alias not in approx
+        }
+        result = super().aggregate(**others) if others else {}
+        for alias, aggregate in approx.items():
+            result[alias] = self.approx_count_distinct(
+                aggregate.get_source_expressions()[0]
+            )
+        return result
+
+    def approx_count_distinct(self, expression):
+        if isinstance(expression, models.F):
+            expression = expression.name
+        if (
+            isinstance(expression, str)
+            and LOOKUP_SEP not in expression
+            and self.is_unfiltered()
+        ):
+            estimate = self.stats_count_distinct(expression)
+            if estimate is not None:
+                return EstimatedCount(estimate, error=self.stats_error())
+        if hll.hll_installed(connections[self.db]):
+            return EstimatedCount(
+                super().aggregate(n=hll.ApproxCountDistinct(expression))["n"],
+                error=hll.ERROR,
+            )
+        return EstimatedCount(
+            hll.cardinality(
+                hll.sketch(
+                    hll.registers(self, expression).values_list("register", "rho")
+                )
+            ),
+            error=hll.ERROR,
+        )
+
+    def approx_count_distinct_by(self, expression, *fields):
+        """
+        Estimate the number of distinct values of expression for each group of fields, as
+        values(*fields).annotate(n=ApproxCountDistinct(expression)) would with the hll extension, & with the pure SQL
+        HyperLogLog if it isn't installed. Returns {group: EstimatedCount}, a group is a tuple with more than one field.
+        Groups where expression is always NULL aren't included.
+        """
+        if isinstance(expression, str):
+            expression = models.F(expression)
+        counts = {}
+        if hll.hll_installed(connections[self.db]):
+            for *group, n in (
+                self.alias(hll_value=expression)
+                .filter(hll_value__isnull=False)
+                .values(*fields)
+                .annotate(n=hll.ApproxCountDistinct(expression))
+                .order_by()
+                .values_list(*fields, "n")
+            ):
+                counts[tuple(group)] = n
+        else:
+            sketches = defaultdict(lambda: [0] * hll.REGISTERS)
+            for *group, register, rho in hll.registers(
+                self, expression, *fields
+            ).values_list(*fields, "register", "rho"):
+                sketches[tuple(group)][register] = rho
+            counts = {
+                group: hll.cardinality(sketch) for group, sketch in sketches.items()
+            }
+        return {
+            group[0] if len(fields) == 1 else group: EstimatedCount(n, error=hll.ERROR)
+            for group, n in counts.items()
+        }
+
+    def stats_count_distinct(self, field_name):
+        """
+        The planner's estimate of the number of distinct values in a column, None if it hasn't been analyzed.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT n_distinct
+                FROM pg_stats
+                WHERE schemaname = ANY(current_schemas(false))
+                    AND tablename = %s
+                    AND attname = %s
+                """,
+                [
+                    self.model._meta.db_table,
+                    self.model._meta.get_field(field_name).column,
+                ],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        n_distinct = row[0]
+        # negative values are a fraction of the number of rows, for when the number of values grows with the table
+        if n_distinct < 0:
+            rows = self.table_estimate()
+            if rows is None:
+                return None
+            return round(-n_distinct * rows)
+        return round(n_distinct)
+
+    def plan_estimate(self):
+        plan = self.explain(format="json")
+        # nothing to explain when the filters can't match anything, eg pk__in=[]
+        if not plan:
+            return 0
+        return json.loads(plan)[0]["Plan"]["Plan Rows"]
+
+
+def stats_drift(model, using):
+    return TableStats(model, using).drift
+
+
+def as_count_estimate(queryset):
+    """
+    Count any queryset with CountEstimateQuerySet.
+    """
+    if isinstance(queryset, CountEstimateQuerySet):
+        return queryset
+    return CountEstimateQuerySet(
+        queryset.model, queryset.query.chain(), queryset.db, queryset._hints
+    )
 
 
 class Data(models.Model):
     value = models.IntegerField()
+
+    objects = CountEstimateQuerySet.as_manager()
+
+
+class DistinctRollupQuerySet(models.QuerySet):
+    def rollup(self, key, queryset, expression, date):
+        """
+        Store a sketch of the distinct values of expression for each date in queryset, replacing existing sketches.
+        """
+        sketches = defaultdict(lambda: [0] * hll.REGISTERS)
+        for day, register, rho in hll.registers(
+            queryset.annotate(rollup_date=date), expression, "rollup_date"
+        ).values_list("rollup_date", "register", "rho"):
+            sketches[day][register] = rho
+        return self.bulk_create(
+            [self.model(key=key, date=day, sketch=s) for day, s in sketches.items()],
+            update_conflicts=True,
+            unique_fields=["key", "date"],
+            update_fields=["sketch"],
+        )
+
+    def count_distinct(self, key, start, end):
+        """
+        Estimate the number of distinct values between start & end (inclusive) by merging the daily sketches.
+        """
+        queryset = self.filter(key=key, date__range=(start, end))
+        sql, params = queryset.values("sketch").query.sql_with_params()
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT register - 1, max(rho)
+                FROM ({sql}) rollup, unnest(rollup.sketch) WITH ORDINALITY AS u(rho, register)
+                GROUP BY register
+                """,
+                params,
+            )
+            return EstimatedCount(
+                hll.cardinality(hll.sketch(cursor.fetchall())), error=hll.ERROR
+            )
+
+
+class DistinctRollup(models.Model):
+    """
+    Daily HyperLogLog sketches so that distinct counts over any date range are a cheap merge.
+    """
+
+    key = models.CharField()
+    date = models.DateField()
+    sketch = ArrayField(models.SmallIntegerField(), size=hll.REGISTERS)
+
+    objects = DistinctRollupQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["key", "date"], name="unique_rollup_date")
+        ]
@@ -0,0 +1,78 @@
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.utils.functional import cached_property
+
+from .models import EstimatedCount, as_count_estimate
+
+
+class EstimatedPage(Page):
+    def __init__(self, object_list, number, paginator, has_next=None):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        if self._has_next is None:
+            return super().has_next()
+        return self._has_next
+
+    def end_index(self):
+        if self._has_next is None:
+            return super().end_index()
+        return self.start_index() + len(self.object_list) - 1
+
+
+class EstimatedPaginator(Paginator):
+    """
+    A paginator for large querysets that counts with CountEstimateQuerySet.
+
+    When the count is an estimate the number of pages is only approximate, so pages aren't checked against it. Instead
+    an extra row is fetched to tell whether there's a next page.
+    """
+
+    @cached_property
+    def count(self):
+        if hasattr(self.object_list, "query"):
+            return as_count_estimate(self.object_list).count()
+        return super().count
+
+    @property
+    def approximate(self):
+        return isinstance(self.count, EstimatedCount)
+
+    def validate_number(self, number):
+        if not self.approximate:
+            return super().validate_number(number)
+        # as Paginator.validate_number() but with no upper bound
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages["invalid_page"])
+        if number < 1:
+            raise EmptyPage(self.error_messages["min_page"])
+        return number
+
+    @cached_property
+    def pages(self):
+        return {}
+
+    def page(self, number):
+        if not self.approximate:
+            return super().page(number)
+        number = self.validate_number(number)
+        # pages are fetched, so keep them around in case they're asked for again
+        if number not in self.pages:
+            bottom = (number - 1) * self.per_page
+            object_list = list(self.object_list[bottom : bottom + self.per_page + 1])
+            if not object_list and number > 1:
+                raise EmptyPage(self.error_messages["no_results"])
+            self.pages[number] = self._get_page(
+                object_list[: self.per_page],
+                number,
+                self,
+                has_next=len(object_list) > self.per_page,
+            )
+        return self.pages[number]
+
+    def _get_page(self, *args, **kwargs):
+        return EstimatedPage(*args, **kwargs)
@@ -0,0 +1,84 @@
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# ANALYZE once this fraction of rows have been modified since the last ANALYZE, autovacuum's default
+# (autovacuum_analyze_scale_factor) is 0.1 but doesn't run until a further 50 rows have changed
+ANALYZE_THRESHOLD = 0.05
+
+
+class TableStats:
+    def __init__(self, model, using=DEFAULT_DB_ALIAS):
+        self.model = model
+        self.using = using
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT
+                    c.reltuples,
+                    s.n_live_tup,
+                    s.n_mod_since_analyze,
+                    greatest(s.last_analyze, s.last_autoanalyze)
+                FROM pg_class c
+                LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE c.oid = %s::regclass
+                """,
+                [model._meta.db_table],
+            )
+            (
+                self.reltuples,
+                self.live_rows,
+                self.modified_since_analyze,
+                self.last_analyzed,
+            ) = cursor.fetchone()
+
+    @property
+    def analyzed(self):
+        return self.reltuples >= 0
+
+    @property
+    def drift(self):
+        """
+        The fraction of rows modified since the last ANALYZE, a bound on how far off estimates from the stats may be.
+        """
+        if not self.analyzed:
+            return None
+        return (self.modified_since_analyze or 0) / max(self.reltuples, 1)
+
+    def is_stale(self, threshold=ANALYZE_THRESHOLD):
+        return not self.analyzed or self.drift > threshold
+
+    def analyze(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                f"ANALYZE {connections[self.using].ops.quote_name(self.model._meta.db_table)}"
+            )
+
+
+def estimated_models():
+    """
+    Models whose default manager uses CountEstimateQuerySet.
+    """
+    from .models import CountEstimateQuerySet
+
+    return [
+        model
+        for model in apps.get_models()
+        if not model._meta.proxy
+        and issubclass(
+            getattr(model._default_manager, "_queryset_class", object),
+            CountEstimateQuerySet,
+        )
+    ]
+
+
+def analyze_stale(models=None, threshold=ANALYZE_THRESHOLD, using=DEFAULT_DB_ALIAS):
+    """
+    ANALYZE the tables of the models that have drifted past threshold, returns their TableStats from before.
+    """
+    analyzed = []
+    for model in estimated_models() if models is None else models:
+        stats = TableStats(model, using)
+        if stats.is_stale(threshold):
+            stats.analyze()
+            analyzed.append(stats)
+    return analyzed
@@ -1,13 +1,417 @@
+import io
 import json
+import time
+from datetime import date
 
 import pytest
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.paginator import EmptyPage
+from django.db import NotSupportedError, connection
+from django.db.models import (
+    Count,
+    DateField,
+    ExpressionWrapper,
+    F,
+    IntegerField,
+    Q,
+    Value,
+)
+from django.db.models.functions import Cast
+from django.test.utils import CaptureQueriesContext
 
-from .models import Data
+from .cache import EstimateCache
+from .hll import ApproxCountDistinct, cardinality, hll_installed
+from .models import Data, DistinctRollup, EstimatedCount
+from .paginator import EstimatedPaginator
+from .stats import TableStats, analyze_stale
 
 pytestmark = pytest.mark.django_db
 
 
+def analyze():
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE count_estimate_data")
+
+
+@pytest.fixture(autouse=True)
+def new_table():
+    # ANALYZE updates pg_class in place, outside of the test's transaction, & rolled back rows from other tests leave
+    # dead pages. TRUNCATE gives the table a new, never analyzed, file (& is rolled back).
+    with connection.cursor() as cursor:
+        cursor.execute("TRUNCATE count_estimate_data")
+
+
 def test_count_estimate():
     Data.objects.bulk_create(Data(value=i) for i in range(100_000))
 
     print(json.loads(Data.objects.all().explain(format="json"))[0]["Plan"]["Plan Rows"])
+
+
+def test_count_unfiltered():
+    Data.objects.bulk_create(Data(value=i) for i in range(100_000))
+    analyze()
+
+    count = Data.objects.count()
+
+    assert isinstance(count, EstimatedCount)
+    assert count == pytest.approx(100_000, rel=0.01)
+
+
+def test_count_unfiltered_scaled_by_relation_size():
+    Data.objects.bulk_create(Data(value=i) for i in range(50_000))
+    analyze()
+    # the table has doubled since it was analyzed
+    Data.objects.bulk_create(Data(value=i) for i in range(50_000))
+
+    assert Data.objects.table_estimate() == pytest.approx(100_000, rel=0.05)
+
+
+def test_count_filtered():
+    Data.objects.bulk_create(Data(value=i) for i in range(100_000))
+    analyze()
+
+    count = Data.objects.filter(value__lt=50_000).count()
+
+    assert isinstance(count, EstimatedCount)
+    assert count == pytest.approx(50_000, rel=0.1)
+
+
+def test_count_below_threshold_is_exact():
+    Data.objects.bulk_create(Data(value=i) for i in range(100_000))
+    analyze()
+
+    count = Data.objects.filter(value__lt=1234).count()
+
+    assert not isinstance(count, EstimatedCount)
+    assert count == 1234
+
+
+def test_count_threshold():
+    Data.objects.bulk_create(Data(value=i) for i in range(100_000))
+    analyze()
+
+    count = (
+        Data.objects.with_estimate_threshold(1_000_000).filter(value__gte=10).count()
+    )
+
+    assert not isinstance(count, EstimatedCount)
+    assert count == 99_990
+
+
+def test_count_never_analyzed():
+    Data.objects.bulk_create(Data(value=i) for i in range(10))
+
+    assert Data.objects.table_estimate() is None
+    assert Data.objects.count() == 10
+
+
+@pytest.fixture
+def data():
+    Data.objects.bulk_create(Data(value=i) for i in range(100_000))
+    analyze()
+
+
+def test_paginator_estimated(data):
+    paginator = EstimatedPaginator(Data.objects.order_by("pk"), 1000)
+
+    assert paginator.approximate
+    assert paginator.num_pages == pytest.approx(100, abs=2)
+
+    page = paginator.page(1)
+    assert page.has_next()
+    assert not page.has_previous()
+    assert (page.start_index(), page.end_index()) == (1, 1000)
+
+    # the estimate may be out, the next page is known by fetching an extra row
+    page = paginator.page(100)
+    assert not page.has_next()
+    assert (page.start_index(), page.end_index()) == (99_001, 100_000)
+
+    with pytest.raises(EmptyPage):
+        paginator.page(101)
+
+
+def test_paginator_exact(data):
+    paginator = EstimatedPaginator(Data.objects.filter(value__lt=2500), 1000)
+
+    assert not paginator.approximate
+    assert paginator.count == 2500
+    assert paginator.num_pages == 3
+    assert not paginator.page(3).has_next()
+
+
+def test_admin_changelist(data, admin_client):
+    with CaptureQueriesContext(connection) as queries:
+        response = admin_client.get("/admin/count_estimate/data/?p=2")
+
+    assert response.status_code == 200
+    assert not [query for query in queries if "COUNT(" in query["sql"].upper()]
+    content = response.content.decode()
+    assert "Page 2 of about" in content
+    assert 'href="?p=1"' in content
+    assert 'href="?p=3"' in content
+
+
+def test_count_no_results():
+    assert Data.objects.filter(pk__in=[]).count() == 0
+
+
+@pytest.fixture
+def estimate_cache():
+    cache.clear()
+    yield EstimateCache()
+    cache.clear()
+
+
+def test_cached_estimate(data, estimate_cache):
+    queryset = Data.objects.with_estimate_cache(estimate_cache).filter(value__gt=10)
+    count = queryset.count()
+
+    with CaptureQueriesContext(connection) as queries:
+        assert queryset.all().count() == count
+
+    assert len(queries) == 0
+
+
+def test_cached_estimate_params(data, estimate_cache):
+    Data.objects.with_estimate_cache(estimate_cache).filter(value__gt=10).count()
+
+    with CaptureQueriesContext(connection) as queries:
+        Data.objects.with_estimate_cache(estimate_cache).filter(value__gt=20).count()
+
+    # just the EXPLAIN, the stats for the error are only read if it's used
+    assert len(queries) == 1
+
+
+def test_cached_estimate_normalized(data, estimate_cache):
+    estimate_cache.normalize = True
+    count = (
+        Data.objects.with_estimate_cache(estimate_cache).filter(value__gt=10).count()
+    )
+
+    with CaptureQueriesContext(connection) as queries:
+        assert (
+            Data.objects.with_estimate_cache(estimate_cache)
+            .filter(value__gt=50_000)
+            .count()
+            == count
+        )
+
+    assert len(queries) == 0
+
+
+def test_cached_estimate_invalidated(data, estimate_cache):
+    estimate_cache.invalidate_after = 3
+    queryset = Data.objects.with_estimate_cache(estimate_cache)
+    queryset.count()
+
+    Data.objects.create(value=1)
+    Data.objects.create(value=2)
+    with CaptureQueriesContext(connection) as queries:
+        queryset.count()
+    assert len(queries) == 0
+
+    Data.objects.create(value=3)
+    with CaptureQueriesContext(connection) as queries:
+        queryset.count()
+    assert len(queries) == 1
+
+
+def test_cached_estimate_not_invalidated_by_slow_writes(data, estimate_cache):
+    estimate_cache.invalidate_after = 2
+    estimate_cache.burst_window = 0.05
+    queryset = Data.objects.with_estimate_cache(estimate_cache)
+    queryset.count()
+
+    Data.objects.create(value=1)
+    time.sleep(0.1)
+    Data.objects.create(value=2)
+    with CaptureQueriesContext(connection) as queries:
+        queryset.count()
+
+    assert len(queries) == 0
+
+
+@pytest.fixture
+def distinct_data():
+    # 50,000 distinct values
+    Data.objects.bulk_create(Data(value=i % 50_000) for i in range(100_000))
+
+
+def test_approx_count_distinct(distinct_data):
+    result = Data.objects.filter(value__gte=10_000).aggregate(
+        distinct=ApproxCountDistinct("value"), count=Count("id")
+    )
+
+    assert isinstance(result["distinct"], EstimatedCount)
+    assert result["distinct"] == pytest.approx(40_000, rel=0.05)
+    assert result["count"] == 80_000
+
+
+def test_approx_count_distinct_small(distinct_data):
+    result = Data.objects.filter(value__lt=100).aggregate(ApproxCountDistinct("value"))
+
+    assert result["value__approxcountdistinct"] == pytest.approx(100, abs=2)
+
+
+def test_approx_count_distinct_stats(distinct_data):
+    analyze()
+
+    with CaptureQueriesContext(connection) as queries:
+        result = Data.objects.aggregate(distinct=ApproxCountDistinct("value"))
+
+    assert "pg_stats" in queries[0]["sql"]
+    assert result["distinct"] == pytest.approx(50_000, rel=0.2)
+
+
+def test_approx_count_distinct_needs_hll():
+    if hll_installed(connection):
+        pytest.skip("hll is installed")
+
+    with pytest.raises(NotSupportedError):
+        list(Data.objects.values("value").annotate(n=ApproxCountDistinct("id")))
+
+
+def test_approx_count_distinct_by(distinct_data):
+    Data.objects.bulk_create(Data(value=i) for i in range(50_000, 50_100))
+    queryset = Data.objects.annotate(parity=F("value") % 2, small=Q(value__lt=100))
+
+    counts = queryset.approx_count_distinct_by("value", "parity")
+
+    assert counts.keys() == {0, 1}
+    assert isinstance(counts[0], EstimatedCount)
+    assert counts[0] == pytest.approx(25_050, rel=0.05)
+    assert counts[1] == pytest.approx(25_050, rel=0.05)
+    assert queryset.approx_count_distinct_by("value", "parity", "small")[
+        1, True
+    ] == pytest.approx(50, abs=2)
+
+
+def test_cardinality_empty():
+    assert cardinality([0] * 2048) == 0
+
+
+def test_distinct_rollup(distinct_data):
+    # spread the data over a week
+    day = ExpressionWrapper(
+        Value(date(2025, 1, 1)) + Cast(F("id") % 7, IntegerField()), DateField()
+    )
+
+    DistinctRollup.objects.rollup("values", Data.objects.all(), "value", day)
+
+    assert DistinctRollup.objects.count() == 7
+    # merging registers is lossless, the merged sketch is the same as a sketch of the whole range
+    assert (
+        DistinctRollup.objects.count_distinct(
+            "values", date(2025, 1, 1), date(2025, 1, 7)
+        )
+        == Data.objects.filter(value__gte=0).aggregate(n=ApproxCountDistinct("value"))[
+            "n"
+        ]
+    )
+    assert DistinctRollup.objects.count_distinct(
+        "values", date(2025, 1, 2), date(2025, 1, 2)
+    ) == pytest.approx(100_000 / 7, rel=0.05)
+
+    # rolling up again replaces the sketches
+    DistinctRollup.objects.rollup("values", Data.objects.all(), "value", day)
+    assert DistinctRollup.objects.count() == 7
+
+
+def flush_stats():
+    # the backend flushes its stats when idle but at most once a second, ask it to flush now
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_stat_force_next_flush()")
+
+
+# the stats only include committed changes
+@pytest.mark.django_db(transaction=True)
+def test_table_stats_drift():
+    Data.objects.bulk_create(Data(value=i) for i in range(10_000))
+    flush_stats()
+    analyze()
+    Data.objects.bulk_create(Data(value=i) for i in range(1_000))
+    flush_stats()
+
+    stats = TableStats(Data)
+
+    assert stats.analyzed
+    assert stats.drift == pytest.approx(0.1)
+    assert stats.is_stale()
+    assert not stats.is_stale(threshold=0.2)
+
+
+def test_table_stats_never_analyzed():
+    stats = TableStats(Data)
+
+    assert not stats.analyzed
+    assert stats.drift is None
+    assert stats.is_stale()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_analyze_stale():
+    Data.objects.bulk_create(Data(value=i) for i in range(10_000))
+    flush_stats()
+
+    analyzed = analyze_stale()
+
+    assert [stats.model for stats in analyzed] == [Data]
+    stats = TableStats(Data)
+    assert stats.reltuples == 10_000
+    assert stats.drift == 0
+    assert analyze_stale() == []
+
+
+@pytest.mark.django_db(transaction=True)
+def test_analyze_estimates_command():
+    Data.objects.bulk_create(Data(value=i) for i in range(10_000))
+    flush_stats()
+    out = io.StringIO()
+
+    call_command("analyze_estimates", "count_estimate.Data", "--dry-run", stdout=out)
+
+    assert out.getvalue() == "count_estimate_data: never analyzed, would analyze\n"
+    assert not TableStats(Data).analyzed
+
+    out = io.StringIO()
+    call_command("analyze_estimates", stdout=out)
+
+    assert out.getvalue() == "count_estimate_data: never analyzed, analyzed\n"
+    assert TableStats(Data).analyzed
+
+
+def test_estimate_error():
+    Data.objects.bulk_create(Data(value=i) for i in range(100_000))
+    analyze()
+
+    count = Data.objects.count()
+
+    # the inserts aren't committed so the stats haven't seen them
+    assert count.error == 0
+    assert count.bounds == (count, count)
+
+
+def test_estimate_error_lazy(data, estimate_cache):
+    with CaptureQueriesContext(connection) as queries:
+        count = Data.objects.with_estimate_cache(estimate_cache).count()
+        assert len(queries) == 1
+
+        assert count.error is not None
+        assert len(queries) == 2
+
+    # cached estimates still have one
+    assert Data.objects.with_estimate_cache(estimate_cache).count().error is not None
+
+
+def test_approx_count_distinct_error():
+    Data.objects.bulk_create(Data(value=i % 1000) for i in range(10_000))
+
+    count = Data.objects.filter(value__gte=0).aggregate(n=ApproxCountDistinct("value"))[
+        "n"
+    ]
+
+    assert count.error == pytest.approx(0.046, abs=0.001)
+    low, high = count.bounds
+    assert low <= 1000 <= high
@@ -1,9 +1,11 @@
 import collections.abc
 
+import django.db.backends.postgresql.operations as postgresql_operations
 import django.db.backends.postgresql.schema as postgresql_schema
 from django.apps import AppConfig
 from django.conf import settings
 from django.core.management.commands import makemigrations, migrate
+from django.db import connections, router, transaction
 from django.db.migrations import state
 from django.db.migrations.operations.base import Operation
 from django.db.migrations.serializer import (
@@ -12,8 +14,16 @@ from django.db.migrations.serializer import (
     serializer_factory,
 )
 from django.db.models import QuerySet, options
+from django.db.models.signals import class_prepared
 from django.db.utils import load_backend
 
+from .incremental import (
+    create_incremental_view,
+    delete_incremental_view,
+    refresh_incremental,
+)
+from .routing import DatabaseOperationsMixin, view_router
+
 # from django.db.models.options import DEFAULT_NAMES
 
 # proposal on Django GitHub
@@ -25,14 +35,35 @@ if "query" not in options.DEFAULT_NAMES:
     options.DEFAULT_NAMES = tuple(options.DEFAULT_NAMES) + ("query",)
 if "materialized" not in options.DEFAULT_NAMES:
     options.DEFAULT_NAMES = tuple(options.DEFAULT_NAMES) + ("materialized",)
+if "materialized_unique_index" not in options.DEFAULT_NAMES:
+    options.DEFAULT_NAMES = tuple(options.DEFAULT_NAMES) + (
+        "materialized_unique_index",
+    )
+if "incremental" not in options.DEFAULT_NAMES:
+    options.DEFAULT_NAMES = tuple(options.DEFAULT_NAMES) + ("incremental",)
+# not part of the migration state, it doesn't change the database
+if "route_reads" not in options.DEFAULT_NAMES:
+    options.DEFAULT_NAMES = tuple(options.DEFAULT_NAMES) + ("route_reads",)
 
 
 class UpdateView(Operation):
-    def __init__(self, model_name, db_view, query, materialized, *args, **kwargs):
+    def __init__(
+        self,
+        model_name,
+        db_view,
+        query,
+        materialized,
+        *args,
+        materialized_unique_index=None,
+        incremental=False,
+        **kwargs,
+    ):
         self.model_name = model_name
         self.db_view = db_view
         self.query = query
         self.materialized = materialized
+        self.materialized_unique_index = materialized_unique_index
+        self.incremental = incremental
         super().__init__(*args, **kwargs)
 
     def state_forwards(self, app_label, state):
@@ -40,6 +71,10 @@ class UpdateView(Operation):
         model_state.options["db_view"] = self.db_view
         model_state.options["query"] = self.query
         model_state.options["materialized"] = self.materialized
+        model_state.options["materialized_unique_index"] = (
+            self.materialized_unique_index
+        )
+        model_state.options["incremental"] = self.incremental
         state.reload_model(app_label, self.model_name, delay=True)
 
     def database_forwards(self, app_label, schema_editor, from_state, to_state):
@@ -70,6 +105,8 @@ class MigrationAutodetectorMixin:
         return super().create_altered_constraints()
 
     def check_altered_view_defs(self):
+        from .diffing import queries_differ
+
         for app_label, model_name in sorted(self.kept_model_keys):
             old_model_name = self.renamed_models.get(
                 (app_label, model_name), model_name
@@ -84,18 +121,29 @@ class MigrationAutodetectorMixin:
                     "Cannot change a model to/from a view unless removed first"
                 )
 
-            from mogrify_queryset.models import mogrify_queryset
+            if not new_db_view:
+                continue
 
             old_query = old_model_state.options.get("query")
-            if isinstance(old_query, QuerySet):
-                old_query = mogrify_queryset(old_query)
             new_query = new_model_state.options.get("query")
-            if isinstance(new_query, QuerySet):
-                new_query = mogrify_queryset(new_query)
             old_materialized = old_model_state.options.get("materialized")
             new_materialized = new_model_state.options.get("materialized")
-
-            if old_query != new_query or old_materialized != new_materialized:
+            old_unique_index = old_model_state.options.get("materialized_unique_index")
+            new_unique_index = new_model_state.options.get("materialized_unique_index")
+            old_incremental = old_model_state.options.get("incremental", False)
+            new_incremental = new_model_state.options.get("incremental", False)
+
+            if (
+                queries_differ(old_query, new_query)
+                or old_materialized != new_materialized
+                or old_unique_index != new_unique_index
+                or old_incremental != new_incremental
+            ):
+                # only mogrified when there's an operation to write
+                if isinstance(new_query, QuerySet):
+                    from mogrify_queryset.models import mogrify_queryset
+
+                    new_query = mogrify_queryset(new_query)
                 self.add_operation(
                     app_label,
                     UpdateView(
@@ -103,17 +151,25 @@ class MigrationAutodetectorMixin:
                         db_view=new_db_view,
                         query=new_query,
                         materialized=new_materialized,
+                        materialized_unique_index=new_unique_index,
+                        incremental=new_incremental,
                     ),
                 )
 
 
 def patch_migrations():
-    if "triggers" not in state.DEFAULT_NAMES:
+    if "db_view" not in state.DEFAULT_NAMES:
         state.DEFAULT_NAMES = tuple(state.DEFAULT_NAMES) + ("db_view",)
     if "query" not in state.DEFAULT_NAMES:
         state.DEFAULT_NAMES = tuple(state.DEFAULT_NAMES) + ("query",)
     if "materialized" not in state.DEFAULT_NAMES:
         state.DEFAULT_NAMES = tuple(state.DEFAULT_NAMES) + ("materialized",)
+    if "materialized_unique_index" not in state.DEFAULT_NAMES:
+        state.DEFAULT_NAMES = tuple(state.DEFAULT_NAMES) + (
+            "materialized_unique_index",
+        )
+    if "incremental" not in state.DEFAULT_NAMES:
+        state.DEFAULT_NAMES = tuple(state.DEFAULT_NAMES) + ("incremental",)
 
     if not issubclass(makemigrations.MigrationAutodetector, MigrationAutodetectorMixin):
         makemigrations.MigrationAutodetector = type(
@@ -148,6 +204,8 @@ class DatabaseSchemaEditorMixin:
         return super().delete_model(model)
 
     def create_view(self, model):
+        if getattr(model._meta, "incremental", False):
+            return create_incremental_view(self, model)
         table = self.quote_name(model._meta.db_table)
         query = model._meta.query
         materialized = model._meta.materialized
@@ -157,8 +215,26 @@ class DatabaseSchemaEditorMixin:
             else f"CREATE MATERIALIZED VIEW IF NOT EXISTS {table} AS {query}"
         )
         self.execute(sql, [])
+        if materialized and getattr(model._meta, "materialized_unique_index", None):
+            self.create_view_unique_index(model)
+
+    def create_view_unique_index(self, model):
+        # REFRESH MATERIALIZED VIEW CONCURRENTLY needs a unique index to match old & new rows
+        columns = [
+            model._meta.get_field(field_name).column
+            for field_name in model._meta.materialized_unique_index
+        ]
+        name = self._create_index_name(model._meta.db_table, columns, suffix="_uniq")
+        self.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {self.quote_name(name)} "
+            f"ON {self.quote_name(model._meta.db_table)} "
+            f"({', '.join(self.quote_name(column) for column in columns)})",
+            [],
+        )
 
     def delete_view(self, model):
+        if getattr(model._meta, "incremental", False):
+            return delete_incremental_view(self, model)
         table = self.quote_name(model._meta.db_table)
         materialized = model._meta.materialized
         sql = (
@@ -189,6 +265,71 @@ def patch_schema_editor():
             )
 
 
+def patch_operations():
+    for config in settings.DATABASES.values():
+        backend = load_backend(config["ENGINE"])
+        ops_class = backend.DatabaseWrapper.ops_class
+
+        if issubclass(
+            ops_class, postgresql_operations.DatabaseOperations
+        ) and not issubclass(ops_class, DatabaseOperationsMixin):
+            backend.DatabaseWrapper.ops_class = type(
+                "DatabaseOperations",
+                (DatabaseOperationsMixin, ops_class),
+                {},
+            )
+
+    # any connections that have already been created
+    for connection in connections.all(initialized_only=True):
+        ops_class = type(connection.ops)
+        if issubclass(
+            ops_class, postgresql_operations.DatabaseOperations
+        ) and not issubclass(ops_class, DatabaseOperationsMixin):
+            connection.ops.__class__ = type(connection).ops_class
+
+
+def refresh_view(model, concurrently=True, using=None, sources=None):
+    """
+    REFRESH MATERIALIZED VIEW, by default CONCURRENTLY so that readers aren't locked out while it's refreshed. Concurrent
+    refreshes need Meta.materialized_unique_index. sources are the modification counters refresh_views() records.
+    """
+    if not getattr(model._meta, "materialized", False):
+        raise TypeError(f"{model._meta.label} isn't a materialized view")
+    if getattr(model._meta, "incremental", False):
+        raise TypeError(
+            f"{model._meta.label} is maintained incrementally, use refresh_incremental()"
+        )
+    if concurrently and not getattr(model._meta, "materialized_unique_index", None):
+        raise ValueError(
+            f"{model._meta.label} needs Meta.materialized_unique_index to be refreshed "
+            "concurrently"
+        )
+    from .models import ViewRefresh
+
+    connection = connections[using or router.db_for_write(model)]
+    table = connection.ops.quote_name(model._meta.db_table)
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if concurrently else ''}{table}"
+            )
+        ViewRefresh.objects.using(connection.alias).record(model, sources)
+
+
+def add_refresh_view(sender, **kwargs):
+    if getattr(sender._meta, "incremental", False):
+        sender.refresh_incremental = classmethod(refresh_incremental)
+    elif getattr(sender._meta, "materialized", False):
+        sender.refresh_view = classmethod(refresh_view)
+    if getattr(sender._meta, "route_reads", None) and getattr(
+        sender._meta, "materialized", False
+    ):
+        view_router.register(sender)
+
+
+class_prepared.connect(add_refresh_view)
+
+
 class QuerySetSerializer(BaseSerializer):
     def serialize(self):
         from mogrify_queryset.models import mogrify_queryset
@@ -206,6 +347,7 @@ class DbViewsConfig(AppConfig):
 
         patch_migrations()
         patch_schema_editor()
+        patch_operations()
 
         # unregister() should return the serializer
         iterable_serializer = Serializer._registry.pop(collections.abc.Iterable)
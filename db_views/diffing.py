@@ -0,0 +1,77 @@
+"""
+Compare view definitions without the database.
+
+makemigrations & migrate compare the query of every view in the migration state, the SQL it was mogrified to, with the
+model's, usually a queryset. Querysets are compiled & their params rendered as literals client side, then compared by a
+hash of their SQL with whitespace outside of quotes normalized. A queryset's hash is cached for as long as it's alive,
+SQL's in an LRU cache. Only params that need the database's adapters, eg lists, fall back to mogrifying with it.
+"""
+
+import functools
+import hashlib
+import re
+import weakref
+
+from django.core.exceptions import EmptyResultSet
+from django.db import DEFAULT_DB_ALIAS
+
+from mogrify_queryset.cache import query_templates
+from mogrify_queryset.literals import literal
+
+# quoted literals & identifiers are kept as is, quotes within them are doubled
+TOKEN_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|\s+""")
+
+
+def normalize_sql(sql):
+    return TOKEN_RE.sub(lambda match: match[1] or " ", sql).strip()
+
+
+@functools.lru_cache(maxsize=1024)
+def sql_hash(sql):
+    return hashlib.sha1(normalize_sql(sql).encode(), usedforsecurity=False).hexdigest()
+
+
+def offline_sql(queryset, using=DEFAULT_DB_ALIAS):
+    """
+    The SQL of queryset with its params as literals, None if any can't be rendered without a connection.
+    """
+    try:
+        sql, params = query_templates.sql_with_params(queryset.query, using)
+    except EmptyResultSet:
+        return None
+    literals = [literal(param) for param in params]
+    if None in literals:
+        return None
+    return sql % tuple(literals)
+
+
+_queryset_hashes = weakref.WeakKeyDictionary()
+
+
+def query_hash(query, using=DEFAULT_DB_ALIAS):
+    """
+    The hash of a view's query, SQL or a queryset, None if it can't be computed without the database.
+    """
+    if isinstance(query, str):
+        return sql_hash(query)
+    if query not in _queryset_hashes:
+        sql = offline_sql(query, using)
+        _queryset_hashes[query] = None if sql is None else sql_hash(sql)
+    return _queryset_hashes[query]
+
+
+def queries_differ(old_query, new_query, using=DEFAULT_DB_ALIAS):
+    if old_query is None or new_query is None:
+        return old_query is not new_query
+    old_hash = query_hash(old_query, using)
+    new_hash = query_hash(new_query, using)
+    if old_hash is not None and new_hash is not None:
+        return old_hash != new_hash
+
+    from mogrify_queryset.models import mogrify_queryset
+
+    return sql_hash(
+        old_query if isinstance(old_query, str) else mogrify_queryset(old_query)
+    ) != sql_hash(
+        new_query if isinstance(new_query, str) else mogrify_queryset(new_query)
+    )
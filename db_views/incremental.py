@@ -0,0 +1,376 @@
+"""
+Incrementally maintained aggregate views.
+
+A materialized view model with Meta.incremental = True whose query sums & counts rows of a single table, grouped by
+Meta.materialized_unique_index, is backed by a regular table instead of a materialized view. Statement level triggers
+on the source table aggregate each statement's transition tables with the view's own query - inserted rows are added,
+deleted rows subtracted & updates are both - into a delta table. refresh_incremental() applies the pending deltas to
+only the groups they change.
+
+Only SUM() & COUNT() without DISTINCT can be maintained from the changes alone, & groups can't be filtered with HAVING
+as it'd be applied to the changes rather than the totals. The backing & delta tables have a hidden row count per group,
+so that groups are removed when their last row is, & a count of non-NULL values per sum, so that a sum of no values is
+NULL as it is in the view's query.
+"""
+
+import re
+
+from django.db import connections, router, transaction
+from django.db.backends.utils import truncate_name
+
+ROWS = "__rows"
+
+# Django's SQL for a grouped query of a single table: the source is always the first FROM & has no alias
+QUERY_RE = re.compile(
+    r'SELECT (?!DISTINCT )(?P<select>.+?) FROM (?P<source>"[^"]+")(?P<rest>(?: .+)? GROUP BY .+)',
+    re.DOTALL,
+)
+COLUMN_RE = re.compile(r'(?P<expression>.+) AS "(?P<alias>(?:[^"]|"")+)"', re.DOTALL)
+AGGREGATE_RE = re.compile(r"(?P<function>SUM|COUNT)\((?P<argument>.*)\)", re.IGNORECASE)
+# quoted literals & identifiers, their contents aren't SQL
+QUOTED_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+
+
+def unquoted(sql):
+    # blanked out rather than removed so that positions are the same
+    return QUOTED_RE.sub(
+        lambda match: match[0][0] + " " * (len(match[0]) - 2) + match[0][0], sql
+    )
+
+
+def split_columns(select):
+    """
+    The columns of a select list, split on the commas that aren't in parentheses or quotes.
+    """
+    columns = []
+    depth = start = 0
+    for match in re.finditer(f"{QUOTED_RE.pattern}|[(),]", select):
+        if match[0] == "(":
+            depth += 1
+        elif match[0] == ")":
+            depth -= 1
+        elif match[0] == "," and depth == 0:
+            columns.append(select[start : match.start()].strip())
+            start = match.end()
+    columns.append(select[start:].strip())
+    return columns
+
+
+def balanced(sql):
+    depth = 0
+    for char in unquoted(sql):
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        if depth < 0:
+            return False
+    return depth == 0
+
+
+def parse_aggregate(expression):
+    """
+    (function, argument, filter) for a SUM() or COUNT() without DISTINCT, optionally with a FILTER clause, else None.
+    """
+    function, _, rest = expression.partition("(")
+    # the argument's closing parenthesis is where the depth first returns to 0
+    depth = 1
+    for position, char in enumerate(unquoted(rest)):
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        if depth == 0:
+            break
+    else:
+        return None
+    match = AGGREGATE_RE.fullmatch(f"{function}({rest[: position + 1]}")
+    aggregate_filter = rest[position + 1 :].strip()
+    if (
+        match is None
+        or re.match(r"DISTINCT\b", match["argument"].strip(), re.IGNORECASE)
+        or aggregate_filter
+        and not (
+            re.fullmatch(r"FILTER \(WHERE .+\)", aggregate_filter, re.DOTALL)
+            and balanced(aggregate_filter[len("FILTER ") :])
+        )
+    ):
+        return None
+    return match["function"].upper(), match["argument"], aggregate_filter
+
+
+def parse_query(model):
+    sql = model._meta.query
+    if not isinstance(sql, str):
+        from mogrify_queryset.models import mogrify_queryset
+
+        sql = mogrify_queryset(sql)
+    match = QUERY_RE.fullmatch(sql)
+    if (
+        match is None
+        or unquoted(sql).count(" FROM ") != 1
+        or " JOIN " in unquoted(sql)
+        or " HAVING " in unquoted(match["rest"])
+    ):
+        raise ValueError(
+            f"{model._meta.label} can't be maintained incrementally, the query must be "
+            "grouped sums & counts of a single table"
+        )
+    # min, max, averages & distinct counts can't be updated from the changes alone, nor can groups be filtered by
+    # their totals before they're known
+    key = key_columns(model)
+    for column in split_columns(match["select"]):
+        column_match = COLUMN_RE.fullmatch(column)
+        if column_match is None or (
+            column_match["alias"] not in key
+            and parse_aggregate(column_match["expression"]) is None
+        ):
+            raise ValueError(
+                f"{model._meta.label} can't be maintained incrementally, {column} "
+                "isn't a SUM() or COUNT() without DISTINCT"
+            )
+    return match
+
+
+def sum_counts(match, key):
+    """
+    {column: COUNT() of the values it sums} for each SUM() column, a sum of no values is NULL rather than 0.
+    """
+    counts = {}
+    for column in split_columns(match["select"]):
+        column_match = COLUMN_RE.fullmatch(column)
+        if column_match["alias"] in key:
+            continue
+        function, argument, aggregate_filter = parse_aggregate(
+            column_match["expression"]
+        )
+        if function == "SUM":
+            counts[column_match["alias"]] = " ".join(
+                filter(None, [f"COUNT({argument})", aggregate_filter])
+            )
+    return counts
+
+
+def sum_count_column(column):
+    return f"{ROWS}_{column}"
+
+
+def delta_table(model, connection):
+    return truncate_name(
+        f"{model._meta.db_table}_delta", connection.ops.max_name_length()
+    )
+
+
+def key_columns(model):
+    if not getattr(model._meta, "materialized_unique_index", None):
+        raise ValueError(
+            f"{model._meta.label} needs Meta.materialized_unique_index to be the fields "
+            "it's grouped by"
+        )
+    return [
+        model._meta.get_field(field_name).column
+        for field_name in model._meta.materialized_unique_index
+    ]
+
+
+def aggregate_columns(model):
+    key = key_columns(model)
+    return [
+        field.column for field in model._meta.concrete_fields if field.column not in key
+    ]
+
+
+def counter_columns(match, model):
+    """
+    The hidden columns: the number of non-NULL values of each sum & the number of rows in the group.
+    """
+    return [
+        *(sum_count_column(column) for column in sum_counts(match, key_columns(model))),
+        ROWS,
+    ]
+
+
+def counted_query(match, model, source=None):
+    """
+    The view's query with the hidden counts of each group, from source rather than the table if given.
+    """
+    counts = [
+        f'{count} AS "{sum_count_column(column)}"'
+        for column, count in sum_counts(match, key_columns(model)).items()
+    ]
+    select = ", ".join([match["select"], *counts, f'COUNT(*) AS "{ROWS}"'])
+    source = f"{source} AS {match['source']}" if source else match["source"]
+    return f"SELECT {select} FROM {source}{match['rest']}"
+
+
+def create_incremental_view(schema_editor, model):
+    quote_name = schema_editor.quote_name
+    match = parse_query(model)
+    table = quote_name(model._meta.db_table)
+    delta = quote_name(delta_table(model, schema_editor.connection))
+    key = [quote_name(column) for column in key_columns(model)]
+    aggregates = [quote_name(column) for column in aggregate_columns(model)]
+    counters = [quote_name(column) for column in counter_columns(match, model)]
+    columns = ", ".join([*key, *aggregates, *counters])
+
+    # writes committed between creating the table & the triggers would never be seen, they wait until the migration's
+    # transaction commits instead
+    schema_editor.execute(f"LOCK TABLE {match['source']} IN SHARE MODE", None)
+    # the view's query is already mogrified, don't interpret any % as a placeholder
+    schema_editor.execute(
+        f"CREATE TABLE {table} AS {counted_query(match, model)}", None
+    )
+    schema_editor.execute(
+        f"CREATE TABLE {delta} AS {counted_query(match, model)} WITH NO DATA", None
+    )
+    # groups are looked up by their key when applying deltas, NULL keys are a group like any other
+    index = schema_editor._create_index_name(
+        model._meta.db_table, key_columns(model), suffix="_uniq"
+    )
+    schema_editor.execute(
+        f"CREATE UNIQUE INDEX {quote_name(index)} ON {table} ({', '.join(key)}) "
+        "NULLS NOT DISTINCT",
+        None,
+    )
+
+    negated = ", ".join([*key, *(f"-{column}" for column in [*aggregates, *counters])])
+    negated_sums = ", ".join(
+        [*key, *(f"-sum({column})" for column in [*aggregates, *counters])]
+    )
+    schema_editor.execute(
+        f"""
+        CREATE FUNCTION {delta}() RETURNS trigger LANGUAGE plpgsql AS $delta$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {delta} ({columns})
+                SELECT {columns} FROM ({counted_query(match, model, "new_rows")}) new_rows;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO {delta} ({columns})
+                SELECT {negated} FROM ({counted_query(match, model, "old_rows")}) old_rows;
+            END IF;
+            IF TG_OP = 'TRUNCATE' THEN
+                -- cancel out everything, whether applied or not
+                INSERT INTO {delta} ({columns})
+                SELECT {negated_sums}
+                FROM (
+                    SELECT {columns} FROM {table} UNION ALL SELECT {columns} FROM {delta}
+                ) groups
+                GROUP BY {", ".join(key)};
+            END IF;
+            RETURN NULL;
+        END
+        $delta$
+        """,
+        None,
+    )
+
+    # transition tables can only be used by triggers for a single event
+    for event, referencing in [
+        ("INSERT", "REFERENCING NEW TABLE AS new_rows"),
+        ("UPDATE", "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+        ("DELETE", "REFERENCING OLD TABLE AS old_rows"),
+        ("TRUNCATE", ""),
+    ]:
+        trigger = truncate_name(
+            f"{delta_table(model, schema_editor.connection)}_{event.lower()}",
+            schema_editor.connection.ops.max_name_length(),
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {quote_name(trigger)} AFTER {event} ON {match['source']} "
+            f"{referencing} FOR EACH STATEMENT EXECUTE FUNCTION {delta}()",
+            None,
+        )
+
+
+def delete_incremental_view(schema_editor, model):
+    table = schema_editor.quote_name(model._meta.db_table)
+    delta = schema_editor.quote_name(delta_table(model, schema_editor.connection))
+    # the triggers depend on the function
+    schema_editor.execute(f"DROP FUNCTION IF EXISTS {delta}() CASCADE", None)
+    schema_editor.execute(f"DROP TABLE IF EXISTS {delta}", None)
+    schema_editor.execute(f"DROP TABLE IF EXISTS {table}", None)
+
+
+def refresh_incremental(model, using=None):
+    """
+    Apply the changes to the source table since the last refresh, returning the number of groups that were added,
+    updated or removed.
+    """
+    from .models import ViewRefresh
+
+    if not getattr(model._meta, "incremental", False):
+        raise TypeError(f"{model._meta.label} isn't maintained incrementally")
+    connection = connections[using or router.db_for_write(model)]
+    quote_name = connection.ops.quote_name
+    match = parse_query(model)
+    table = quote_name(model._meta.db_table)
+    delta = quote_name(delta_table(model, connection))
+    key = [quote_name(column) for column in key_columns(model)]
+    aggregates = [quote_name(column) for column in aggregate_columns(model)]
+    counters = [quote_name(column) for column in counter_columns(match, model)]
+    rows = quote_name(ROWS)
+    # SUM() columns -> their count of non-NULL values
+    sums = {
+        quote_name(column): quote_name(sum_count_column(column))
+        for column in sum_counts(match, key_columns(model))
+    }
+    columns = ", ".join([*key, *aggregates, *counters])
+
+    def same_group(a, b):
+        return " AND ".join(f"{a}.{k} IS NOT DISTINCT FROM {b}.{k}" for k in key)
+
+    def added(column):
+        if column in sums:
+            # a sum of no values is NULL
+            return (
+                f"CASE WHEN {table}.{sums[column]} + changes.{sums[column]} > 0 "
+                f"THEN coalesce({table}.{column}, 0) + coalesce(changes.{column}, 0) END"
+            )
+        return f"{table}.{column} + changes.{column}"
+
+    def inserted(column):
+        if column in sums:
+            return f"CASE WHEN changes.{sums[column]} > 0 THEN changes.{column} END"
+        return f"changes.{column}"
+
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            # refreshes are applied one at a time, readers aren't blocked
+            cursor.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+            # Deltas are only deleted if they were visible to this statement, ones committed in the meantime are left
+            # for next time. Each group is either deleted, updated or inserted: the snapshot is the same for each part
+            # of the statement so they all see the groups as they were before it.
+            cursor.execute(f"""
+                WITH delta AS (
+                    DELETE FROM {delta} RETURNING *
+                ),
+                changes AS (
+                    SELECT {", ".join([*key, *(f"sum({column}) AS {column}" for column in [*aggregates, *counters])])}
+                    FROM delta
+                    GROUP BY {", ".join(key)}
+                ),
+                emptied AS (
+                    DELETE FROM {table}
+                    USING changes
+                    WHERE {same_group(table, "changes")}
+                        AND {table}.{rows} + changes.{rows} = 0
+                    RETURNING 1
+                ),
+                updated AS (
+                    UPDATE {table}
+                    SET {", ".join(f"{column} = {added(column)}" for column in [*aggregates, *counters])}
+                    FROM changes
+                    WHERE {same_group(table, "changes")}
+                        AND {table}.{rows} + changes.{rows} <> 0
+                    RETURNING 1
+                ),
+                inserted AS (
+                    INSERT INTO {table} ({columns})
+                    SELECT {", ".join([*key, *(inserted(column) for column in [*aggregates, *counters])])}
+                    FROM changes
+                    WHERE changes.{rows} > 0
+                        AND NOT EXISTS (SELECT FROM {table} WHERE {same_group(table, "changes")})
+                    RETURNING 1
+                )
+                SELECT (SELECT count(*) FROM emptied)
+                    + (SELECT count(*) FROM updated)
+                    + (SELECT count(*) FROM inserted)
+                """)
+            changed = cursor.fetchone()[0]
+        ViewRefresh.objects.using(connection.alias).record(model)
+    return changed
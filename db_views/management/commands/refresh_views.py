@@ -0,0 +1,60 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from db_views.scheduler import refresh_views
+
+
+class Command(BaseCommand):
+    help = (
+        "REFRESH MATERIALIZED VIEW for db_views models in dependency order, skipping "
+        "views whose sources haven't changed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "models",
+            nargs="*",
+            metavar="app_label.ModelName",
+            help="Defaults to all materialized views",
+        )
+        parser.add_argument(
+            "--no-concurrently",
+            action="store_false",
+            dest="concurrently",
+            help="Lock out readers while refreshing, the default for views without "
+            "Meta.materialized_unique_index",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=4,
+            help="The number of views refreshed at once, each with its own connection",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Refresh views whose sources haven't changed",
+        )
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, models, concurrently, jobs, force, database, **options):
+        try:
+            models = [apps.get_model(label) for label in models] or None
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        if jobs < 1:
+            raise CommandError("--jobs must be at least 1")
+
+        try:
+            results = refresh_views(
+                models,
+                using=database,
+                max_workers=jobs,
+                concurrently=concurrently,
+                force=force,
+            )
+        except TypeError as e:
+            raise CommandError(e)
+        for model, action in results.items():
+            self.stdout.write(f"{model._meta.db_table}: {action}")
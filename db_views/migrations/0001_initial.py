@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="Account",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField()),
+                ("is_active", models.BooleanField(db_default=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ActiveAccount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField()),
+            ],
+            options={
+                "db_view": True,
+                "query": 'SELECT "db_views_account"."id", "db_views_account"."name", "db_views_account"."is_active" FROM "db_views_account" WHERE ("db_views_account"."is_active" AND "db_views_account"."name" = \'foo\')',
+                "materialized": True,
+                "materialized_unique_index": ["id"],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("db_views", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ActiveAccountCount",
+            fields=[
+                ("name", models.CharField(primary_key=True, serialize=False)),
+                ("accounts", models.IntegerField()),
+            ],
+            options={
+                "db_view": True,
+                "query": 'SELECT "db_views_activeaccount"."name" AS "name", COUNT(*) AS "accounts" FROM "db_views_activeaccount" GROUP BY 1',
+                "materialized": True,
+                "materialized_unique_index": ["name"],
+            },
+        ),
+        migrations.CreateModel(
+            name="ViewRefresh",
+            fields=[
+                ("view", models.CharField(primary_key=True, serialize=False)),
+                ("sources", models.JSONField()),
+                ("refreshed_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
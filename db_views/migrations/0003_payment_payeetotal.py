@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("db_views", "0002_activeaccountcount_viewrefresh"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Payment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("payee", models.CharField()),
+                ("amount", models.DecimalField(decimal_places=2, max_digits=12)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="PayeeTotal",
+            fields=[
+                ("payee", models.CharField(primary_key=True, serialize=False)),
+                ("payments", models.IntegerField()),
+                (
+                    "total",
+                    models.DecimalField(decimal_places=2, max_digits=12, null=True),
+                ),
+            ],
+            options={
+                "db_view": True,
+                "query": 'SELECT "db_views_payment"."payee" AS "payee", COUNT(*) AS "payments", SUM("db_views_payment"."amount") AS "total" FROM "db_views_payment" GROUP BY 1',
+                "materialized": True,
+                "materialized_unique_index": ["payee"],
+                "incremental": True,
+            },
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("db_views", "0003_payment_payeetotal"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="payment",
+            name="amount",
+            field=models.DecimalField(decimal_places=2, max_digits=12, null=True),
+        ),
+    ]
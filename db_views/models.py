@@ -1,5 +1,6 @@
-from django.db import models
+from datetime import timedelta
 
+from django.db import connections, models
 
 #
 # - serialize querysets
@@ -20,3 +21,70 @@ class ActiveAccount(models.Model):
         db_view = True
         query = Account.objects.filter(is_active=True, name=models.Value("foo"))
         materialized = True
+        materialized_unique_index = ["id"]
+
+
+class ActiveAccountCount(models.Model):
+    # a materialized view on a materialized view, it must be refreshed after ActiveAccount
+    name = models.CharField(primary_key=True)
+    accounts = models.IntegerField()
+
+    class Meta:
+        db_view = True
+        query = ActiveAccount.objects.values("name").annotate(
+            accounts=models.Count("*")
+        )
+        materialized = True
+        materialized_unique_index = ["name"]
+
+
+class Payment(models.Model):
+    payee = models.CharField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+
+
+class PayeeTotal(models.Model):
+    # backed by a table that's kept up to date from the changes to Payment
+    payee = models.CharField(primary_key=True)
+    payments = models.IntegerField()
+    total = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+
+    class Meta:
+        db_view = True
+        query = Payment.objects.values("payee").annotate(
+            payments=models.Count("*"), total=models.Sum("amount")
+        )
+        materialized = True
+        materialized_unique_index = ["payee"]
+        incremental = True
+        # matching Payment queries read from this instead when refreshed in the last 5 minutes
+        route_reads = timedelta(minutes=5)
+
+
+class ViewRefreshQuerySet(models.QuerySet):
+    def record(self, view, sources=None):
+        """
+        Record that view has just been refreshed, with the modification counters of its sources if given.
+        """
+        from .routing import view_router
+
+        defaults = {} if sources is None else {"sources": sources}
+        self.update_or_create(
+            view=view._meta.db_table,
+            defaults=defaults,
+            create_defaults={"sources": {}, **defaults},
+        )
+        view_router.refreshed(view, connections[self.db])
+
+
+class ViewRefresh(models.Model):
+    """
+    When a materialized view was last refreshed & the modification counters of the relations it reads from when it was
+    last refreshed by refresh_views().
+    """
+
+    view = models.CharField(primary_key=True)
+    sources = models.JSONField()
+    refreshed_at = models.DateTimeField(auto_now=True)
+
+    objects = ViewRefreshQuerySet.as_manager()
@@ -0,0 +1,269 @@
+"""
+Read queries that match a materialized view's query from the view instead.
+
+A view model with Meta.route_reads registers its query, a values() queryset, with view_router. When any query of the
+same model is compiled it's compared to the registered views: if it compiles to the same SQL once its filters, ordering
+& limits are removed, has at least the view's filters & the rest are lookups on the view's columns, it's compiled as a
+query of the view with the remaining filters, ordering & limits instead. Results are the same as from the original query
+as of the view's last refresh.
+
+Meta.route_reads is the tolerated staleness, a timedelta since the view was last refreshed, or True for any. Queries
+within transaction.atomic() aren't routed so that a transaction sees its own writes.
+"""
+
+import contextlib
+import contextvars
+import functools
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.exceptions import EmptyResultSet, FullResultSet
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.lookups import Lookup
+from django.db.models.sql.where import AND, WhereNode
+from django.utils import timezone
+
+from mogrify_queryset.cache import uncacheable
+
+_routing = contextvars.ContextVar("db_views_routing", default=True)
+
+
+@contextlib.contextmanager
+def no_routing():
+    """
+    Read from the queried tables within the block, eg for reads that must see the latest changes.
+    """
+    token = _routing.set(False)
+    try:
+        yield
+    finally:
+        _routing.reset(token)
+
+
+def in_transaction(connection):
+    # the atomic blocks TestCase wraps each test in aren't the caller's transaction
+    return any(
+        not getattr(block, "_from_testcase", False)
+        for block in connection.atomic_blocks
+    )
+
+
+def structure(query, connection):
+    """
+    The SQL of query without its filters, ordering or limits. Grouped queries are compared with all of their
+    annotations selected, eg count() drops the ones it doesn't need but they don't change which rows there are.
+    """
+    query = query.clone()
+    if query.group_by is not None:
+        query.set_annotation_mask(query.annotations)
+    query.where = WhereNode()
+    query.clear_ordering(force=True)
+    query.clear_limits()
+    try:
+        with no_routing():
+            return query.get_compiler(connection=connection).as_sql()
+    except (EmptyResultSet, FullResultSet):
+        return None
+
+
+class ViewRouter:
+    # refresh times are cached for this long, a refresh in the meantime is only missed in the conservative direction
+    refresh_check_interval = timedelta(seconds=10)
+
+    def __init__(self):
+        # source model -> view models
+        self.views = defaultdict(list)
+        # (alias, view model) -> SQL
+        self.structures = {}
+        # (alias, view model) -> (refreshed_at, checked_at)
+        self.refreshes = {}
+        self.lock = threading.Lock()
+
+    def register(self, view):
+        query = view._meta.query
+        if not isinstance(query, QuerySet) or not query.query.values_select:
+            raise ValueError(
+                f"{view._meta.label} can't route reads, Meta.query must be a values() "
+                "queryset"
+            )
+        where = query.query.where
+        if where.connector != AND or where.negated:
+            raise ValueError(
+                f"{view._meta.label} can't route reads, Meta.query must only be "
+                "filtered by ANDed lookups"
+            )
+        # the view's own query, & clones of it, always compile to its definition
+        query.query.view_definition = True
+        self.views[query.model].append(view)
+
+    def view_structure(self, view, connection):
+        key = (connection.alias, view)
+        if key not in self.structures:
+            self.structures[key] = structure(view._meta.query.query, connection)
+        return self.structures[key]
+
+    def refreshed_at(self, view, connection):
+        from .models import ViewRefresh
+
+        key = (connection.alias, view)
+        now = timezone.now()
+        with self.lock:
+            refreshed_at, checked_at = self.refreshes.get(key, (None, None))
+        if checked_at is None or now - checked_at > self.refresh_check_interval:
+            refreshed_at = (
+                ViewRefresh.objects.using(connection.alias)
+                .filter(view=view._meta.db_table)
+                .values_list("refreshed_at", flat=True)
+                .first()
+            )
+            with self.lock:
+                self.refreshes[key] = (refreshed_at, now)
+        return refreshed_at
+
+    def refreshed(self, view, connection):
+        # a refresh by this process is seen straight away, once committed
+        def update():
+            now = timezone.now()
+            with self.lock:
+                self.refreshes[connection.alias, view] = (now, now)
+
+        transaction.on_commit(update, using=connection.alias)
+
+    def is_fresh(self, view, connection):
+        max_staleness = view._meta.route_reads
+        if max_staleness is True:
+            return True
+        refreshed_at = self.refreshed_at(view, connection)
+        return (
+            refreshed_at is not None and timezone.now() - refreshed_at <= max_staleness
+        )
+
+    def route(self, query, connection):
+        """
+        A queryset of a view that reads the same results as query, or None.
+        """
+        views = self.views.get(query.model)
+        if not views or getattr(query, "view_definition", False):
+            return None
+        # whether it's routed depends on no_routing(), the transaction & the view's refresh time too
+        uncacheable()
+        if not _routing.get() or len(query.alias_map) != 1:
+            return None
+        # the view hasn't seen any writes the transaction has made to its sources
+        if in_transaction(connection):
+            return None
+        if query.where.connector != AND or query.where.negated:
+            return None
+        if query.extra_order_by or not all(
+            isinstance(name, str) for name in query.order_by
+        ):
+            return None
+        # the model's default ordering isn't in the view, it's ignored when grouped
+        if (
+            not query.order_by
+            and query.default_ordering
+            and query.get_meta().ordering
+            and not query.group_by
+        ):
+            return None
+        ordering = {name.lstrip("-") for name in query.order_by}
+        columns = list(query.selected or ())
+
+        query_structure = None
+        for view in views:
+            view_query = view._meta.query.query
+            filters = self.remaining_filters(query, view_query)
+            if (
+                filters is None
+                or not columns
+                or not {*columns, *ordering} <= set(view_query.selected)
+            ):
+                continue
+            if query_structure is None:
+                query_structure = structure(query, connection)
+            if query_structure is None or query_structure != self.view_structure(
+                view, connection
+            ):
+                continue
+            if not self.is_fresh(view, connection):
+                continue
+
+            queryset = (
+                view._base_manager.db_manager(connection.alias)
+                .filter(**filters)
+                .values(*columns)
+                .order_by(*query.order_by)
+            )
+            queryset.query.set_limits(query.low_mark, query.high_mark)
+            return queryset
+        return None
+
+    def remaining_filters(self, query, view_query):
+        """
+        The filters of query that aren't in view_query as lookups on the view's fields, None if query doesn't have all
+        of the view's filters or the rest can't be filtered on the view.
+        """
+        remaining = list(query.where.children)
+        for child in view_query.where.children:
+            if child not in remaining:
+                return None
+            remaining.remove(child)
+
+        # the view's columns are named by their alias: selected fields are an index into select, annotations by name
+        columns = {
+            name: (
+                view_query.select[selected]
+                if isinstance(selected, int)
+                else view_query.annotations.get(selected)
+            )
+            for name, selected in view_query.selected.items()
+        }
+        filters = {}
+        for child in remaining:
+            if not isinstance(child, Lookup) or hasattr(
+                child.rhs, "resolve_expression"
+            ):
+                return None
+            name = next(
+                (name for name, column in columns.items() if child.lhs == column),
+                None,
+            )
+            key = f"{name}__{child.lookup_name}"
+            if name is None or key in filters:
+                return None
+            filters[key] = child.rhs
+        return filters
+
+
+view_router = ViewRouter()
+
+
+class RoutedCompilerMixin:
+    def as_sql(self, with_limits=True, with_col_aliases=False):
+        queryset = view_router.route(self.query, self.connection)
+        if queryset is None:
+            return super().as_sql(with_limits, with_col_aliases)
+        # the results are read as though they were from this query
+        self.pre_sql_setup(with_col_aliases=with_col_aliases)
+        return queryset.query.get_compiler(
+            connection=self.connection, elide_empty=self.elide_empty
+        ).as_sql(with_limits, with_col_aliases)
+
+
+class DatabaseOperationsMixin:
+    def compiler(self, compiler_name):
+        compiler = super().compiler(compiler_name)
+        if compiler_name == "SQLCompiler":
+            return routed_compiler(compiler)
+        return compiler
+
+
+@functools.cache
+def routed_compiler(compiler_class):
+    return type(
+        compiler_class.__name__,
+        (RoutedCompilerMixin, compiler_class),
+        {},
+    )
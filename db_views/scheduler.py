@@ -0,0 +1,236 @@
+"""
+Refresh materialized views in dependency order.
+
+A view's query is stored as a rewrite rule & pg_depend records the relations the rule reads from. Plain views are
+followed through to what they read so that a materialized view on a plain view over another materialized view still
+depends on it. Each view is refreshed once the views it depends on have been, independent branches in parallel.
+
+Views are skipped when nothing they read from has changed since they were last refreshed, judged by the modification
+counters in pg_stat_user_tables & the relation's filenode, which changes on TRUNCATE. The counters are read before each
+refresh so a change is either included in the refresh or seen next time, at worst a view is refreshed needlessly. Changes
+made through functions called by a view's query aren't tracked.
+"""
+
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from graphlib import TopologicalSorter
+
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .apps import refresh_view
+from .incremental import refresh_incremental
+
+DEPENDENCIES_SQL = """
+SELECT DISTINCT pg_rewrite.ev_class, pg_depend.refobjid, pg_class.relkind
+FROM pg_rewrite
+JOIN pg_depend
+    ON pg_depend.classid = 'pg_rewrite'::regclass
+    AND pg_depend.objid = pg_rewrite.oid
+    AND pg_depend.refclassid = 'pg_class'::regclass
+    AND pg_depend.refobjid <> pg_rewrite.ev_class
+JOIN pg_class ON pg_class.oid = pg_depend.refobjid
+UNION
+-- selecting from a parent table includes its partitions & inheriting tables
+SELECT pg_inherits.inhparent, pg_inherits.inhrelid, pg_class.relkind
+FROM pg_inherits
+JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid
+"""
+
+SOURCE_STATS_SQL = """
+SELECT relid, pg_relation_filenode(relid), n_tup_ins, n_tup_upd, n_tup_del
+FROM pg_stat_user_tables
+WHERE relid = ANY(%s::oid[])
+"""
+
+
+def materialized_views():
+    return [
+        model
+        for model in apps.get_models()
+        if getattr(model._meta, "materialized", False)
+    ]
+
+
+class ViewGraph:
+    """
+    The relations each materialized view reads from & the views among them that must be refreshed first.
+    """
+
+    def __init__(self, models, using=DEFAULT_DB_ALIAS):
+        self.models = list(models)
+        self.using = using
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT pg_class.oid, pg_class.relispopulated
+                FROM unnest(%s::text[]) WITH ORDINALITY AS view(name, position)
+                JOIN pg_class ON pg_class.oid = view.name::regclass
+                ORDER BY view.position
+                """,
+                [[connection.ops.quote_name(m._meta.db_table) for m in self.models]],
+            )
+            rows = cursor.fetchall()
+            cursor.execute(DEPENDENCIES_SQL)
+            edges = defaultdict(list)
+            for oid, source, relkind in cursor.fetchall():
+                edges[oid].append((source, relkind))
+
+        self.oids = {model: oid for model, (oid, _) in zip(self.models, rows)}
+        self.populated = {
+            model: populated for model, (_, populated) in zip(self.models, rows)
+        }
+        models_by_oid = {oid: model for model, oid in self.oids.items()}
+        self.sources = {}
+        self.dependencies = {}
+        for model, oid in self.oids.items():
+            self.sources[model] = self.find_sources(oid, edges)
+            self.dependencies[model] = {
+                models_by_oid[source]
+                for source in self.sources[model]
+                if source in models_by_oid
+            }
+
+    def find_sources(self, oid, edges):
+        # plain views have no data of their own, they're followed to what they read from; materialized views are
+        # sources & aren't followed, a change to what they read from isn't seen until they're refreshed
+        sources = set()
+        seen = {oid}
+        stack = [oid]
+        while stack:
+            for source, relkind in edges.get(stack.pop(), ()):
+                if source in seen:
+                    continue
+                seen.add(source)
+                if relkind != "v":
+                    sources.add(source)
+                if relkind != "m":
+                    stack.append(source)
+        return sources
+
+    def view_changes(self, model):
+        # the current transaction's changes, which aren't in pg_stat_user_tables until committed & flushed
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT pg_relation_filenode(relid), n_tup_ins, n_tup_upd, n_tup_del
+                FROM pg_stat_xact_user_tables
+                WHERE relid = %s
+                """,
+                [self.oids[model]],
+            )
+            return cursor.fetchone()
+
+    def source_stats(self, model):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(SOURCE_STATS_SQL, [sorted(self.sources[model])])
+            return {str(oid): list(counters) for oid, *counters in cursor.fetchall()}
+
+
+def refresh_views(
+    models=None,
+    *,
+    using=DEFAULT_DB_ALIAS,
+    max_workers=4,
+    concurrently=True,
+    force=False,
+):
+    """
+    Refresh materialized views (by default all of them) in dependency order, skipping those whose sources haven't
+    changed unless force is set.
+
+    Up to max_workers views are refreshed at once, each worker with its own connection - with a pooled database these
+    are taken from the pool. With max_workers=1 views are refreshed in the calling thread & within any transaction it's
+    in. Views with Meta.materialized_unique_index are refreshed concurrently unless concurrently is False.
+
+    Returns {model: action}, in the order of models, where action is one of "refreshed", "refreshed concurrently",
+    "refreshed incrementally" or "unchanged".
+    """
+    from .models import ViewRefresh
+
+    models = materialized_views() if models is None else models
+    for model in models:
+        if not getattr(model._meta, "materialized", False):
+            raise TypeError(f"{model._meta.label} isn't a materialized view")
+    graph = ViewGraph(models, using)
+    # include the caller's own changes, the backend otherwise flushes its stats at most once a second
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT pg_stat_force_next_flush()")
+
+    refreshes = {
+        refresh.view: refresh.sources
+        for refresh in ViewRefresh.objects.using(using).filter(
+            view__in=[model._meta.db_table for model in graph.models]
+        )
+    }
+    results = {}
+    # whether each refreshed view's contents changed, a concurrent refresh may find nothing to change
+    changed = {}
+
+    def refresh(model):
+        if getattr(model._meta, "incremental", False):
+            # the pending deltas are the changes, there's nothing to check
+            with transaction.atomic(using=using):
+                before = graph.view_changes(model)
+                refresh_incremental(model, using=using)
+                changed[model] = graph.view_changes(model) != before
+            return "refreshed incrementally"
+
+        stats = graph.source_stats(model)
+        if (
+            not force
+            and graph.populated[model]
+            and refreshes.get(model._meta.db_table) == stats
+            # the stats of a view refreshed by another worker may not have been flushed yet
+            and not any(changed[dependency] for dependency in graph.dependencies[model])
+        ):
+            changed[model] = False
+            return "unchanged"
+
+        # a view that's never been populated can't be refreshed concurrently
+        view_concurrently = (
+            concurrently
+            and graph.populated[model]
+            and bool(getattr(model._meta, "materialized_unique_index", None))
+        )
+        with transaction.atomic(using=using):
+            before = graph.view_changes(model)
+            refresh_view(
+                model, concurrently=view_concurrently, using=using, sources=stats
+            )
+            changed[model] = graph.view_changes(model) != before
+            with connections[using].cursor() as cursor:
+                cursor.execute("SELECT pg_stat_force_next_flush()")
+        return "refreshed concurrently" if view_concurrently else "refreshed"
+
+    sorter = TopologicalSorter(graph.dependencies)
+    if max_workers == 1:
+        for model in sorter.static_order():
+            results[model] = refresh(model)
+        return {model: results[model] for model in graph.models}
+
+    def refresh_in_thread(model):
+        try:
+            return refresh(model)
+        finally:
+            # each thread has its own connection
+            connections[using].close()
+
+    sorter.prepare()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while sorter.is_active():
+                for model in sorter.get_ready():
+                    running[executor.submit(refresh_in_thread, model)] = model
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    model = running.pop(future)
+                    results[model] = future.result()
+                    sorter.done(model)
+        except BaseException:
+            # don't start any views that were waiting, the ones already running are left to finish
+            executor.shutdown(cancel_futures=True)
+            raise
+    return {model: results[model] for model in graph.models}
@@ -1,3 +1,618 @@
-from django.test import TestCase
+import io
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+import pytest
+from django.apps import apps
+from django.contrib.postgres.fields import ArrayField
+from django.core.management import call_command
+from django.core.management.commands import makemigrations
+from django.db import OperationalError, connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.state import ProjectState
+from django.db.models import Avg, Count, IntegerField, Max, Min, Q, Sum, Value
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from delayed_query.pipeline import fetch_many
+from mogrify_queryset.models import mogrify_queryset
+
+from .apps import UpdateView, refresh_view
+from .diffing import normalize_sql, queries_differ, query_hash
+from .incremental import parse_query, refresh_incremental, sum_counts
+from .models import (
+    Account,
+    ActiveAccount,
+    ActiveAccountCount,
+    PayeeTotal,
+    Payment,
+    ViewRefresh,
+)
+from .routing import no_routing, view_router
+from .scheduler import DEPENDENCIES_SQL, ViewGraph, refresh_views
+
+pytestmark = pytest.mark.django_db
+
+benchmark = pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks"
+)
+
+
+def test_unique_index():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE tablename = 'db_views_activeaccount'"
+        )
+        [(indexdef,)] = cursor.fetchall()
+
+    assert indexdef.startswith("CREATE UNIQUE INDEX")
+    assert indexdef.endswith("USING btree (id)")
+
+
+def test_refresh_view():
+    account = Account.objects.create(name="foo")
+    Account.objects.create(name="bar")
+    assert list(ActiveAccount.objects.all()) == []
+
+    ActiveAccount.refresh_view()
+
+    assert list(ActiveAccount.objects.values_list("pk", flat=True)) == [account.pk]
+
+    account.delete()
+    ActiveAccount.refresh_view(concurrently=False)
+
+    assert list(ActiveAccount.objects.all()) == []
+
+
+def test_refresh_view_not_materialized():
+    with pytest.raises(TypeError):
+        refresh_view(Account)
+
+
+# the views are refreshed on other connections
+@pytest.mark.django_db(transaction=True)
+def test_refresh_views_command():
+    Account.objects.create(name="foo")
+    out = io.StringIO()
+
+    call_command("refresh_views", stdout=out)
+
+    assert out.getvalue() == (
+        "db_views_activeaccount: refreshed concurrently\n"
+        "db_views_activeaccountcount: refreshed concurrently\n"
+        "db_views_payeetotal: refreshed incrementally\n"
+    )
+    assert ActiveAccount.objects.count() == 1
+
+    out = io.StringIO()
+    call_command(
+        "refresh_views",
+        "db_views.ActiveAccount",
+        "--no-concurrently",
+        "--force",
+        stdout=out,
+    )
+
+    assert out.getvalue() == "db_views_activeaccount: refreshed\n"
+
+
+def test_view_graph():
+    graph = ViewGraph([ActiveAccount, ActiveAccountCount])
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 'db_views_account'::regclass::oid")
+        [(account,)] = cursor.fetchall()
+
+    assert graph.dependencies == {
+        ActiveAccount: set(),
+        ActiveAccountCount: {ActiveAccount},
+    }
+    assert graph.sources[ActiveAccount] == {account}
+    assert graph.sources[ActiveAccountCount] == {graph.oids[ActiveAccount]}
+
+
+def test_view_graph_through_plain_view():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE VIEW active_account_names AS "
+            "SELECT name FROM db_views_activeaccount"
+        )
+        cursor.execute(
+            "CREATE MATERIALIZED VIEW active_account_names_count AS "
+            "SELECT count(*) FROM active_account_names"
+        )
+        cursor.execute("SELECT 'active_account_names_count'::regclass::oid")
+        [(oid,)] = cursor.fetchall()
+
+    graph = ViewGraph([ActiveAccount])
+
+    with connection.cursor() as cursor:
+        cursor.execute(DEPENDENCIES_SQL)
+        edges = defaultdict(list)
+        for view, source, relkind in cursor.fetchall():
+            edges[view].append((source, relkind))
+    assert graph.find_sources(oid, edges) == {graph.oids[ActiveAccount]}
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_refresh_views(max_workers):
+    Account.objects.create(name="foo")
+
+    assert refresh_views(max_workers=max_workers) == {
+        ActiveAccount: "refreshed concurrently",
+        ActiveAccountCount: "refreshed concurrently",
+        PayeeTotal: "refreshed incrementally",
+    }
+    # in dependency order or the count would be of the unrefreshed view
+    assert list(ActiveAccountCount.objects.values_list("name", "accounts")) == [
+        ("foo", 1)
+    ]
+    assert ViewRefresh.objects.count() == 3
+
+    assert refresh_views(max_workers=max_workers) == {
+        ActiveAccount: "unchanged",
+        ActiveAccountCount: "unchanged",
+        PayeeTotal: "refreshed incrementally",
+    }
+
+    Account.objects.create(name="foo")
+
+    assert refresh_views(max_workers=max_workers) == {
+        ActiveAccount: "refreshed concurrently",
+        ActiveAccountCount: "refreshed concurrently",
+        PayeeTotal: "refreshed incrementally",
+    }
+    assert list(ActiveAccountCount.objects.values_list("name", "accounts")) == [
+        ("foo", 2)
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_refresh_views_unchanged_dependency():
+    Account.objects.create(name="foo")
+    refresh_views()
+    # an unrelated change that doesn't alter the contents of ActiveAccount
+    Account.objects.create(name="bar")
+
+    assert refresh_views([ActiveAccount, ActiveAccountCount]) == {
+        ActiveAccount: "refreshed concurrently",
+        ActiveAccountCount: "unchanged",
+    }
+
+
+@pytest.mark.django_db(transaction=True)
+def test_refresh_views_truncate():
+    Account.objects.create(name="foo")
+    refresh_views()
+    with connection.cursor() as cursor:
+        cursor.execute("TRUNCATE db_views_account")
+
+    assert refresh_views()[ActiveAccount] == "refreshed concurrently"
+    assert ActiveAccount.objects.count() == 0
+
+
+def test_refresh_views_force():
+    refresh_views(max_workers=1)
+
+    assert refresh_views(
+        [ActiveAccount, ActiveAccountCount], max_workers=1, force=True
+    ) == {
+        ActiveAccount: "refreshed concurrently",
+        ActiveAccountCount: "refreshed concurrently",
+    }
+
+
+def test_refresh_views_records_once():
+    refresh_views([ActiveAccount], max_workers=1)
+
+    with CaptureQueriesContext(connection) as queries:
+        refresh_views([ActiveAccount], max_workers=1, force=True)
+
+    writes = [
+        query["sql"]
+        for query in queries
+        if query["sql"].startswith(
+            ('INSERT INTO "db_views_viewrefresh"', 'UPDATE "db_views_viewrefresh"')
+        )
+    ]
+    assert len(writes) == 1
+    assert ViewRefresh.objects.get(view="db_views_activeaccount").sources
+
+
+def test_refresh_views_not_materialized():
+    with pytest.raises(TypeError):
+        refresh_views([Account])
+
+
+def payee_totals():
+    return sorted(PayeeTotal.objects.values_list("payee", "payments", "total"))
+
+
+def expected_payee_totals():
+    with no_routing():
+        return sorted(
+            Payment.objects.values("payee")
+            .annotate(payments=Count("*"), total=Sum("amount"))
+            .values_list("payee", "payments", "total")
+        )
+
+
+def test_refresh_incremental():
+    Payment.objects.bulk_create(
+        [
+            Payment(payee="a", amount=Decimal("1.50")),
+            Payment(payee="a", amount=Decimal("2.50")),
+            Payment(payee="b", amount=Decimal("10")),
+        ]
+    )
+    assert payee_totals() == []
+
+    assert PayeeTotal.refresh_incremental() == 2
+
+    assert payee_totals() == [("a", 2, Decimal("4.00")), ("b", 1, Decimal("10.00"))]
+
+    Payment.objects.filter(payee="a", amount=Decimal("1.50")).update(payee="c")
+    Payment.objects.filter(payee="b").update(amount=Decimal("20"))
+    Payment.objects.create(payee="a", amount=Decimal("1"))
+    # the deltas are only applied when refreshed
+    assert payee_totals() == [("a", 2, Decimal("4.00")), ("b", 1, Decimal("10.00"))]
+
+    assert PayeeTotal.refresh_incremental() == 3
+
+    assert payee_totals() == expected_payee_totals()
+
+
+def test_refresh_incremental_removes_empty_groups():
+    Payment.objects.create(payee="a", amount=Decimal("1"))
+    refresh_incremental(PayeeTotal)
+    Payment.objects.create(payee="b", amount=Decimal("1"))
+
+    Payment.objects.all().delete()
+    # b was added & removed since the last refresh
+    assert refresh_incremental(PayeeTotal) == 1
+
+    assert payee_totals() == []
+    assert refresh_incremental(PayeeTotal) == 0
+
+
+def test_refresh_incremental_truncate():
+    Payment.objects.create(payee="a", amount=Decimal("1"))
+    refresh_incremental(PayeeTotal)
+    Payment.objects.create(payee="b", amount=Decimal("1"))
+    with connection.cursor() as cursor:
+        cursor.execute("TRUNCATE db_views_payment")
+    Payment.objects.create(payee="c", amount=Decimal("1"))
+
+    refresh_incremental(PayeeTotal)
+
+    assert payee_totals() == [("c", 1, Decimal("1.00"))]
+
+
+def test_refresh_incremental_not_incremental():
+    with pytest.raises(TypeError):
+        refresh_incremental(ActiveAccount)
+    with pytest.raises(TypeError):
+        refresh_view(PayeeTotal)
+
+
+def test_refresh_incremental_null_sums():
+    Payment.objects.create(payee="a", amount=None)
+    refresh_incremental(PayeeTotal)
+
+    assert payee_totals() == [("a", 1, None)]
+
+    payment = Payment.objects.create(payee="a", amount=Decimal("5"))
+    refresh_incremental(PayeeTotal)
+
+    assert payee_totals() == [("a", 2, Decimal("5.00"))]
+
+    payment.delete()
+    Payment.objects.create(payee="b", amount=Decimal("1"))
+    Payment.objects.filter(payee="b").update(amount=None)
+    refresh_incremental(PayeeTotal)
+
+    # sums of no values are NULL, as with the view's query
+    assert payee_totals() == [("a", 1, None), ("b", 1, None)]
+    assert payee_totals() == expected_payee_totals()
+
+
+def test_incremental_query_must_be_grouped():
+    with pytest.raises(ValueError):
+        parse_query(ActiveAccount)
+
+
+@pytest.mark.parametrize(
+    "aggregates",
+    [
+        {"total": Max("amount")},
+        {"total": Min("amount")},
+        {"total": Avg("amount")},
+        {"total": Sum("amount") * 2},
+        {"payments": Count("amount", distinct=True)},
+    ],
+)
+def test_incremental_query_must_be_sums_and_counts(monkeypatch, aggregates):
+    monkeypatch.setattr(
+        PayeeTotal._meta,
+        "query",
+        Payment.objects.values("payee").annotate(
+            **{"payments": Count("*"), "total": Sum("amount"), **aggregates}
+        ),
+    )
+
+    with no_routing(), pytest.raises(ValueError):
+        parse_query(PayeeTotal)
+
+
+def test_incremental_query_must_not_filter_groups(monkeypatch):
+    monkeypatch.setattr(
+        PayeeTotal._meta,
+        "query",
+        Payment.objects.values("payee")
+        .annotate(payments=Count("*"), total=Sum("amount"))
+        .filter(total__gt=0),
+    )
+
+    with no_routing(), pytest.raises(ValueError):
+        parse_query(PayeeTotal)
+
+
+def test_incremental_query_filtered_aggregates(monkeypatch):
+    monkeypatch.setattr(
+        PayeeTotal._meta,
+        "query",
+        Payment.objects.values("payee").annotate(
+            payments=Count("pk", filter=Q(amount__gt=0)),
+            total=Sum("amount", filter=Q(amount__gt=0)),
+        ),
+    )
+
+    with no_routing():
+        match = parse_query(PayeeTotal)
+
+    assert sum_counts(match, ["payee"]) == {
+        "total": 'COUNT("db_views_payment"."amount") FILTER (WHERE "db_views_payment"."amount" > 0)'
+    }
+
+
+@benchmark
+def test_benchmark_refresh_incremental():
+    Payment.objects.bulk_create(
+        Payment(payee=str(i % 1_000), amount=Decimal(i % 100)) for i in range(500_000)
+    )
+    refresh_incremental(PayeeTotal)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE MATERIALIZED VIEW payee_total AS "
+            + mogrify_queryset(PayeeTotal._meta.query)
+        )
+
+    Payment.objects.filter(pk__lte=10).update(amount=Decimal(1))
+
+    print()
+    start = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute("REFRESH MATERIALIZED VIEW payee_total")
+    print(f"REFRESH MATERIALIZED VIEW {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    refresh_incremental(PayeeTotal)
+    print(f"refresh_incremental()     {time.perf_counter() - start:.3f}s")
+
+    assert payee_totals() == expected_payee_totals()
+
+
+def test_normalize_sql():
+    assert normalize_sql("""
+        SELECT  'a  b', "x  y"
+        FROM\tfoo WHERE name = 'it''s  '
+        """) == """SELECT 'a  b', "x  y" FROM foo WHERE name = 'it''s  '"""
+
+
+def detect_changes(to_state):
+    from_state = MigrationLoader(None, ignore_no_migrations=True).project_state()
+    return makemigrations.MigrationAutodetector(from_state, to_state)._detect_changes()
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    def ensure_connection():
+        raise OperationalError("offline")
+
+    monkeypatch.setattr(connection, "ensure_connection", ensure_connection)
+
+
+def test_view_defs_unchanged_offline(offline):
+    assert "db_views" not in detect_changes(ProjectState.from_apps(apps))
+
+
+def test_view_defs_changed(offline):
+    to_state = ProjectState.from_apps(apps)
+    to_state.models["db_views", "payeetotal"].options["query"] = Payment.objects.values(
+        "payee"
+    ).annotate(payments=Count("*"), total=Sum("amount") * 100)
+
+    [migration] = detect_changes(to_state)["db_views"]
+
+    [operation] = migration.operations
+    assert isinstance(operation, UpdateView)
+    assert operation.model_name == "payeetotal"
+    assert '(SUM("db_views_payment"."amount") * 100) AS "total"' in operation.query
+
+
+def test_query_hash_fallback():
+    queryset = Account.objects.annotate(
+        ids=Value([1, 2], output_field=ArrayField(IntegerField()))
+    )
+    # lists are rendered by psycopg's adapters
+    assert query_hash(queryset) is None
+
+    assert not queries_differ(mogrify_queryset(queryset), queryset)
+    assert queries_differ(mogrify_queryset(queryset), queryset.filter(pk=1))
+
+
+@pytest.fixture
+def payments(django_capture_on_commit_callbacks):
+    view_router.refreshes.clear()
+    Payment.objects.bulk_create(
+        [
+            Payment(payee="a", amount=Decimal("1")),
+            Payment(payee="a", amount=Decimal("2")),
+            Payment(payee="b", amount=Decimal("10")),
+        ]
+    )
+    with django_capture_on_commit_callbacks(execute=True):
+        PayeeTotal.refresh_incremental()
+    # not in the view until it's refreshed again
+    Payment.objects.create(payee="c", amount=Decimal("5"))
+    yield
+    view_router.refreshes.clear()
+
+
+def payee_totals_queryset():
+    return Payment.objects.values("payee").annotate(
+        payments=Count("*"), total=Sum("amount")
+    )
+
+
+def routed_sql(queryset):
+    with CaptureQueriesContext(connection) as queries:
+        result = list(queryset.all())
+    return result, queries[-1]["sql"]
+
+
+def test_route_reads(payments):
+    result, sql = routed_sql(payee_totals_queryset().order_by("payee"))
+
+    assert 'FROM "db_views_payeetotal"' in sql
+    assert result == [
+        {"payee": "a", "payments": 2, "total": Decimal("3")},
+        {"payee": "b", "payments": 1, "total": Decimal("10")},
+    ]
+
+    with no_routing():
+        result, sql = routed_sql(payee_totals_queryset().order_by("payee"))
+    assert 'FROM "db_views_payment"' in sql
+    assert len(result) == 3
+
+
+def test_route_reads_filtered(payments):
+    queryset = payee_totals_queryset()
+
+    assert routed_sql(queryset.filter(payee="a"))[0] == [
+        {"payee": "a", "payments": 2, "total": Decimal("3")}
+    ]
+    assert routed_sql(queryset.filter(total__gt=5).values_list("payee"))[0] == [("b",)]
+    result, sql = routed_sql(queryset.order_by("-total")[:1])
+    assert 'FROM "db_views_payeetotal"' in sql
+    assert result == [{"payee": "b", "payments": 1, "total": Decimal("10")}]
+    assert queryset.count() == 2
+
+
+def test_route_reads_not_matching(payments):
+    for queryset in [
+        # filters on columns that aren't in the view
+        payee_totals_queryset().filter(amount__gt=1),
+        # different aggregates
+        Payment.objects.values("payee").annotate(
+            payments=Count("*"), total=Avg("amount")
+        ),
+        Payment.objects.values("payee").annotate(payments=Count("*")),
+    ]:
+        assert 'FROM "db_views_payment"' in routed_sql(queryset)[1]
+
+
+def test_route_reads_stale(payments):
+    ViewRefresh.objects.filter(view="db_views_payeetotal").update(
+        refreshed_at=timezone.now() - timedelta(minutes=6)
+    )
+    view_router.refreshes.clear()
+
+    assert 'FROM "db_views_payment"' in routed_sql(payee_totals_queryset())[1]
+
+    ViewRefresh.objects.all().delete()
+    view_router.refreshes.clear()
+
+    assert 'FROM "db_views_payment"' in routed_sql(payee_totals_queryset())[1]
+
+
+def test_route_reads_in_transaction(payments):
+    with transaction.atomic():
+        Payment.objects.create(payee="a", amount=Decimal("4"))
+        result, sql = routed_sql(payee_totals_queryset().filter(payee="a"))
+
+    assert 'FROM "db_views_payment"' in sql
+    assert result == [{"payee": "a", "payments": 3, "total": Decimal("7")}]
+    assert 'FROM "db_views_payeetotal"' in routed_sql(payee_totals_queryset())[1]
+
+
+def test_route_reads_fetch_many(payments):
+    queryset = payee_totals_queryset().order_by("payee")
+
+    # the SQL isn't reused from a compilation that was routed differently
+    with transaction.atomic():
+        assert len(fetch_many(queryset)[0]) == 3
+    assert len(fetch_many(queryset)[0]) == 2
+    with transaction.atomic():
+        assert len(fetch_many(queryset)[0]) == 3
+
+
+def test_route_reads_view_definition(payments):
+    # the view's own query can't be routed to itself
+    assert 'FROM "db_views_payment"' in mogrify_queryset(PayeeTotal._meta.query)
+
+
+@benchmark
+def test_benchmark_route_reads(django_capture_on_commit_callbacks):
+    view_router.refreshes.clear()
+    Payment.objects.bulk_create(
+        Payment(payee=str(i % 1_000), amount=Decimal(i % 100)) for i in range(500_000)
+    )
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_incremental(PayeeTotal)
+    queryset = payee_totals_queryset().filter(payee="1")
+    number = 100
+
+    print()
+    start = time.perf_counter()
+    with no_routing():
+        for _ in range(number):
+            expected = list(queryset.all())
+    print(f"Payment    {(time.perf_counter() - start) / number * 1000:.3f}ms")
+
+    start = time.perf_counter()
+    for _ in range(number):
+        result = list(queryset.all())
+    print(f"PayeeTotal {(time.perf_counter() - start) / number * 1000:.3f}ms")
+
+    assert result == expected
+    view_router.refreshes.clear()
+
+
+@benchmark
+def test_benchmark_view_diffing():
+    from_state = MigrationLoader(None, ignore_no_migrations=True).project_state()
+    views = [
+        (
+            from_state.models["db_views", model._meta.model_name].options["query"],
+            model._meta.query,
+        )
+        for model in [ActiveAccount, ActiveAccountCount, PayeeTotal]
+    ]
+    number = 1_000
+
+    print()
+    start = time.perf_counter()
+    for _ in range(number):
+        for old_query, new_query in views:
+            assert old_query == mogrify_queryset(new_query)
+    print(f"mogrify x3        {(time.perf_counter() - start) / number * 1000:.3f}ms")
+
+    start = time.perf_counter()
+    for _ in range(number):
+        for old_query, new_query in views:
+            assert not queries_differ(old_query, new_query)
+    print(f"queries_differ x3 {(time.perf_counter() - start) / number * 1000:.3f}ms")
@@ -1,38 +1,52 @@
-from django.core.exceptions import EmptyResultSet
-from django.db import connection, models
+from django.core.exceptions import EmptyResultSet, FieldError
+from django.db import models
 from django.db.models.sql import DeleteQuery, Query, UpdateQuery
 from django.db.models.sql.where import WhereNode
 
+from mogrify_queryset.cache import query_templates
+
 
 def mogrify_queryset(qs, query_class=None, **kwargs):
     query = qs.query
     if query_class:
         query = query.chain(query_class)
-    with connection.cursor() as cur:
-        try:
-            return cur.mogrify(*query.sql_with_params())
-
-        except EmptyResultSet:
-            # An EmptyResultSet means a filter was declared that's a logical contradiction
-            # (ie that will never be true), for eg foo__in=[]
-            #
-            # We still need a query with a compatible select clause; in order to do
-            # that we can clear the where clause and add "limit 0"
-            # It's not ideal as it doesn't show the originally requested where clause
-            # (ie if required for debugging purposes) but it functions equivalently
-            # if required to execute by itself or interpolated in a larger query.
-
-            query = query.clone()
-            query.where = WhereNode()
-            return cur.mogrify(*query.sql_with_params()) + " LIMIT 0"
+    try:
+        return query_templates.mogrify(query)
+    except EmptyResultSet:
+        # An EmptyResultSet means a filter was declared that's a logical contradiction
+        # (ie that will never be true), for eg foo__in=[]
+        #
+        # We still need a query with a compatible select clause; in order to do
+        # that we can clear the where clause and add "limit 0"
+        # It's not ideal as it doesn't show the originally requested where clause
+        # (ie if required for debugging purposes) but it functions equivalently
+        # if required to execute by itself or interpolated in a larger query.
+
+        query = query.clone()
+        query.where = WhereNode()
+        return query_templates.mogrify(query) + " LIMIT 0"
 
 
 def delete(queryset):
-    pass
-
-
-def update(queryset):
-    pass
+    """
+    A DeleteQuery for the queryset, to be executed later with execute_delayed(). As with QuerySet._raw_delete() there
+    are no signals & no cascading in Python.
+    """
+    return queryset.query.chain(DeleteQuery)
+
+
+def update(queryset, **kwargs):
+    """
+    An UpdateQuery for the queryset, to be executed later with execute_delayed(). Only fields on the queryset's model
+    can be updated.
+    """
+    if not kwargs:
+        raise ValueError("No fields to update")
+    query = queryset.query.chain(UpdateQuery)
+    query.add_update_values(kwargs)
+    if query.related_updates:
+        raise FieldError("Only fields on the queryset's model can be updated")
+    return query
 
 
 class DerpUpdate(UpdateQuery):
@@ -49,12 +63,10 @@ class Derp(Query):
 
 class ProductQuerySet(models.QuerySet):
     def delete_query(self):
-        return self.query.chain(DeleteQuery)
+        return delete(self)
 
     def update_query(self, **kwargs):
-        query = self.query.chain(UpdateQuery)
-        query.add_update_values(kwargs)
-        return query
+        return update(self, **kwargs)
 
 
 class Product(models.Model):
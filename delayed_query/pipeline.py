@@ -0,0 +1,126 @@
+import time
+
+from django.core.exceptions import EmptyResultSet
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from mogrify_queryset.cache import query_templates
+from mogrify_queryset.literals import mogrify
+
+
+def log_queries(connection, statements, duration):
+    # The statements run together so each is logged with the time for all of them
+    if connection.queries_logged:
+        for statement in statements:
+            if statement is not None:
+                connection.queries_log.append(
+                    {"sql": mogrify(*statement), "time": f"{duration:.3f}"}
+                )
+
+
+def execute_pipeline(statements, using=DEFAULT_DB_ALIAS):
+    """
+    Execute (sql, params) statements in one round trip with psycopg's pipeline mode & return their cursors. None
+    statements are skipped & have a None cursor.
+    """
+    connection = connections[using]
+    connection.ensure_connection()
+    cursors = []
+    start = time.monotonic()
+    with connection.wrap_database_errors:
+        with connection.connection.pipeline():
+            for statement in statements:
+                if statement is None:
+                    cursors.append(None)
+                    continue
+                cursor = connection.create_cursor()
+                cursor.execute(*statement)
+                cursors.append(cursor)
+    log_queries(connection, statements, time.monotonic() - start)
+    return cursors
+
+
+def compile_statement(query, using):
+    try:
+        return query_templates.sql_with_params(query, using)
+    except EmptyResultSet:
+        return None
+
+
+def execute_delayed(queries, using=DEFAULT_DB_ALIAS):
+    """
+    Execute delayed UpdateQuery & DeleteQuery objects in one round trip, in a transaction, returning the number of rows
+    affected by each.
+    """
+    statements = [compile_statement(query, using) for query in queries]
+    with transaction.atomic(using=using, savepoint=False):
+        cursors = execute_pipeline(statements, using)
+    return [0 if cursor is None else cursor.rowcount for cursor in cursors]
+
+
+def fetch_many(*querysets):
+    """
+    Evaluate querysets in one round trip, returning a list of the results of each - model instances, values() dicts,
+    etc, as iterating each would. Prefetches are done afterwards, as usual.
+    """
+    using = {queryset.db for queryset in querysets}
+    if len(using) > 1:
+        raise ValueError("Querysets must use the same database")
+    using = using.pop() if using else DEFAULT_DB_ALIAS
+
+    querysets = [queryset._chain() for queryset in querysets]
+    statements = [compile_statement(queryset.query, using) for queryset in querysets]
+    cursors = execute_pipeline(statements, using)
+
+    results = []
+    for queryset, cursor in zip(querysets, cursors):
+        rows = [] if cursor is None else cursor.fetchall()
+        fetched(queryset.query, using, rows)
+        queryset._fetch_all()
+        results.append(queryset._result_cache)
+    return results
+
+
+def fetched(query, using, rows):
+    """
+    Have the query's compiler return rows rather than executing the query, so that the queryset's iterable builds its
+    results from them.
+    """
+    compiler = query.get_compiler(using)
+    compiler.pre_sql_setup()
+    if compiler.has_extra_select:
+        rows = [row[: compiler.col_count] for row in rows]
+    compiler.execute_sql = lambda *args, **kwargs: [rows]
+    query.get_compiler = lambda *args, **kwargs: compiler
+
+
+class DelayedQueries:
+    """
+    Collect delayed queries & execute them together:
+
+        with DelayedQueries() as delayed:
+            for product, name in renames:
+                delayed.add(update(Product.objects.filter(pk=product.pk), name=name))
+        delayed.rowcounts
+
+    Queries are executed on exit unless there was an exception.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.queries = []
+        self.rowcounts = None
+
+    def add(self, query):
+        self.queries.append(query)
+
+    def execute(self):
+        self.rowcounts = execute_delayed(self.queries, self.using)
+        self.queries = []
+        return self.rowcounts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
@@ -1,10 +1,22 @@
+import os
+import time
+
 import pytest
-from django.db.models import sql
+from django.contrib.auth.models import Group, Permission
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Value, sql
+from django.db.models.functions import Concat
+from django.test.utils import CaptureQueriesContext
 
-from .models import Product, mogrify_queryset
+from .models import Product, delete, mogrify_queryset, update
+from .pipeline import DelayedQueries, execute_delayed, fetch_many
 
 pytestmark = pytest.mark.django_db
 
+benchmark = pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks"
+)
+
 
 def UpdateQueryWith(**kwargs):
     class UpdateQuery(sql.UpdateQuery):
@@ -45,3 +57,161 @@ def test_update_query():
     print()
     print(Product.objects.filter(name="Foo").update_query(name="Bar"))
     print()
+
+
+def test_execute_delayed():
+    Product.objects.bulk_create(Product(name=name) for name in ["Foo", "Bar", "Baz"])
+
+    with CaptureQueriesContext(connection) as queries:
+        rowcounts = execute_delayed(
+            [
+                update(
+                    Product.objects.filter(name__startswith="B"),
+                    name=Concat(F("name"), Value("!")),
+                ),
+                delete(Product.objects.filter(name="Foo")),
+                Product.objects.filter(name="Qux").update_query(name="Quux"),
+                delete(Product.objects.filter(pk__in=[])),
+            ]
+        )
+
+    assert rowcounts == [2, 1, 0, 0]
+    assert sorted(Product.objects.values_list("name", flat=True)) == ["Bar!", "Baz!"]
+    # the empty delete isn't executed
+    assert [query["sql"] for query in queries] == [
+        """UPDATE "delayed_query_product" SET "name" = (COALESCE("delayed_query_product"."name", '') || COALESCE('!', '')) WHERE "delayed_query_product"."name"::text LIKE 'B%'""",
+        """DELETE FROM "delayed_query_product" WHERE "delayed_query_product"."name" = 'Foo'""",
+        """UPDATE "delayed_query_product" SET "name" = 'Quux' WHERE "delayed_query_product"."name" = 'Qux'""",
+    ]
+
+
+def test_execute_delayed_error_rolls_back():
+    Product.objects.create(name="Foo")
+
+    with pytest.raises(IntegrityError), transaction.atomic():
+        execute_delayed(
+            [
+                update(Product.objects.all(), name="Bar"),
+                update(Product.objects.all(), name=None),
+            ]
+        )
+
+    assert list(Product.objects.values_list("name", flat=True)) == ["Foo"]
+
+
+def test_update_without_fields():
+    with pytest.raises(ValueError, match="No fields to update"):
+        update(Product.objects.all())
+
+
+def test_delayed_queries():
+    products = Product.objects.bulk_create(Product(name=f"{i}") for i in range(10))
+
+    with DelayedQueries() as delayed:
+        for product in products:
+            delayed.add(
+                update(Product.objects.filter(pk=product.pk), name=f"#{product.name}")
+            )
+
+    assert delayed.rowcounts == [1] * 10
+    assert delayed.queries == []
+    assert sorted(Product.objects.values_list("name", flat=True)) == [
+        f"#{i}" for i in range(10)
+    ]
+
+
+def test_fetch_many():
+    foo, bar, baz = Product.objects.bulk_create(
+        Product(name=name) for name in ["Foo", "Bar", "Baz"]
+    )
+
+    with CaptureQueriesContext(connection) as queries:
+        products, names, counts, nothing, distinct = fetch_many(
+            Product.objects.order_by("name"),
+            Product.objects.filter(name__startswith="B").values_list("name", flat=True),
+            Product.objects.values("name").annotate(n=Count("*")).order_by("-name"),
+            Product.objects.filter(pk__in=[]),
+            Product.objects.order_by(F("name").desc()).distinct().values("pk")[:2],
+        )
+
+    assert len(queries) == 4
+    assert products == [bar, baz, foo]
+    assert sorted(names) == ["Bar", "Baz"]
+    assert counts == [
+        {"name": "Foo", "n": 1},
+        {"name": "Baz", "n": 1},
+        {"name": "Bar", "n": 1},
+    ]
+    assert nothing == []
+    assert distinct == [{"pk": foo.pk}, {"pk": baz.pk}]
+
+
+def test_fetch_many_related():
+    group = Group.objects.create(name="Group")
+    group.permissions.set(Permission.objects.all()[:2])
+
+    content_types = [
+        p.content_type
+        for p in Permission.objects.select_related("content_type").order_by("pk")[:2]
+    ]
+
+    permissions, groups = fetch_many(
+        Permission.objects.select_related("content_type").order_by("pk")[:2],
+        Group.objects.prefetch_related("permissions"),
+    )
+
+    with CaptureQueriesContext(connection) as queries:
+        assert [p.content_type for p in permissions] == content_types
+        assert len(groups[0].permissions.all()) == 2
+    assert len(queries) == 0
+
+
+def test_fetch_many_queryset_unchanged():
+    Product.objects.create(name="Foo")
+    queryset = Product.objects.all()
+
+    fetch_many(queryset)
+
+    assert queryset._result_cache is None
+    with CaptureQueriesContext(connection) as queries:
+        assert len(queryset) == 1
+    assert len(queries) == 1
+
+
+@benchmark
+def test_benchmark_execute_delayed():
+    products = Product.objects.bulk_create(Product(name=f"{i}") for i in range(500))
+
+    print()
+    start = time.perf_counter()
+    for product in products:
+        Product.objects.filter(pk=product.pk).update(name=f"#{product.name}")
+    print(f"update() x500         {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    execute_delayed(
+        update(Product.objects.filter(pk=product.pk), name=f"##{product.name}")
+        for product in products
+    )
+    print(f"execute_delayed() x500 {time.perf_counter() - start:.3f}s")
+
+
+@benchmark
+def test_benchmark_fetch_many():
+    Product.objects.bulk_create(Product(name=f"{i}") for i in range(100))
+
+    def querysets():
+        return [Product.objects.filter(name__startswith=f"{i}") for i in range(8)]
+
+    number = 1_000
+    print()
+    start = time.perf_counter()
+    for _ in range(number):
+        for queryset in querysets():
+            list(queryset)
+    print(f"8 querysets      {(time.perf_counter() - start) / number * 1000:.2f}ms")
+
+    start = time.perf_counter()
+    for _ in range(number):
+        fetch_many(*querysets())
+    print(f"fetch_many()     {(time.perf_counter() - start) / number * 1000:.2f}ms")
@@ -0,0 +1,154 @@
+import contextvars
+import io
+import pickle
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.exceptions import FullResultSet
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Field
+from django.utils import timezone
+
+from .literals import mogrify
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+# Cached for shapes that can't be templated so that they aren't checked again
+UNCACHEABLE = object()
+
+# set while a query's template is compiled, see uncacheable()
+_compiling = contextvars.ContextVar("mogrify_queryset_compiling", default=None)
+
+
+def uncacheable():
+    """
+    Don't cache the template of the query being compiled, for compilers whose SQL depends on more than the query.
+    """
+    compiling = _compiling.get()
+    if compiling is not None:
+        compiling.append(True)
+
+
+class ShapePickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # Unbound fields, eg Cast("x", IntegerField()), pickle their creation counter - new instances with the same
+        # arguments must have the same shape
+        if isinstance(obj, Field) and not hasattr(obj, "model"):
+            _, path, args, kwargs = obj.deconstruct()
+            return Field, (), (path, args, kwargs)
+        return NotImplemented
+
+
+class QueryTemplateCache:
+    """
+    An LRU cache of compiled SQL, keyed on the shape of a Query.
+
+    The shape is everything but the WHERE clause: the query is pickled without it. The WHERE clause is compiled each
+    time, it's where params usually change & compiling it on its own is a fraction of compiling the whole query - joins,
+    selected columns, ordering, etc, are only compiled on a miss. Its SQL is part of the key as eg __in lookups have a
+    placeholder per value.
+
+    Params outside of the WHERE clause can also depend on the context the query is compiled in, eg TruncDay() has the
+    current time zone as a param, so that context is part of the key too.
+
+    The template is the full SQL with the params before & after the WHERE clause. Anything else that has params, eg an
+    annotation with Value(), is part of the shape & so the params can be reused. Queries where the WHERE clause doesn't
+    appear verbatim in the SQL, eg the compiler rewrites it for an update with joins, aren't cached, nor are queries whose
+    compiler called uncacheable().
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def shape(self, query):
+        state = query.__dict__.copy()
+        del state["where"]
+        buffer = io.BytesIO()
+        try:
+            ShapePickler(buffer, pickle.HIGHEST_PROTOCOL).dump((type(query), state))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        return buffer.getvalue()
+
+    def context(self):
+        return timezone.get_current_timezone_name() if settings.USE_TZ else None
+
+    def sql_with_params(self, query, using=DEFAULT_DB_ALIAS):
+        """
+        As query.sql_with_params() but only the WHERE clause is compiled if the query's shape has been seen before.
+        Raises EmptyResultSet as query.sql_with_params() does.
+        """
+        shape = self.shape(query)
+        if shape is None:
+            with self.lock:
+                self.misses += 1
+            return query.get_compiler(using).as_sql()
+
+        try:
+            where, where_params = query.get_compiler(using).compile(query.where)
+        except FullResultSet:
+            where, where_params = "", ()
+        key = (using, shape, where, self.context())
+
+        with self.lock:
+            template = self.templates.get(key)
+            if template is not None:
+                self.templates.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if template is UNCACHEABLE:
+            return query.get_compiler(using).as_sql()
+        if template is not None:
+            sql, before, after = template
+            return sql, (*before, *where_params, *after)
+
+        compiling = []
+        token = _compiling.set(compiling)
+        try:
+            sql, params = query.get_compiler(using).as_sql()
+        finally:
+            _compiling.reset(token)
+        if compiling:
+            template = UNCACHEABLE
+        else:
+            template = self.template(sql, params, where, where_params)
+        with self.lock:
+            self.templates[key] = template
+            if len(self.templates) > self.maxsize:
+                self.templates.popitem(last=False)
+        return sql, params
+
+    def template(self, sql, params, where, where_params):
+        if not where:
+            return sql, tuple(params), ()
+        where = f"WHERE {where}"
+        if sql.count(where) != 1:
+            return UNCACHEABLE
+        # the number of params before the WHERE clause, %% is an escaped %
+        start = sql[: sql.index(where)].replace("%%", "").count("%s")
+        end = start + len(where_params)
+        if tuple(params[start:end]) != tuple(where_params):
+            return UNCACHEABLE
+        return sql, tuple(params[:start]), tuple(params[end:])
+
+    def mogrify(self, query, using=DEFAULT_DB_ALIAS):
+        return mogrify(*self.sql_with_params(query, using), using=using)
+
+    def cache_info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.templates))
+
+    def cache_clear(self):
+        with self.lock:
+            self.templates.clear()
+            self.hits = self.misses = 0
+
+
+query_templates = QueryTemplateCache()
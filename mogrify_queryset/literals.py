@@ -0,0 +1,112 @@
+"""
+Render params as SQL literals without a connection, the same as psycopg's ClientCursor does with the default adapters.
+"""
+
+import math
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from uuid import UUID
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from psycopg.adapt import Transformer
+
+
+def _number(value):
+    # a space stops a negative number following a - becoming a comment
+    return f" {value}" if value < 0 else str(value)
+
+
+def _float(value):
+    if math.isnan(value):
+        return "'NaN'::float8"
+    if math.isinf(value):
+        return "'Infinity'::float8" if value > 0 else "'-Infinity'::float8"
+    return _number(value)
+
+
+def _decimal(value):
+    if value.is_nan():
+        return "'NaN'::numeric"
+    if value.is_infinite():
+        return "'Infinity'::numeric" if value > 0 else "'-Infinity'::numeric"
+    return _number(value)
+
+
+def _str(value):
+    if "\0" in value:
+        return None
+    quoted = value.replace("'", "''")
+    if "\\" in value:
+        return " E'" + quoted.replace("\\", "\\\\") + "'"
+    return f"'{quoted}'"
+
+
+def _bytes(value):
+    return f"'\\x{bytes(value).hex()}'::bytea"
+
+
+def _datetime(value):
+    cast = "timestamp" if value.tzinfo is None else "timestamptz"
+    return f"'{value.isoformat(' ')}'::{cast}"
+
+
+def _time(value):
+    cast = "time" if value.tzinfo is None else "timetz"
+    return f"'{value.isoformat()}'::{cast}"
+
+
+LITERALS = {
+    type(None): lambda value: "NULL",
+    bool: lambda value: "true" if value else "false",
+    int: _number,
+    float: _float,
+    Decimal: _decimal,
+    str: _str,
+    bytes: _bytes,
+    bytearray: _bytes,
+    memoryview: _bytes,
+    date: lambda value: f"'{value.isoformat()}'::date",
+    datetime: _datetime,
+    time: _time,
+    timedelta: lambda value: f"'{str(value).replace(',', '')}'::interval",
+    UUID: lambda value: f"'{value.hex}'::uuid",
+}
+
+# Subclasses are looked up by their MRO, as psycopg does
+_literals = {}
+
+
+def _literal_function(cls):
+    if cls not in _literals:
+        _literals[cls] = next(
+            (LITERALS[base] for base in cls.__mro__ if base in LITERALS), None
+        )
+    return _literals[cls]
+
+
+def literal(value):
+    """
+    The SQL literal for value, or None if it's not a type Django emits for the builtin fields, eg lists, Jsonb.
+    """
+    function = _literal_function(type(value))
+    if function is None:
+        return None
+    return function(value)
+
+
+def mogrify(sql, params, using=DEFAULT_DB_ALIAS):
+    """
+    cursor.mogrify() without a cursor. Params that literal() can't render fall back to the connection's adapters.
+    """
+    transformer = None
+    literals = []
+    for param in params:
+        rendered = literal(param)
+        if rendered is None:
+            if transformer is None:
+                connection = connections[using]
+                connection.ensure_connection()
+                transformer = Transformer.from_context(connection.connection)
+            rendered = transformer.as_literal(param).decode()
+        literals.append(rendered)
+    return sql % tuple(literals)
@@ -1,30 +1,30 @@
 from django.core.exceptions import EmptyResultSet
-from django.db import connection, models
+from django.db import models
 from django.db.models import sql
 from django.db.models.sql.where import WhereNode
 
+from .cache import query_templates
+
 
 def mogrify_queryset(qs, query_class=None):
     query = qs.query
     if query_class:
         query = query.chain(query_class)
-    with connection.cursor() as cur:
-        try:
-            return cur.mogrify(*query.sql_with_params())
-
-        except EmptyResultSet:
-            # An EmptyResultSet means a filter was declared that's a logical contradiction
-            # (ie that will never be true), for eg foo__in=[]
-            #
-            # We still need a query with a compatible select clause; in order to do
-            # that we can clear the where clause and add "limit 0"
-            # It's not ideal as it doesn't show the originally requested where clause
-            # (ie if required for debugging purposes) but it functions equivalently
-            # if required to execute by itself or interpolated in a larger query.
-
-            query = query.clone()
-            query.where = WhereNode()
-            return cur.mogrify(*query.sql_with_params()) + " LIMIT 0"
+    try:
+        return query_templates.mogrify(query)
+    except EmptyResultSet:
+        # An EmptyResultSet means a filter was declared that's a logical contradiction
+        # (ie that will never be true), for eg foo__in=[]
+        #
+        # We still need a query with a compatible select clause; in order to do
+        # that we can clear the where clause and add "limit 0"
+        # It's not ideal as it doesn't show the originally requested where clause
+        # (ie if required for debugging purposes) but it functions equivalently
+        # if required to execute by itself or interpolated in a larger query.
+
+        query = query.clone()
+        query.where = WhereNode()
+        return query_templates.mogrify(query) + " LIMIT 0"
 
 
 def UpdateQueryWith(**kwargs):
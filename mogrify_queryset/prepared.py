@@ -0,0 +1,205 @@
+"""
+Explicitly PREPAREd querysets.
+
+Django's psycopg backend binds params client side so psycopg's automatic preparation never kicks in, and when it does
+it's keyed on the exact SQL with thresholds that can't be set per query. prepare(queryset) has the SQL compiled as
+usual but PREPAREd once per connection & run with EXECUTE.
+"""
+
+import functools
+import hashlib
+import re
+import threading
+import weakref
+from collections import OrderedDict
+
+from django.db import DatabaseError, transaction
+from django.db.models.signals import post_migrate
+from django.db.models.sql import Query
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE, MULTI
+from psycopg.errors import (
+    DuplicatePreparedStatement,
+    FeatureNotSupported,
+    InvalidSqlStatementName,
+)
+
+# PREPARE uses $1, $2, etc rather than %s
+PLACEHOLDER_RE = re.compile(r"%([%s])")
+
+# a prepared statement's result types changed since it was prepared, eg by a migration
+CHANGED_RESULT_TYPE = "cached plan must not change result type"
+
+
+def numbered_placeholders(sql):
+    count = 0
+
+    def replace(match):
+        nonlocal count
+        if match[1] == "%":
+            return "%"
+        count += 1
+        return f"${count}"
+
+    return PLACEHOLDER_RE.sub(replace, sql)
+
+
+class PreparedStatements:
+    """
+    The statements prepared on each connection, keyed on their SQL, & evicted in LRU order after maxsize.
+
+    Migrations may change the result types of prepared statements, which Postgres can't replan. post_migrate starts a
+    new generation in the process that migrated: each connection deallocates everything before preparing again. Other
+    processes only find out when executing fails, then that connection is expired the same way.
+    """
+
+    maxsize = 100
+
+    def __init__(self):
+        # psycopg connections - a new connection is a new session
+        self.connections = weakref.WeakKeyDictionary()
+        self.generation = 0
+        self.lock = threading.Lock()
+        post_migrate.connect(self.invalidate)
+
+    def invalidate(self, **kwargs):
+        with self.lock:
+            self.generation += 1
+
+    def forget(self, connection):
+        self.connections.pop(connection.connection, None)
+
+    def expire(self, connection):
+        """
+        Deallocate everything on the connection before the next statement is prepared.
+        """
+        _, statements = self.connections.get(connection.connection, (None, None))
+        if statements:
+            self.connections[connection.connection] = (None, statements)
+
+    def statements(self, connection):
+        generation, statements = self.connections.get(
+            connection.connection, (None, None)
+        )
+        if generation != self.generation:
+            if statements:
+                with connection.cursor() as cursor:
+                    cursor.execute("DEALLOCATE ALL")
+            statements = OrderedDict()
+            self.connections[connection.connection] = (self.generation, statements)
+        return statements
+
+    def name(self, sql):
+        digest = hashlib.sha1(sql.encode(), usedforsecurity=False).hexdigest()
+        return f"django_{digest[:16]}"
+
+    def prepare(self, connection, sql):
+        """
+        Return the name of the statement for sql, PREPAREing it if needed, or None if it can't be prepared - eg the type
+        of a param can't be inferred.
+        """
+        # statements are tracked per psycopg connection, queries are compiled before the cursor opens it
+        connection.ensure_connection()
+        statements = self.statements(connection)
+        if sql in statements:
+            statements.move_to_end(sql)
+            return statements[sql]
+
+        name = self.name(sql)
+        try:
+            # in a transaction a failed PREPARE would abort it, the savepoint is only needed then
+            with transaction.atomic(using=connection.alias):
+                with connection.cursor() as cursor:
+                    cursor.execute(f"PREPARE {name} AS {numbered_placeholders(sql)}")
+        except DatabaseError as e:
+            # already prepared, eg after being forgotten when another statement was deallocated
+            if not isinstance(e.__cause__, DuplicatePreparedStatement):
+                name = None
+        statements[sql] = name
+
+        if len(statements) > self.maxsize:
+            _, evicted = statements.popitem(last=False)
+            if evicted is not None:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DEALLOCATE {evicted}")
+        return name
+
+
+prepared_statements = PreparedStatements()
+
+
+class PreparedCompilerMixin:
+    executing = False
+
+    def execute_sql(
+        self, result_type=MULTI, chunked_fetch=False, chunk_size=GET_ITERATOR_CHUNK_SIZE
+    ):
+        # Subqueries are compiled with as_sql() too, only the query being executed is prepared. iterator() DECLAREs a
+        # server side cursor for the query, which can't be an EXECUTE.
+        self.executing = not chunked_fetch
+        try:
+            return super().execute_sql(result_type, chunked_fetch, chunk_size)
+        except DatabaseError as e:
+            if isinstance(e.__cause__, InvalidSqlStatementName):
+                # eg DISCARD ALL by a connection pooler
+                prepared_statements.forget(self.connection)
+            elif isinstance(e.__cause__, FeatureNotSupported) and (
+                CHANGED_RESULT_TYPE in str(e.__cause__)
+            ):
+                # migrated by another process
+                prepared_statements.expire(self.connection)
+            else:
+                raise
+            # prepare again unless the transaction has already been aborted
+            if self.connection.in_atomic_block:
+                raise
+            return super().execute_sql(result_type, chunked_fetch, chunk_size)
+        finally:
+            self.executing = False
+
+    def as_sql(self, *args, **kwargs):
+        sql, params = super().as_sql(*args, **kwargs)
+        if not self.executing:
+            return sql, params
+        name = prepared_statements.prepare(self.connection, sql)
+        if name is None:
+            return sql, params
+        if not params:
+            return f"EXECUTE {name}", params
+        return f"EXECUTE {name}({', '.join(['%s'] * len(params))})", params
+
+
+@functools.cache
+def prepared_compiler(compiler_class):
+    return type(
+        f"Prepared{compiler_class.__name__}",
+        (PreparedCompilerMixin, compiler_class),
+        {},
+    )
+
+
+class PreparedQuery(Query):
+    def get_compiler(self, using=None, connection=None, elide_empty=True):
+        compiler = super().get_compiler(using, connection, elide_empty)
+        compiler.__class__ = prepared_compiler(type(compiler))
+        return compiler
+
+
+def prepare(queryset):
+    """
+    A clone of queryset that's executed as a prepared statement.
+    """
+    queryset = queryset._chain()
+    queryset.query = queryset.query.chain(PreparedQuery)
+    return queryset
+
+
+def prepared(method):
+    """
+    Prepare the queryset returned by a manager or queryset method.
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return prepare(method(*args, **kwargs))
+
+    return wrapper
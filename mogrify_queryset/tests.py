@@ -1,10 +1,49 @@
+import os
+import timeit
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+from uuid import UUID
+from zoneinfo import ZoneInfo
+
 import pytest
-from django.db.models.sql import DeleteQuery
+from django.db import connection
+from django.db.models import (
+    CharField,
+    DateTimeField,
+    F,
+    IntegerField,
+    OuterRef,
+    QuerySet,
+    Value,
+)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast, Concat, Length, TruncDay, Upper
+from django.db.models.sql import DeleteQuery, UpdateQuery
+from django.test.utils import CaptureQueriesContext
+from django.utils.safestring import SafeString
+from django.utils.timezone import override
+from psycopg.adapt import Transformer
 
+from .cache import QueryTemplateCache
+from .literals import literal, mogrify
 from .models import Product, UpdateQueryWith, mogrify_queryset
+from .prepared import prepare, prepared, prepared_statements
 
 pytestmark = pytest.mark.django_db
 
+benchmark = pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks"
+)
+
+
+def cursor_mogrify_sql(sql, params):
+    with connection.cursor() as cursor:
+        return cursor.mogrify(sql, params)
+
+
+def cursor_mogrify(queryset):
+    return cursor_mogrify_sql(*queryset.query.sql_with_params())
+
 
 def test_delete_query():
     assert (
@@ -24,3 +63,442 @@ def test_update_query():
 UPDATE "mogrify_queryset_product" SET "name" = 'Bar' WHERE "mogrify_queryset_product"."name" = 'Foo'\
 """
     )
+
+
+def test_empty_result_set():
+    assert mogrify_queryset(Product.objects.filter(name__in=[])) == """\
+SELECT "mogrify_queryset_product"."id", "mogrify_queryset_product"."name" FROM "mogrify_queryset_product" LIMIT 0\
+"""
+
+
+LITERAL_VALUES = [
+    None,
+    True,
+    False,
+    0,
+    -5,
+    2**70,
+    1.5,
+    -1.5,
+    1e100,
+    float("nan"),
+    float("inf"),
+    float("-inf"),
+    Decimal("1.50"),
+    Decimal("-0.5"),
+    Decimal("NaN"),
+    Decimal("-Infinity"),
+    "",
+    "it's",
+    "C:\\it's",
+    SafeString("safe"),
+    b"\x00\xff",
+    bytearray(b"x"),
+    memoryview(b"y"),
+    date(2024, 2, 29),
+    datetime(2024, 2, 29, 1, 2, 3, 4),
+    datetime(2024, 2, 29, 1, 2, 3, tzinfo=timezone.utc),
+    datetime(2024, 2, 29, 1, 2, 3, tzinfo=ZoneInfo("Australia/Melbourne")),
+    time(1, 2, 3),
+    time(1, 2, 3, 4, tzinfo=timezone.utc),
+    timedelta(days=1, seconds=5, microseconds=3),
+    timedelta(days=-1),
+    timedelta(0),
+    UUID(int=5),
+]
+
+
+@pytest.mark.parametrize("value", LITERAL_VALUES)
+def test_literal(value):
+    connection.ensure_connection()
+    transformer = Transformer.from_context(connection.connection)
+
+    assert literal(value) == transformer.as_literal(value).decode()
+
+
+def test_literal_unknown_type():
+    assert literal([1, 2]) is None
+    assert literal("\0") is None
+
+
+def test_mogrify():
+    assert mogrify("SELECT %s, %s, '%%'", ["it's", None]) == "SELECT 'it''s', NULL, '%'"
+
+
+def test_query_template_cache():
+    cache = QueryTemplateCache()
+
+    for name in ["Foo", "Bar", "it's"]:
+        queryset = Product.objects.filter(name=name).order_by("name")
+        assert cache.mogrify(queryset.query) == cursor_mogrify(queryset)
+
+    assert cache.cache_info() == (2, 1, 256, 1)
+
+
+def test_query_template_cache_params_around_where():
+    cache = QueryTemplateCache()
+
+    for name in ["Foo", "Bar"]:
+        queryset = (
+            Product.objects.annotate(label=Concat("name", Value("!")))
+            .filter(name=name)
+            .order_by(Length(Concat("name", Value("?"))))
+        )
+        assert cache.mogrify(queryset.query) == cursor_mogrify(queryset)
+
+    assert cache.cache_info().hits == 1
+
+
+def test_query_template_cache_in_lookup():
+    cache = QueryTemplateCache()
+
+    for names in [["Foo"], ["Foo", "Bar"], ["Bar", "Baz"]]:
+        queryset = Product.objects.filter(name__in=names)
+        assert cache.mogrify(queryset.query) == cursor_mogrify(queryset)
+
+    # a template per number of placeholders
+    assert cache.cache_info() == (1, 2, 256, 2)
+
+
+def test_query_template_cache_shape():
+    cache = QueryTemplateCache()
+
+    # new instances of unbound fields have the same shape
+    cache.mogrify(Product.objects.annotate(n=Cast("name", IntegerField())).query)
+    cache.mogrify(Product.objects.annotate(n=Cast("name", IntegerField())).query)
+    assert cache.cache_info().hits == 1
+
+    # anything outside the WHERE clause is part of the shape
+    queryset = Product.objects.annotate(label=Value("Bar"))
+    cache.mogrify(queryset.query)
+    assert cache.mogrify(queryset.annotate(label=Value("Baz")).query) == (
+        cursor_mogrify(queryset.annotate(label=Value("Baz")))
+    )
+    assert cache.mogrify(Product.objects.order_by(Upper("name")).query) == (
+        cursor_mogrify(Product.objects.order_by(Upper("name")))
+    )
+    assert cache.cache_info().hits == 1
+
+
+def test_query_template_cache_time_zone():
+    cache = QueryTemplateCache()
+
+    # TruncDay() has the current time zone as a param outside of the WHERE clause
+    for time_zone in ["UTC", "Asia/Hong_Kong", "UTC", "Asia/Hong_Kong"]:
+        with override(time_zone):
+            queryset = Product.objects.annotate(
+                day=TruncDay(Cast("name", DateTimeField()))
+            )
+            sql = cache.mogrify(queryset.query)
+            assert time_zone in sql
+            assert sql == cursor_mogrify(queryset)
+
+    assert cache.cache_info() == (2, 2, 256, 2)
+
+
+def test_query_template_cache_update():
+    cache = QueryTemplateCache()
+
+    for name in ["Foo", "Bar"]:
+        query = Product.objects.filter(name=name).query.chain(UpdateQuery)
+        query.add_update_values({"name": Concat(F("name"), Value("!"))})
+        assert cache.mogrify(query) == (
+            """UPDATE "mogrify_queryset_product" SET "name" = (COALESCE("mogrify_queryset_product"."name", '') || COALESCE('!', '')) """
+            f"""WHERE "mogrify_queryset_product"."name" = '{name}'"""
+        )
+
+    assert cache.cache_info().hits == 1
+
+
+def test_query_template_cache_lru():
+    cache = QueryTemplateCache(maxsize=2)
+
+    for queryset in [
+        Product.objects.filter(name="Foo"),
+        Product.objects.filter(pk=1),
+        Product.objects.filter(name="Bar"),
+        Product.objects.filter(name__startswith="B"),
+        Product.objects.filter(pk=2),
+    ]:
+        cache.mogrify(queryset.query)
+
+    assert cache.cache_info() == (1, 4, 2, 2)
+    cache.cache_clear()
+    assert cache.cache_info() == (0, 0, 2, 0)
+
+
+@benchmark
+def test_benchmark_query_template_cache():
+    cache = QueryTemplateCache()
+
+    def queryset(i):
+        return (
+            Product.objects.annotate(
+                label=Concat("name", Value(" #"), Cast("pk", CharField()))
+            )
+            .filter(pk__gt=i, name__startswith=f"Product {i}")
+            .order_by("-name", "pk")
+            .values("pk", "label")
+        )
+
+    number = 10_000
+    print()
+    for name, mogrify_ in [
+        ("cursor", cursor_mogrify),
+        ("sql_with_params()", lambda qs: mogrify(*qs.query.sql_with_params())),
+        ("cache", lambda qs: cache.mogrify(qs.query)),
+    ]:
+        i = iter(range(number))
+        elapsed = timeit.timeit(lambda: mogrify_(queryset(next(i))), number=number)
+        print(f"{name:>20} {elapsed / number * 1_000_000:>6.0f}µs")
+    building = timeit.timeit(lambda: queryset(1), number=number)
+    print(f"{'building queryset':>20} {building / number * 1_000_000:>6.0f}µs")
+
+
+@benchmark
+def test_benchmark_mogrify():
+    params = [
+        42,
+        "Product 42",
+        Decimal("9.95"),
+        datetime(2024, 2, 29, 1, 2, 3, tzinfo=timezone.utc),
+        date(2024, 2, 29),
+        UUID(int=42),
+        True,
+        None,
+    ]
+    sql = ", ".join(["%s"] * len(params))
+    connection.ensure_connection()
+
+    def transformer_mogrify():
+        transformer = Transformer.from_context(connection.connection)
+        return sql % tuple(transformer.as_literal(param).decode() for param in params)
+
+    number = 100_000
+    print()
+    for name, mogrify_ in [
+        ("cursor", lambda: cursor_mogrify_sql(sql, params)),
+        ("connection adapters", transformer_mogrify),
+        ("literal()", lambda: mogrify(sql, params)),
+    ]:
+        elapsed = timeit.timeit(mogrify_, number=number)
+        print(f"{name:>20} {elapsed / number * 1_000_000:>6.1f}µs")
+
+
+def prepared_statement_names():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM pg_prepared_statements")
+        return {name for name, in cursor.fetchall()}
+
+
+@pytest.fixture
+def deallocate():
+    yield
+    with connection.cursor() as cursor:
+        cursor.execute("DEALLOCATE ALL")
+    prepared_statements.forget(connection)
+
+
+def test_prepare(deallocate):
+    foo = Product.objects.create(name="Foo")
+    bar = Product.objects.create(name="Bar")
+    sql, _ = Product.objects.filter(name="Foo").query.sql_with_params()
+    name = prepared_statements.name(sql)
+
+    with CaptureQueriesContext(connection) as queries:
+        assert list(prepare(Product.objects.filter(name="Foo"))) == [foo]
+        assert list(prepare(Product.objects.filter(name="Bar"))) == [bar]
+
+    # PREPARE is in a savepoint
+    assert [
+        query["sql"]
+        for query in queries
+        if not query["sql"].startswith(("SAVEPOINT", "RELEASE"))
+    ] == [
+        f'PREPARE {name} AS SELECT "mogrify_queryset_product"."id", "mogrify_queryset_product"."name" '
+        'FROM "mogrify_queryset_product" WHERE "mogrify_queryset_product"."name" = $1',
+        f"EXECUTE {name}('Foo')",
+        f"EXECUTE {name}('Bar')",
+    ]
+    assert prepared_statement_names() == {name}
+
+
+def test_prepare_count_and_subquery(deallocate):
+    foo = Product.objects.create(name="Foo")
+    Product.objects.create(name="Bar")
+    queryset = prepare(Product.objects.filter(name="Foo"))
+
+    assert queryset.count() == 1
+    # only executed queries are prepared
+    assert list(Product.objects.filter(pk__in=queryset.values("pk"))) == [foo]
+    assert len(prepared_statement_names()) == 1
+
+
+def test_prepare_unpreparable(deallocate):
+    # the types of $1 + $2 can't be inferred
+    queryset = prepare(Product.objects.annotate(n=RawSQL("%s + %s", [1, 2])))
+    Product.objects.create(name="Foo")
+
+    assert [product.n for product in queryset] == [3]
+    assert [product.n for product in queryset.all()] == [3]
+    assert prepared_statement_names() == set()
+
+
+def test_prepare_iterator(deallocate):
+    Product.objects.create(name="Foo")
+
+    assert len(list(prepare(Product.objects.all()).iterator())) == 1
+    assert prepared_statement_names() == set()
+
+
+def test_prepare_invalidated_by_migrations(deallocate):
+    queryset = prepare(Product.objects.all())
+    list(queryset)
+
+    prepared_statements.invalidate()
+    with CaptureQueriesContext(connection) as queries:
+        list(queryset.all())
+
+    assert [query["sql"].split()[0] for query in queries] == [
+        "DEALLOCATE",
+        "SAVEPOINT",
+        "PREPARE",
+        "RELEASE",
+        "EXECUTE",
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_prepare_after_discard_all(deallocate):
+    Product.objects.create(name="Foo")
+    queryset = prepare(Product.objects.all())
+    list(queryset)
+
+    with connection.cursor() as cursor:
+        cursor.execute("DISCARD ALL")
+
+    assert len(queryset.all()) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_prepare_after_migrating_elsewhere(deallocate):
+    Product.objects.create(name="Foo")
+    queryset = prepare(Product.objects.all())
+    list(queryset)
+
+    # as though another process migrated, without post_migrate in this one
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "ALTER TABLE mogrify_queryset_product ALTER COLUMN name TYPE text"
+        )
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            assert len(queryset.all()) == 1
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "ALTER TABLE mogrify_queryset_product ALTER COLUMN name TYPE varchar"
+            )
+
+    assert [query["sql"].split()[0] for query in queries] == [
+        "EXECUTE",
+        "DEALLOCATE",
+        "BEGIN",
+        "PREPARE",
+        "COMMIT",
+        "EXECUTE",
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_prepare_first_query(deallocate):
+    Product.objects.create(name="Foo")
+    connection.close()
+
+    assert len(prepare(Product.objects.all())) == 1
+    assert len(prepared_statement_names()) == 1
+
+
+def test_prepare_maxsize(deallocate, monkeypatch):
+    monkeypatch.setattr(prepared_statements, "maxsize", 2)
+
+    for queryset in [
+        Product.objects.filter(name="Foo"),
+        Product.objects.filter(pk=1),
+        Product.objects.filter(name__startswith="B"),
+    ]:
+        list(prepare(queryset))
+
+    assert len(prepared_statement_names()) == 2
+
+
+class PreparedProductQuerySet(QuerySet):
+    @prepared
+    def named(self, name):
+        return self.filter(name=name)
+
+
+def test_prepared_method(deallocate):
+    foo = Product.objects.create(name="Foo")
+    queryset = PreparedProductQuerySet(Product)
+
+    assert list(queryset.named("Foo")) == [foo]
+    assert len(prepared_statement_names()) == 1
+
+
+@benchmark
+def test_benchmark_prepare(deallocate):
+    from count_subquery.models import Author, CountSubquery, Publication
+    from jsonb_agg_subquery.models import JSONBAggSubquery, Pizza, Topping
+
+    authors = Author.objects.bulk_create(Author(name=f"{i}") for i in range(1000))
+    Publication.objects.bulk_create(
+        Publication(author=author, title=f"{i}")
+        for author in authors
+        for i in range(10)
+    )
+    pizzas = Pizza.objects.bulk_create(Pizza(name=f"{i}") for i in range(1000))
+    Topping.objects.bulk_create(
+        Topping(pizza=pizza, name=f"{i}") for pizza in pizzas for i in range(5)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+
+    examples = {
+        "count_subquery": lambda pk: Author.objects.filter(pk=pk).annotate(
+            num_books=CountSubquery(Publication.objects.filter(author=OuterRef("pk")))
+        ),
+        "jsonb_agg_subquery": lambda pk: Pizza.objects.filter(pk=pk).values(
+            "name",
+            toppings=JSONBAggSubquery(
+                Topping.objects.filter(pizza=OuterRef("pk")).values("name")
+            ),
+        ),
+    }
+
+    def planning_time(sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (ANALYZE, FORMAT json) {sql}")
+            return cursor.fetchone()[0][0]["Planning Time"]
+
+    number = 2_000
+    print()
+    print(f"{'':>20} {'planning':>9} {'per query':>10}")
+    for example, queryset in examples.items():
+        pks = [obj.pk for obj in (authors if example == "count_subquery" else pizzas)]
+
+        start = timeit.default_timer()
+        for i in range(number):
+            list(queryset(pks[i % len(pks)]))
+        unprepared = (timeit.default_timer() - start) / number
+        planning = planning_time(mogrify_queryset(queryset(pks[0])))
+        print(f"{example:>20} {planning:>7.3f}ms {unprepared * 1000:>8.3f}ms")
+
+        start = timeit.default_timer()
+        for i in range(number):
+            list(prepare(queryset(pks[i % len(pks)])))
+        prepared_ = (timeit.default_timer() - start) / number
+        sql, params = queryset(pks[0]).query.sql_with_params()
+        name = prepared_statements.name(sql)
+        planning = planning_time(f"EXECUTE {name}({pks[0]})")
+        print(f"{'prepared':>20} {planning:>7.3f}ms {prepared_ * 1000:>8.3f}ms")
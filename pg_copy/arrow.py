@@ -0,0 +1,135 @@
+import io
+import re
+
+from .encoders import Encoder
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columnar formats want much larger batches than CSV, for Parquet each batch is a row group
+ARROW_BATCH_SIZE = 64 * 1024
+
+
+def arrow_type(db_type):
+    """
+    Map a Postgres type, as returned by output_columns(modifiers=True), to the Arrow type of the value psycopg loads.
+    """
+    name, _, modifiers = db_type.partition("(")
+    name = name.strip()
+    if name == "numeric":
+        if not modifiers:
+            raise ValueError("numeric columns must have a precision & scale")
+        precision, scale = re.findall(r"\d+", modifiers)
+        return pyarrow.decimal128(int(precision), int(scale))
+    types = {
+        "varchar": pyarrow.string(),
+        "text": pyarrow.string(),
+        "smallint": pyarrow.int16(),
+        "integer": pyarrow.int32(),
+        "bigint": pyarrow.int64(),
+        "real": pyarrow.float32(),
+        "double precision": pyarrow.float64(),
+        "boolean": pyarrow.bool_(),
+        "date": pyarrow.date32(),
+        "time": pyarrow.time64("us"),
+        "timestamp": pyarrow.timestamp("us"),
+        # aware datetimes are converted to UTC
+        "timestamp with time zone": pyarrow.timestamp("us", tz="UTC"),
+        "interval": pyarrow.duration("us"),
+        "bytea": pyarrow.binary(),
+    }
+    if name not in types:
+        raise ValueError(f"No Arrow type for {db_type}")
+    return types[name]
+
+
+def arrow_schema(columns):
+    return pyarrow.schema([(name, arrow_type(db_type)) for name, db_type in columns])
+
+
+class Sink(io.RawIOBase):
+    """
+    A write only file that's drained after each batch so that the output can be streamed.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class ArrowStreamEncoder(Encoder):
+    """
+    Encode rows as Arrow record batches in the IPC streaming format.
+
+    columns is a list of (name, type) as returned from output_columns(modifiers=True).
+    """
+
+    content_type = "application/vnd.apache.arrow.stream"
+    extension = "arrows"
+
+    def __init__(self, columns):
+        self.schema = arrow_schema(columns)
+        self.sink = Sink()
+
+    def open_writer(self):
+        return pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    def start(self, columns):
+        super().start(columns)
+        self.writer = self.open_writer()
+        return self.sink.drain()
+
+    def encode(self, rows):
+        self.writer.write_batch(
+            pyarrow.RecordBatch.from_arrays(
+                [
+                    pyarrow.array(values, type=field.type)
+                    for values, field in zip(zip(*rows), self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+        return self.sink.drain()
+
+    def finish(self):
+        self.writer.close()
+        return self.sink.drain()
+
+
+class ParquetEncoder(ArrowStreamEncoder):
+    """
+    Encode rows as Parquet, one row group per batch. The footer with the file's metadata is written last.
+    """
+
+    content_type = "application/vnd.apache.parquet"
+    extension = "parquet"
+
+    def open_writer(self):
+        return pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+
+
+ARROW_ENCODERS = {}
+if pyarrow:
+    ARROW_ENCODERS = {
+        encoder.extension: encoder for encoder in [ArrowStreamEncoder, ParquetEncoder]
+    }
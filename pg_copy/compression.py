@@ -0,0 +1,147 @@
+import zlib
+from functools import wraps
+
+from django.utils.cache import patch_vary_headers
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Input is compressed in blocks of this size, the compressor's own state is bounded by its window (32KB for gzip, a few
+# MB for zstd at the default level).
+BLOCK_SIZE = 256 * 1024
+
+
+class GzipCompressor:
+    default_level = 6
+
+    def __init__(self, level=None):
+        # wbits=31 for the gzip container rather than raw zlib
+        self.compressor = zlib.compressobj(
+            self.default_level if level is None else level, zlib.DEFLATED, 31
+        )
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+class ZstdCompressor:
+    default_level = 3
+
+    def __init__(self, level=None):
+        self.compressor = zstandard.ZstdCompressor(
+            level=self.default_level if level is None else level
+        ).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+# In order of preference when the client accepts several equally
+COMPRESSORS = {"gzip": GzipCompressor}
+if zstandard:
+    COMPRESSORS = {"zstd": ZstdCompressor, **COMPRESSORS}
+
+
+def accepted_encodings(accept_encoding):
+    """
+    Parse an Accept-Encoding header into a dict of encoding -> quality.
+    """
+    encodings = {}
+    for item in accept_encoding.split(","):
+        encoding, *params = [part.strip() for part in item.split(";")]
+        if not encoding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        encodings[encoding.lower()] = quality
+    return encodings
+
+
+def negotiate_encoding(request):
+    accepted = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+    candidates = [
+        (accepted.get(encoding, accepted.get("*", 0.0)), encoding)
+        for encoding in COMPRESSORS
+    ]
+    # max() returns the first of equal qualities, ie the preferred compressor
+    quality, encoding = max(candidates, key=lambda candidate: candidate[0])
+    return encoding if quality > 0 else None
+
+
+def compress_stream(chunks, encoding, level=None, block_size=BLOCK_SIZE):
+    compressor = COMPRESSORS[encoding](level)
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= block_size:
+            if data := compressor.compress(bytes(buffer)):
+                yield data
+            buffer.clear()
+    yield compressor.compress(bytes(buffer)) + compressor.flush()
+
+
+async def acompress_stream(chunks, encoding, level=None, block_size=BLOCK_SIZE):
+    compressor = COMPRESSORS[encoding](level)
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= block_size:
+            if data := compressor.compress(bytes(buffer)):
+                yield data
+            buffer.clear()
+    yield compressor.compress(bytes(buffer)) + compressor.flush()
+
+
+def compress_response(request, response, level=None, block_size=BLOCK_SIZE):
+    """
+    Compress the response with the best encoding the client accepts, streaming responses are compressed as they're
+    streamed.
+    """
+    patch_vary_headers(response, ["Accept-Encoding"])
+    if response.has_header("Content-Encoding"):
+        return response
+    if not (encoding := negotiate_encoding(request)):
+        return response
+
+    if response.streaming:
+        stream = acompress_stream if response.is_async else compress_stream
+        response.streaming_content = stream(
+            response.streaming_content, encoding, level, block_size
+        )
+    else:
+        response.content = b"".join(
+            compress_stream([response.content], encoding, level, block_size)
+        )
+        if response.has_header("Content-Length"):
+            response.headers["Content-Length"] = str(len(response.content))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def compress_export(view=None, *, level=None):
+    """
+    View decorator to compress exports.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return compress_response(request, view(request, *args, **kwargs), level)
+
+        return wrapper
+
+    return decorator(view) if view else decorator
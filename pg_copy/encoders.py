@@ -0,0 +1,96 @@
+import csv
+import io
+import re
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def output_columns(queryset, using=DEFAULT_DB_ALIAS, modifiers=False):
+    """
+    Return the (name, type) of each column in the queryset's select, for use with a binary COPY's set_types().
+
+    Types come from the output field of each selected expression so take care that they're accurate, a binary COPY
+    won't complain about mismatched types - you'll just get garbage. Type modifiers, eg numeric(10, 2), are stripped
+    unless modifiers is set.
+    """
+    connection = connections[using]
+    query = queryset.query
+    compiler = query.get_compiler(using=using)
+    compiler.setup_query()
+    # same ordering as ValuesIterable
+    names = [*query.extra_select, *query.values_select, *query.annotation_select]
+    types = [
+        expression.output_field.cast_db_type(connection)
+        for expression, _, _ in compiler.select[: compiler.col_count]
+    ]
+    if not modifiers:
+        # the type registry doesn't know about modifiers like numeric(10, 2)
+        types = [re.sub(r"\(.*\)", "", db_type) for db_type in types]
+    return list(zip(names, types))
+
+
+class Encoder:
+    """
+    Encode batches of rows on the app server instead of having Postgres format them.
+    """
+
+    content_type = "application/octet-stream"
+    extension = "bin"
+
+    def start(self, columns):
+        """
+        Called once with the column names, return any bytes to be written before the rows.
+        """
+        self.columns = columns
+        return b""
+
+    def encode(self, rows):
+        raise NotImplementedError
+
+    def finish(self):
+        return b""
+
+
+class CSVEncoder(Encoder):
+    content_type = "text/csv"
+    extension = "csv"
+    delimiter = ","
+
+    def __init__(self, header=True):
+        self.header = header
+
+    def start(self, columns):
+        super().start(columns)
+        return self.encode([columns]) if self.header else b""
+
+    def encode(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=self.delimiter, lineterminator="\n")
+        writer.writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+
+
+class TSVEncoder(CSVEncoder):
+    content_type = "text/tab-separated-values"
+    extension = "tsv"
+    delimiter = "\t"
+
+
+class NDJSONEncoder(Encoder):
+    content_type = "application/x-ndjson"
+    extension = "ndjson"
+
+    def __init__(self):
+        self.json_encoder = DjangoJSONEncoder(ensure_ascii=False)
+
+    def encode(self, rows):
+        return "".join(
+            self.json_encoder.encode(dict(zip(self.columns, row))) + "\n"
+            for row in rows
+        ).encode("utf-8")
+
+
+ENCODERS = {
+    encoder.extension: encoder for encoder in [CSVEncoder, TSVEncoder, NDJSONEncoder]
+}
@@ -0,0 +1,203 @@
+import codecs
+import csv
+import json
+from itertools import chain
+
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models.constants import LOOKUP_SEP
+
+
+def read_csv(file, encoding="utf-8"):
+    return csv.DictReader(codecs.iterdecode(file, encoding))
+
+
+def read_ndjson(file, encoding="utf-8"):
+    for line in codecs.iterdecode(file, encoding):
+        if line.strip():
+            yield json.loads(line)
+
+
+def identifies(fields, model):
+    """
+    Whether fields of model, a lookup of a foreign key, match at most one row.
+    """
+    names = {field.name for field in fields}
+    if any(field.unique for field in fields):
+        return True
+    opts = model._meta
+    return any(
+        set(unique) <= names
+        for unique in chain(
+            opts.unique_together,
+            (constraint.fields for constraint in opts.total_unique_constraints),
+        )
+    )
+
+
+def copy_import(
+    model,
+    rows,
+    *,
+    columns=None,
+    unique_fields=None,
+    update_fields=None,
+    using=DEFAULT_DB_ALIAS,
+):
+    """
+    Import an iterable of dicts into model's table using COPY ... FROM STDIN.
+
+    Rows are copied into a temporary staging table which is then inserted into the table with a single
+    INSERT ... SELECT. Keys may be field names, attnames or a lookup on a foreign key's related model, eg
+    category__name, which is resolved with a join on the staging table. Lookups must be unique & match a row unless they're
+    all NULL, otherwise ValueError is raised. If unique_fields is given then existing rows are
+    updated with ON CONFLICT ... DO UPDATE, by default only the imported columns (note that, as with any upsert, a row
+    can't be updated twice by the same import).
+
+    Rows are streamed and never held in memory, returns the number of rows inserted or updated.
+    """
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    opts = model._meta
+    rows = iter(rows)
+
+    if columns is None:
+        try:
+            first_row = next(rows)
+        except StopIteration:
+            return 0
+        columns = list(first_row)
+        rows = chain([first_row], rows)
+
+    staging_table = quote_name(f"{opts.db_table}_import")
+    staging_columns = []
+    # column in the target table -> staging column, or joined column for lookups
+    select = {}
+    # foreign key -> list of (related field, staging column) to join on
+    joins = {}
+    # "" in a CSV means NULL unless the column is a string, for lookups it's no related row
+    nullable_blanks = []
+
+    for column in columns:
+        field_name, _, lookup = column.partition(LOOKUP_SEP)
+        field = opts.get_field(field_name)
+        if lookup:
+            if not field.many_to_one:
+                raise ValueError(f"{column} is not a lookup on a foreign key")
+            related_field = field.related_model._meta.get_field(lookup)
+            joins.setdefault(field, []).append((related_field, column))
+            type_field = related_field
+        else:
+            select[field.column] = f"s.{quote_name(column)}"
+            type_field = field
+        staging_columns.append(
+            f"{quote_name(column)} {type_field.cast_db_type(connection)}"
+        )
+        nullable_blanks.append(
+            bool(lookup)
+            or not isinstance(type_field, (models.CharField, models.TextField))
+        )
+
+    from_clause = f"{staging_table} s"
+    # (staging columns, SQL selecting those without a match) of each foreign key
+    unmatched = []
+    for i, (field, lookups) in enumerate(joins.items()):
+        lookup_columns = [column for _, column in lookups]
+        if not identifies([related for related, _ in lookups], field.related_model):
+            # each row would be joined to every match
+            raise ValueError(
+                f"{', '.join(lookup_columns)} doesn't identify a single "
+                f"{field.related_model._meta.verbose_name}"
+            )
+        alias = f"j{i}"
+        on = " AND ".join(
+            f"{alias}.{quote_name(related.column)} = s.{quote_name(column)}"
+            for related, column in lookups
+        )
+        from_clause += (
+            f" LEFT JOIN {quote_name(field.related_model._meta.db_table)} {alias}"
+            f" ON {on}"
+        )
+        select[field.column] = f"{alias}.{quote_name(field.target_field.column)}"
+        staged = [f"s.{quote_name(column)}" for column in lookup_columns]
+        unmatched.append(
+            (
+                lookup_columns,
+                f"SELECT DISTINCT {', '.join(staged)} FROM {staging_table} s "
+                f"LEFT JOIN {quote_name(field.related_model._meta.db_table)} {alias} "
+                f"ON {on} "
+                f"WHERE {alias}.{quote_name(field.target_field.column)} IS NULL "
+                f"AND NOT ({' AND '.join(f'{column} IS NULL' for column in staged)}) "
+                "LIMIT 10",
+            )
+        )
+
+    imported_columns = list(select)
+
+    # Fields that aren't imported get their default, as with bulk_create(), though evaluated once per import
+    default_params = []
+    for field in opts.concrete_fields:
+        if (
+            field.column not in select
+            and not field.primary_key
+            and not field.has_db_default()
+            and not field.generated
+        ):
+            select[field.column] = "%s"
+            default_params.append(
+                field.get_db_prep_save(field.get_default(), connection)
+            )
+
+    insert_sql = (
+        f"INSERT INTO {quote_name(opts.db_table)} "
+        f"({', '.join(quote_name(column) for column in select)}) "
+        f"SELECT {', '.join(select.values())} FROM {from_clause}"
+    )
+    if unique_fields:
+        conflict_columns = [opts.get_field(name).column for name in unique_fields]
+        if update_fields is None:
+            # existing rows keep the values of columns that weren't imported
+            update_columns = [c for c in imported_columns if c not in conflict_columns]
+        else:
+            update_columns = [opts.get_field(name).column for name in update_fields]
+        insert_sql += (
+            f" ON CONFLICT ({', '.join(quote_name(c) for c in conflict_columns)})"
+        )
+        if update_columns:
+            insert_sql += " DO UPDATE SET " + ", ".join(
+                f"{quote_name(c)} = EXCLUDED.{quote_name(c)}" for c in update_columns
+            )
+        else:
+            insert_sql += " DO NOTHING"
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {staging_table} ({', '.join(staging_columns)}) "
+            "ON COMMIT DROP"
+        )
+        with cursor.copy(
+            f"COPY {staging_table} ({', '.join(quote_name(c) for c in columns)}) "
+            "FROM STDIN"
+        ) as copy:
+            for row in rows:
+                values = [row.get(column) for column in columns]
+                copy.write_row(
+                    [
+                        None if nullable_blank and value == "" else value
+                        for value, nullable_blank in zip(values, nullable_blanks)
+                    ]
+                )
+        # the join would otherwise set the foreign key to NULL
+        for lookup_columns, unmatched_sql in unmatched:
+            cursor.execute(unmatched_sql)
+            values = [row if len(row) > 1 else row[0] for row in cursor.fetchall()]
+            if values:
+                raise ValueError(
+                    f"No match for {', '.join(lookup_columns)}: "
+                    f"{', '.join(map(repr, values))}"
+                )
+        cursor.execute(insert_sql, default_params)
+        count = cursor.rowcount
+        # ON COMMIT DROP won't happen until the outermost atomic block exits
+        cursor.execute(f"DROP TABLE {staging_table}")
+
+    return count
@@ -0,0 +1,160 @@
+import time
+from contextlib import closing, contextmanager
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.dispatch import Signal
+
+# Sent with stats=ExportStats every progress_interval seconds while exporting & once when finished, connect receivers
+# to record metrics.
+export_progress = Signal()
+export_finished = Signal()
+
+PROGRESS_TIMEOUT = 60 * 60
+
+
+def progress_key(export_id):
+    return f"pg_copy:export:{export_id}"
+
+
+def get_progress(export_id):
+    return cache.get(progress_key(export_id))
+
+
+class ExportStats:
+    """
+    Pass to a COPY export (eg CopyExportResponse(..., stats=ExportStats())) to record how it went.
+
+    If export_id is given then progress is saved to the cache for the progress endpoint. Set db_time to record how long
+    the COPY ran on the database, from pg_stat_activity, which needs another connection once the export has finished.
+    """
+
+    def __init__(self, export_id=None, *, progress_interval=1.0, db_time=False):
+        self.export_id = export_id
+        self.progress_interval = progress_interval
+        self.measure_db_time = db_time
+        self.rows = 0
+        self.bytes = 0
+        self.backend_pid = None
+        self.started = None
+        self.first_byte = None
+        self.last_progress = None
+        self.finished = None
+        self.db_time = None
+        self.error = None
+
+    @property
+    def running(self):
+        return self.started is not None and self.finished is None
+
+    @property
+    def time_to_first_byte(self):
+        if self.first_byte is not None:
+            return self.first_byte - self.started
+
+    @property
+    def duration(self):
+        if self.started is not None:
+            return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self):
+        return {
+            "export_id": self.export_id,
+            "running": self.running,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "backend_pid": self.backend_pid,
+            "time_to_first_byte": self.time_to_first_byte,
+            "duration": self.duration,
+            "db_time": self.db_time,
+            "error": self.error,
+        }
+
+    @contextmanager
+    def track(self, cursor, using=DEFAULT_DB_ALIAS):
+        self.backend_pid = cursor.connection.info.backend_pid
+        self.started = self.last_progress = time.monotonic()
+        self.save()
+        try:
+            yield
+            # exact, including when rows span messages eg binary COPY
+            self.rows = cursor.rowcount
+        except GeneratorExit:
+            self.error = "cancelled"
+            raise
+        except Exception as e:
+            self.error = repr(e)
+            raise
+        finally:
+            self.finished = time.monotonic()
+            if self.measure_db_time:
+                self.db_time = self.fetch_db_time(using)
+            self.save()
+            export_finished.send(sender=self.__class__, stats=self)
+
+    def emit(self, size):
+        now = time.monotonic()
+        if self.first_byte is None:
+            self.first_byte = now
+        self.bytes += size
+        if now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            self.save()
+            export_progress.send(sender=self.__class__, stats=self)
+
+    def save(self):
+        if self.export_id is not None:
+            cache.set(progress_key(self.export_id), self.as_dict(), PROGRESS_TIMEOUT)
+
+    def fetch_db_time(self, using):
+        # The export's own connection can't be used: pg_stat_activity would show the query asking for it
+        with closing(connections.create_connection(using)) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT extract(epoch FROM state_change - query_start)
+                    FROM pg_stat_activity
+                    WHERE pid = %s AND state <> 'active'
+                    """,
+                    [self.backend_pid],
+                )
+                row = cursor.fetchone()
+        return float(row[0]) if row else None
+
+
+def database_activity(backend_pid, using=DEFAULT_DB_ALIAS):
+    """
+    What the backend running an export is currently doing. A wait_event of ClientWrite means it's waiting on us to read
+    the output, ie the bottleneck is the client.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT
+                a.state,
+                a.wait_event_type,
+                a.wait_event,
+                extract(epoch FROM now() - a.query_start),
+                p.tuples_processed,
+                p.bytes_processed
+            FROM pg_stat_activity a
+            LEFT JOIN pg_stat_progress_copy p USING (pid)
+            WHERE a.pid = %s
+            """,
+            [backend_pid],
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    keys = [
+        "state",
+        "wait_event_type",
+        "wait_event",
+        "query_time",
+        "tuples_processed",
+        "bytes_processed",
+    ]
+    activity = dict(zip(keys, row))
+    if activity["query_time"] is not None:
+        activity["query_time"] = float(activity["query_time"])
+    return activity
@@ -0,0 +1,227 @@
+import math
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from django.db import connections, transaction
+from django.db.models import BooleanField, Expression, IntegerField, Max, Min
+
+from mogrify_queryset.models import mogrify_queryset
+
+from .responses import CHUNK_SIZE, stream_copy
+
+# Ordered slices are spooled until it's their turn, only the first few MB are kept in memory
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+class CtidRange(Expression):
+    """
+    Filter rows of the base table to those stored within the given block range, end=None for no upper bound.
+
+    Since Postgres 14 this is a TID Range Scan which only reads the requested blocks.
+    """
+
+    output_field = BooleanField()
+
+    def __init__(self, start, end=None):
+        super().__init__()
+        self.start = start
+        self.end = end
+
+    def as_sql(self, compiler, connection):
+        ctid = f"{compiler.quote_name_unless_alias(compiler.query.base_table)}.ctid"
+        sql = f"{ctid} >= '({int(self.start)},0)'::tid"
+        if self.end is not None:
+            sql += f" AND {ctid} < '({int(self.end)},0)'::tid"
+        return sql, []
+
+
+def pk_slices(queryset, slices):
+    pk = queryset.model._meta.pk
+    if pk.is_relation:
+        pk = pk.target_field
+    if not isinstance(pk, IntegerField):
+        raise ValueError(
+            f"{queryset.model._meta.label} can't be split by pk ranges, its pk isn't an "
+            'integer - split by "ctid" instead'
+        )
+    bounds = queryset.model._base_manager.using(queryset.db).aggregate(
+        start=Min("pk"), end=Max("pk")
+    )
+    if bounds["start"] is None:
+        return [queryset]
+    step = math.ceil((bounds["end"] - bounds["start"] + 1) / slices)
+    return [
+        queryset.filter(pk__gte=start, pk__lt=start + step)
+        for start in range(bounds["start"], bounds["end"] + 1, step)
+    ]
+
+
+def ctid_slices(queryset, slices):
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_relation_size(%s::regclass) / current_setting('block_size')::int",
+            [queryset.model._meta.db_table],
+        )
+        blocks = cursor.fetchone()[0]
+    step = max(math.ceil(blocks / slices), 1)
+    starts = range(0, max(blocks, 1), step)
+    # leave the last slice open in case the table grows in the meantime
+    return [
+        queryset.filter(CtidRange(start, start + step if start != starts[-1] else None))
+        for start in starts
+    ]
+
+
+def is_ordered_by_pk(queryset):
+    opts = queryset.model._meta
+    order_by = queryset.query.order_by
+    return (
+        len(order_by) == 1
+        and isinstance(order_by[0], str)
+        and order_by[0].lstrip("-") in ("pk", opts.pk.name, opts.pk.attname)
+    )
+
+
+def parallel_copy(
+    queryset,
+    slices=4,
+    *,
+    split="pk",
+    ordered=False,
+    options="FORMAT csv",
+    header=True,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Export a queryset with a COPY per slice, each running on its own connection in a thread.
+
+    The queryset is split by either pk ranges or ctid block ranges. When ordered, the queryset must be ordered by pk;
+    slices are written to spool files and concatenated in order. Otherwise any ordering is dropped and chunks are
+    yielded as soon as any slice produces them.
+
+    Every slice reads from the same snapshot, exported by a coordinating connection that's held open for the duration,
+    so the export is as consistent as a single COPY - a row updated in the meantime can't be exported twice or missed.
+
+    options are the COPY options, eg "FORMAT csv". If header is set then a single header is exported first.
+    """
+    using = queryset.db
+
+    if ordered:
+        if split != "pk" or not is_ordered_by_pk(queryset):
+            raise ValueError("Ordered exports must be split by & ordered by pk")
+    else:
+        queryset = queryset.order_by()
+
+    with closing(connections.create_connection(using)) as coordinator:
+        # the snapshot is taken before slicing so the slices cover every row in it
+        coordinator.ensure_connection()
+        with coordinator.connection.cursor() as cursor:
+            cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute("SELECT pg_export_snapshot()")
+            [snapshot] = cursor.fetchone()
+
+        querysets = (pk_slices if split == "pk" else ctid_slices)(queryset, slices)
+        if ordered and queryset.query.order_by[0].startswith("-"):
+            querysets.reverse()
+
+        if header:
+            # Let Postgres format the header so that it's exactly as it would be in a single COPY
+            yield from stream_copy(
+                f"COPY ({mogrify_queryset(queryset[:0])}) TO STDOUT WITH ({options}, HEADER)",
+                using=using,
+            )
+
+        statements = [
+            f"COPY ({mogrify_queryset(qs)}) TO STDOUT WITH ({options})"
+            for qs in querysets
+        ]
+        cancelled = threading.Event()
+
+        def copy_slice(sql, write):
+            try:
+                with transaction.atomic(using=using):
+                    with connections[using].cursor() as cursor:
+                        cursor.execute(
+                            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+                        )
+                        cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot])
+                    with closing(
+                        stream_copy(sql, using=using, chunk_size=chunk_size)
+                    ) as chunks:
+                        for chunk in chunks:
+                            if cancelled.is_set():
+                                return
+                            write(chunk)
+            finally:
+                # each thread has its own connection
+                connections[using].close()
+
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            try:
+                if ordered:
+                    yield from _ordered(executor, copy_slice, statements, chunk_size)
+                else:
+                    yield from _unordered(executor, copy_slice, statements, cancelled)
+            finally:
+                cancelled.set()
+
+
+def _ordered(executor, copy_slice, statements, chunk_size):
+    def spool_slice(sql):
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            copy_slice(sql, spool.write)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+    futures = [executor.submit(spool_slice, sql) for sql in statements]
+    try:
+        for future in futures:
+            with future.result() as spool:
+                while chunk := spool.read(chunk_size):
+                    yield chunk
+    finally:
+        # clean up any slices that weren't consumed
+        for future in futures:
+            if not future.cancel() and future.done() and not future.exception():
+                future.result().close()
+
+
+def _unordered(executor, copy_slice, statements, cancelled):
+    chunks = queue.Queue(maxsize=len(statements) * 4)
+
+    def put(item):
+        # don't block forever if the consumer has gone away
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def queue_slice(sql):
+        try:
+            copy_slice(sql, put)
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    for sql in statements:
+        executor.submit(queue_slice, sql)
+
+    remaining = len(statements)
+    while remaining:
+        item = chunks.get()
+        if item is None:
+            remaining -= 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield item
@@ -0,0 +1,172 @@
+from contextlib import nullcontext
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import StreamingHttpResponse
+
+# COPY sends one message per row; coalescing them means we aren't doing a socket write per row.
+CHUNK_SIZE = 64 * 1024
+# Number of rows handed to an encoder at a time for binary COPY
+BATCH_SIZE = 1000
+
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\0" + bytes(8)
+BINARY_TRAILER = b"\xff\xff"
+
+
+def stream_copy(
+    sql, params=None, using=DEFAULT_DB_ALIAS, chunk_size=CHUNK_SIZE, stats=None
+):
+    """
+    Yield the output of a COPY ... TO STDOUT statement in blocks of roughly chunk_size bytes.
+
+    The cursor & COPY stay open until the generator is exhausted or closed. Closing early (eg the client disconnected
+    and the server called close() on the response) makes psycopg cancel the COPY & drain what's left on the wire so
+    that the connection can be reused.
+
+    Pass an instrumentation.ExportStats as stats to record rows, bytes & timings.
+    """
+    with connections[using].cursor() as cursor:
+        with stats.track(cursor, using) if stats else nullcontext():
+            with cursor.copy(sql, params) as copy:
+                buffer = bytearray()
+                while data := copy.read():
+                    buffer += data
+                    if stats:
+                        # a message per row
+                        stats.rows += 1
+                    if len(buffer) >= chunk_size:
+                        if stats:
+                            stats.emit(len(buffer))
+                        yield bytes(buffer)
+                        buffer.clear()
+                if buffer:
+                    if stats:
+                        stats.emit(len(buffer))
+                    yield bytes(buffer)
+
+
+def stream_copy_rows(sql, types, params=None, using=DEFAULT_DB_ALIAS):
+    """
+    Yield the rows of a COPY ... TO STDOUT (FORMAT binary) statement, loaded as Python values of the given types.
+    """
+    with connections[using].cursor() as cursor:
+        with cursor.copy(sql, params) as copy:
+            copy.set_types(types)
+            # Some versions of psycopg fail to parse an empty binary COPY, where the header & trailer arrive together
+            data = copy.read()
+            if data == BINARY_HEADER + BINARY_TRAILER:
+                copy.read()
+                return
+            if data:
+                yield copy.formatter.parse_row(data)
+                yield from copy.rows()
+
+
+def json_array(chunks):
+    """
+    Turn NDJSON chunks into a JSON array by replacing the newline after each row with a comma.
+
+    JSON encoded by Postgres never contains a raw newline so every newline is the end of a row, rows may be split across
+    chunks.
+    """
+    yield b"["
+    separator = b""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        rows, end = (chunk[:-1], b",") if chunk.endswith(b"\n") else (chunk, b"")
+        if rows:
+            yield separator + rows.replace(b"\n", b",")
+        separator = end
+    yield b"]"
+
+
+def stream_encoded(rows, columns, encoder, batch_size=BATCH_SIZE):
+    rows = iter(rows)
+    if header := encoder.start(columns):
+        yield header
+    while batch := list(islice(rows, batch_size)):
+        yield encoder.encode(batch)
+    if footer := encoder.finish():
+        yield footer
+
+
+async def astream_copy(
+    sql, params=None, using=DEFAULT_DB_ALIAS, chunk_size=CHUNK_SIZE, stats=None
+):
+    # Django connections are thread local, each step must run on the same thread that opened the cursor.
+    chunks = stream_copy(sql, params, using, chunk_size, stats)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    try:
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close, thread_sensitive=True)()
+
+
+class CopyExportResponse(StreamingHttpResponse):
+    """
+    Stream the result of a COPY ... TO STDOUT statement, for WSGI.
+
+    Unlike passing the Copy object to HttpResponse, nothing is buffered beyond the current chunk.
+    """
+
+    stream = staticmethod(stream_copy)
+
+    def __init__(
+        self,
+        sql,
+        params=None,
+        *args,
+        using=DEFAULT_DB_ALIAS,
+        chunk_size=CHUNK_SIZE,
+        stats=None,
+        **kwargs,
+    ):
+        super().__init__(
+            self.stream(sql, params, using, chunk_size, stats), *args, **kwargs
+        )
+
+
+class AsyncCopyExportResponse(CopyExportResponse):
+    """
+    Stream the result of a COPY ... TO STDOUT statement, for ASGI.
+
+    Django consumes sync iterators under ASGI by loading them entirely into memory, so this uses an async iterator
+    instead.
+    """
+
+    stream = staticmethod(astream_copy)
+
+
+class EncodedCopyExportResponse(StreamingHttpResponse):
+    """
+    Stream a binary COPY, encoding rows on the app server rather than having Postgres format them.
+
+    columns is a list of (name, type) as returned from encoders.output_columns().
+    """
+
+    def __init__(
+        self,
+        sql,
+        columns,
+        encoder,
+        params=None,
+        *args,
+        using=DEFAULT_DB_ALIAS,
+        batch_size=BATCH_SIZE,
+        **kwargs,
+    ):
+        names, types = zip(*columns)
+        kwargs.setdefault("content_type", encoder.content_type)
+        super().__init__(
+            stream_encoded(
+                stream_copy_rows(sql, types, params, using),
+                names,
+                encoder,
+                batch_size,
+            ),
+            *args,
+            **kwargs,
+        )
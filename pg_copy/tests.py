@@ -1,12 +1,58 @@
-import pytest
-import io
 import csv
+import gzip
+import io
+import json
+import os
 import textwrap
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import Permission
+from django.contrib.sessions.models import Session
+from django.db import connection
+from django.db.models import F
+from django.db.models.functions import Mod
+from django.utils.dateformat import DateFormat
 
+from .arrow import ARROW_BATCH_SIZE, ARROW_ENCODERS, arrow_schema
+from .compression import COMPRESSORS, accepted_encodings, compress_stream
+from .encoders import CSVEncoder, output_columns
+from .importer import copy_import
+from .instrumentation import (
+    ExportStats,
+    database_activity,
+    export_finished,
+    export_progress,
+    get_progress,
+)
 from .models import Brand, Category, Product
+from .parallel import parallel_copy
+from .responses import (
+    astream_copy,
+    json_array,
+    stream_copy,
+    stream_copy_rows,
+    stream_encoded,
+)
+from .views import (
+    ChoiceDisplay,
+    format_timestamps,
+    mogrify_queryset,
+    product_export_queryset,
+)
 
 pytestmark = pytest.mark.django_db
 
+benchmark = pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="Set BENCHMARK=1 to run benchmarks"
+)
+
 
 def ascii_grid_to_csv(table):
     """
@@ -101,8 +147,9 @@ def test_csv_export(products, client):
     response = client.get("/pg_copy/export/")
 
     assert response.status_code == 200
+    assert response.streaming
     assert response.get("Content-Disposition") == 'attachment; filename="products.csv"'
-    assert response.content.decode("utf-8") == ascii_grid_to_csv(
+    assert response.getvalue().decode("utf-8") == ascii_grid_to_csv(
         """\
         +----------+------------------------------+-----------------------------------------+----------------+---------+-------+----------+----------------+--------------+------------+----------------------+---------------------+
         | SKU      | Name                         | Description                             | Category       | Brand   | Price | Currency | Stock Quantity | Availability | Is Active? | Last Updated         | Date Created        |
@@ -120,8 +167,9 @@ def test_csv_export_no_data(client):
     response = client.get("/pg_copy/export/")
 
     assert response.status_code == 200
+    assert response.streaming
     assert response.get("Content-Disposition") == 'attachment; filename="products.csv"'
-    assert response.content.decode("utf-8") == ascii_grid_to_csv(
+    assert response.getvalue().decode("utf-8") == ascii_grid_to_csv(
         """\
         +-----+------+-------------+----------+-------+-------+----------+----------------+--------------+------------+--------------+--------------+
         | SKU | Name | Description | Category | Brand | Price | Currency | Stock Quantity | Availability | Is Active? | Last Updated | Date Created |
@@ -147,3 +195,894 @@ def test_traditional_export(products, client):
         +----------+------------------------------+-----------------------------------------+----------------+---------+-------+----------+----------------+--------------+------------+----------------------+---------------------+
         """
     )
+
+
+def test_streaming_export(products, client):
+    response = client.get("/pg_copy/export-streaming/")
+
+    assert response.streaming
+    assert response.get("Content-Disposition") == 'attachment; filename="products.csv"'
+    assert (
+        response.getvalue()
+        == client.get("/pg_copy/export-traditional/").content
+    )
+
+
+def test_format_timestamps():
+    timezone = ZoneInfo("Hongkong")
+    start = datetime(2000, 1, 1, tzinfo=ZoneInfo("UTC"))
+    # every day of the month & hour of the day
+    timestamps = [start + timedelta(days=i, hours=i, minutes=i) for i in range(60)]
+
+    assert format_timestamps(timestamps, timezone) == [
+        DateFormat(t.astimezone(timezone)).format("jS M Y g:i ")
+        + DateFormat(t.astimezone(timezone)).format("A").lower()
+        for t in timestamps
+    ]
+
+
+@pytest.mark.parametrize("lookup", ["case", "jsonb"])
+def test_choice_display(products, lookup):
+    choices = [
+        ("Toys", "Kids' stuff"),
+        ("Electronics", 'Gadgets & "gizmos"'),
+        ("Kitchen", "%(expressions)s %s"),
+    ]
+
+    labels = (
+        Product.objects.annotate(
+            label=ChoiceDisplay("category__name", choices=choices, lookup=lookup)
+        )
+        .order_by("sku")
+        .values_list("sku", "label")
+    )
+
+    assert list(labels) == [
+        ("ELEC-001", 'Gadgets & "gizmos"'),
+        ("HOME-001", ""),
+        ("TOY-001", "Kids' stuff"),
+        ("TOY-002", "Kids' stuff"),
+    ]
+
+
+@pytest.mark.parametrize("lookup", ["case", "jsonb"])
+def test_choice_display_integer_keys(products, lookup):
+    labels = (
+        Product.objects.annotate(
+            label=ChoiceDisplay(
+                F("stock_qty"), choices=[(0, "None"), (80, "Some")], lookup=lookup
+            )
+        )
+        .order_by("sku")
+        .values_list("label", flat=True)
+    )
+
+    assert list(labels) == ["", "", "None", "Some"]
+
+
+@pytest.mark.parametrize("lookup", ["case", "jsonb"])
+def test_choice_display_boolean_keys(products, lookup):
+    Product.objects.filter(sku="TOY-002").update(is_active=False)
+    labels = (
+        Product.objects.annotate(
+            label=ChoiceDisplay(
+                F("is_active"),
+                choices=[(True, "Active"), (False, "Inactive")],
+                lookup=lookup,
+            )
+        )
+        .order_by("sku")
+        .values_list("label", flat=True)
+    )
+
+    assert list(labels) == ["Active", "Active", "Active", "Inactive"]
+
+
+def test_choice_display_jsonb_key_types():
+    with pytest.raises(ValueError):
+        ChoiceDisplay("price", choices=[(Decimal("1.0"), "One")], lookup="jsonb")
+
+
+def test_stream_copy_chunks(products):
+    chunks = list(
+        stream_copy(
+            "COPY (SELECT sku FROM pg_copy_product ORDER BY id) TO STDOUT",
+            chunk_size=10,
+        )
+    )
+
+    # rows are coalesced until the chunk size is reached, they're never split
+    assert chunks == [b"TOY-001\nTOY-002\n", b"ELEC-001\nHOME-001\n"]
+
+
+# cancelling a COPY aborts any surrounding transaction
+@pytest.mark.django_db(transaction=True)
+def test_stream_copy_closed_early(products):
+    chunks = stream_copy(
+        "COPY (SELECT generate_series(1, 100000)) TO STDOUT", chunk_size=10
+    )
+
+    assert next(chunks) == b"1\n2\n3\n4\n5\n"
+    chunks.close()
+
+    # the COPY was cancelled and the connection is ready for the next query
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1")
+        assert cursor.fetchone() == (1,)
+
+
+def test_astream_copy(products):
+    @async_to_sync
+    async def read_all():
+        return [
+            chunk
+            async for chunk in astream_copy(
+                "COPY (SELECT sku FROM pg_copy_product ORDER BY id) TO STDOUT"
+            )
+        ]
+
+    assert read_all() == [b"TOY-001\nTOY-002\nELEC-001\nHOME-001\n"]
+
+
+def test_binary_export_csv(products, client):
+    response = client.get("/pg_copy/export-binary/")
+    expected = client.get("/pg_copy/export/")
+
+    assert response.status_code == 200
+    assert response.get("Content-Type") == "text/csv"
+    assert response.get("Content-Disposition") == 'attachment; filename="products.csv"'
+    assert response.getvalue() == expected.getvalue()
+
+
+def test_binary_export_ndjson(products, client):
+    response = client.get("/pg_copy/export-binary/?format=ndjson")
+
+    assert response.status_code == 200
+    assert response.get("Content-Type") == "application/x-ndjson"
+    lines = response.getvalue().decode("utf-8").splitlines()
+    assert len(lines) == 4
+    assert json.loads(lines[0]) == {
+        "SKU": "HOME-001",
+        "Name": "Stainless Steel Water Bottle",
+        "Description": "1L insulated bottle, keeps drinks cold.",
+        "Category": "Home & Kitchen",
+        "Brand": "Initech",
+        "Price": "19.95",
+        "Currency": "USD",
+        "Stock Quantity": 200,
+        "Availability": "In Stock",
+        "Is Active?": "Yes",
+        "Last Updated": "1st Jan 2000 3:00 pm",
+        "Date Created": "2000-01-01T15:00:00",
+    }
+
+
+def test_binary_export_tsv(products, client):
+    response = client.get("/pg_copy/export-binary/?format=tsv")
+
+    assert response.status_code == 200
+    assert response.getvalue().decode("utf-8").splitlines()[1].split("\t")[:3] == [
+        "HOME-001",
+        "Stainless Steel Water Bottle",
+        "1L insulated bottle, keeps drinks cold.",
+    ]
+
+
+def test_binary_export_no_data(client):
+    response = client.get("/pg_copy/export-binary/?format=ndjson")
+
+    assert response.getvalue() == b""
+
+
+def test_binary_export_unknown_format(client):
+    response = client.get("/pg_copy/export-binary/?format=xls")
+
+    assert response.status_code == 400
+
+
+def test_arrow_export(products, client):
+    pyarrow = pytest.importorskip("pyarrow")
+
+    response = client.get("/pg_copy/export-arrow/?format=arrows")
+
+    assert response.streaming
+    assert response["Content-Type"] == "application/vnd.apache.arrow.stream"
+    table = pyarrow.ipc.open_stream(response.getvalue()).read_all()
+    assert table.schema.field("Price").type == pyarrow.decimal128(10, 2)
+    assert table.schema.field("Date Created").type == pyarrow.timestamp("us")
+    assert table.schema.field("Stock Quantity").type == pyarrow.int32()
+    assert table.to_pylist()[-1] == {
+        "SKU": "TOY-001",
+        "Name": "Wooden Train Set",
+        "Description": "Classic wooden train with tracks.",
+        "Category": "Toys",
+        "Brand": "Acme",
+        "Price": Decimal("29.95"),
+        "Currency": "USD",
+        "Stock Quantity": 0,
+        "Availability": "Preorder",
+        "Is Active?": "Yes",
+        "Last Updated": "1st Jan 2000 12:00 pm",
+        "Date Created": datetime(2000, 1, 1, 12),
+    }
+
+
+def test_parquet_export(products, client):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    response = client.get("/pg_copy/export-arrow/?format=parquet")
+
+    table = pyarrow.parquet.read_table(pyarrow.BufferReader(response.getvalue()))
+    assert table.column("SKU").to_pylist() == [
+        "HOME-001",
+        "ELEC-001",
+        "TOY-002",
+        "TOY-001",
+    ]
+    assert table.column("Brand").to_pylist() == ["Initech", None, "Globex", "Acme"]
+
+
+def test_parquet_export_no_data(client):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    response = client.get("/pg_copy/export-arrow/")
+
+    table = pyarrow.parquet.read_table(pyarrow.BufferReader(response.getvalue()))
+    assert table.num_rows == 0
+    assert len(table.schema) == 12
+
+
+def test_arrow_schema():
+    pyarrow = pytest.importorskip("pyarrow")
+
+    schema = arrow_schema(
+        output_columns(
+            Product.objects.values("price", "is_active", "created_at"), modifiers=True
+        )
+    )
+
+    assert schema == pyarrow.schema(
+        [
+            ("price", pyarrow.decimal128(10, 2)),
+            ("is_active", pyarrow.bool_()),
+            ("created_at", pyarrow.timestamp("us", tz="UTC")),
+        ]
+    )
+
+
+def test_output_columns():
+    assert output_columns(product_export_queryset()) == [
+        ("SKU", "varchar"),
+        ("Name", "varchar"),
+        ("Description", "text"),
+        ("Category", "varchar"),
+        ("Brand", "varchar"),
+        ("Price", "numeric"),
+        ("Currency", "varchar"),
+        ("Stock Quantity", "integer"),
+        ("Availability", "varchar"),
+        ("Is Active?", "varchar"),
+        ("Last Updated", "varchar"),
+        ("Date Created", "timestamp"),
+    ]
+
+
+def test_import_csv(products, client):
+    upload = io.BytesIO(
+        textwrap.dedent(
+            """\
+            sku,name,category__name,brand__name,price,stock_qty,created_at,updated_at
+            TOY-003,Kite,Toys,,12.50,3,2000-01-02 12:00:00+08,2000-01-02 12:00:00+08
+            TOY-001,Wooden Train Set (Deluxe),Toys,Globex,39.95,5,2000-01-01 12:00:00+08,2000-01-03 12:00:00+08
+            """
+        ).encode("utf-8")
+    )
+    upload.name = "products.csv"
+
+    response = client.post("/pg_copy/import/", {"file": upload})
+
+    assert response.status_code == 200
+    assert response.json() == {"imported": 2}
+    assert Product.objects.count() == 5
+    assert Product.objects.filter(sku="TOY-003").values(
+        "name", "category__name", "brand", "price", "stock_qty", "currency"
+    ).get() == {
+        "name": "Kite",
+        "category__name": "Toys",
+        "brand": None,
+        "price": Decimal("12.50"),
+        "stock_qty": 3,
+        "currency": "USD",
+    }
+    assert Product.objects.filter(sku="TOY-001").values(
+        "name", "brand__name", "price", "stock_qty"
+    ).get() == {
+        "name": "Wooden Train Set (Deluxe)",
+        "brand__name": "Globex",
+        "price": Decimal("39.95"),
+        "stock_qty": 5,
+    }
+
+
+def test_import_ndjson(products, client):
+    upload = io.BytesIO(
+        b'{"sku": "ELEC-002", "name": "Radio", "category__name": "Electronics", "price": 20,'
+        b' "created_at": "2000-01-02T12:00:00+08:00", "updated_at": "2000-01-02T12:00:00+08:00"}\n'
+    )
+    upload.name = "products.ndjson"
+
+    response = client.post("/pg_copy/import/", {"file": upload})
+
+    assert response.json() == {"imported": 1}
+    assert Product.objects.get(sku="ELEC-002").category.name == "Electronics"
+
+
+def test_copy_import_dicts(products):
+    count = copy_import(
+        Category,
+        ({"name": f"Category {i}"} for i in range(100)),
+        unique_fields=["name"],
+    )
+
+    assert count == 100
+    assert Category.objects.count() == 103
+
+    # nothing to update
+    assert copy_import(Category, [{"name": "Toys"}], unique_fields=["name"]) == 0
+
+
+def test_copy_import_partial_update(products):
+    count = copy_import(
+        Product,
+        [
+            {
+                "sku": "TOY-001",
+                "name": "Train Set",
+                "category__name": "Toys",
+                "price": "19.95",
+                "created_at": "2000-01-01 12:00:00+08",
+                "updated_at": "2000-01-04 12:00:00+08",
+            }
+        ],
+        unique_fields=["sku"],
+    )
+
+    assert count == 1
+    product = Product.objects.get(sku="TOY-001")
+    assert (product.name, product.price) == ("Train Set", Decimal("19.95"))
+    # not imported so not reset to their defaults
+    assert product.description == "Classic wooden train with tracks."
+    assert product.brand.name == "Acme"
+
+
+def test_copy_import_unknown_lookup(products):
+    with pytest.raises(ValueError):
+        copy_import(Product, [{"sku__name": "Foo"}])
+
+
+def test_copy_import_unmatched_lookup(products):
+    row = {
+        "sku": "TOY-003",
+        "name": "Kite",
+        "category__name": "Toys",
+        "created_at": "2000-01-02 12:00:00+08",
+        "updated_at": "2000-01-02 12:00:00+08",
+        "price": "12.50",
+    }
+
+    # a nullable foreign key isn't silently left NULL
+    with pytest.raises(ValueError, match="No match for brand__name: 'Acne'"):
+        copy_import(Product, [{**row, "brand__name": "Acne"}])
+    with pytest.raises(ValueError, match="No match for category__name: 'Tys'"):
+        copy_import(Product, [{**row, "category__name": "Tys"}])
+    assert not Product.objects.filter(sku="TOY-003").exists()
+
+    assert copy_import(Product, [{**row, "brand__name": ""}]) == 1
+    assert Product.objects.get(sku="TOY-003").brand is None
+
+
+def test_copy_import_non_unique_lookup():
+    row = {"name": "Can fly", "codename": "fly"}
+
+    with pytest.raises(ValueError, match="doesn't identify a single content type"):
+        copy_import(Permission, [{**row, "content_type__model": "product"}])
+
+    # unique together
+    assert (
+        copy_import(
+            Permission,
+            [
+                {
+                    **row,
+                    "content_type__app_label": "pg_copy",
+                    "content_type__model": "product",
+                }
+            ],
+        )
+        == 1
+    )
+    assert Permission.objects.get(codename="fly").content_type.model_class() is Product
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("order_by", ["pk", "-pk"])
+def test_parallel_copy_ordered(order_by):
+    create_many_products(1000)
+    queryset = Product.objects.values("sku", "price").order_by(order_by)
+    expected = b"".join(
+        stream_copy(
+            f"COPY ({mogrify_queryset(queryset)}) TO STDOUT WITH (FORMAT csv, HEADER)"
+        )
+    )
+
+    assert b"".join(parallel_copy(queryset, slices=3, ordered=True)) == expected
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("split", ["pk", "ctid"])
+def test_parallel_copy_unordered(split):
+    create_many_products(1000)
+    queryset = Product.objects.values("sku", "price").order_by("-sku")
+
+    header, *rows = (
+        b"".join(parallel_copy(queryset, slices=3, split=split))
+        .decode("utf-8")
+        .splitlines()
+    )
+
+    assert header == "sku,price"
+    assert sorted(rows) == sorted(
+        f"{sku},{price}" for sku, price in queryset.values_list("sku", "price")
+    )
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_copy_empty():
+    queryset = Product.objects.values("sku").order_by("pk")
+
+    assert b"".join(parallel_copy(queryset, ordered=True)) == b"sku\n"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_copy_closed_early():
+    create_many_products(10_000)
+    chunks = parallel_copy(Product.objects.all(), slices=3, chunk_size=1)
+
+    next(chunks)
+    next(chunks)
+    chunks.close()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_parallel_copy_snapshot():
+    create_many_products(1000)
+    queryset = Product.objects.values("sku", "price")
+    expected = sorted(
+        f"{sku},{price}" for sku, price in queryset.values_list("sku", "price")
+    )
+    chunks = parallel_copy(queryset, slices=3)
+
+    # the slices haven't started until after the header
+    assert next(chunks) == b"sku,price\n"
+    Product.objects.update(price=F("price") + 1)
+
+    assert sorted(b"".join(chunks).decode("utf-8").splitlines()) == expected
+
+
+def test_parallel_copy_pk_must_be_an_integer():
+    with pytest.raises(ValueError):
+        list(parallel_copy(Session.objects.all()))
+
+
+def test_parallel_copy_ordered_requires_pk_ordering():
+    with pytest.raises(ValueError):
+        list(parallel_copy(Product.objects.order_by("sku"), ordered=True))
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate;q=0.5, zstd ;q=0.9, br;q=x") == {
+        "gzip": 1.0,
+        "deflate": 0.5,
+        "zstd": 0.9,
+        "br": 0.0,
+    }
+
+
+def test_export_progress(products, client):
+    response = client.get("/pg_copy/export/?export_id=abc-123")
+    assert response["X-Export-ID"] == "abc-123"
+    content = response.getvalue()
+
+    progress = client.get("/pg_copy/export-progress/abc-123/").json()
+
+    assert progress["running"] is False
+    assert progress["rows"] == 4
+    assert progress["bytes"] == len(content)
+    assert progress["error"] is None
+    assert progress["time_to_first_byte"] <= progress["duration"]
+    # only measured when asked for
+    assert progress["db_time"] is None
+
+    client.get("/pg_copy/export/?export_id=abc-123&db_time=1").getvalue()
+
+    assert client.get("/pg_copy/export-progress/abc-123/").json()["db_time"] >= 0
+
+
+def test_export_progress_not_found(client):
+    assert client.get("/pg_copy/export-progress/nope/").status_code == 404
+
+
+def test_export_invalid_id(client):
+    assert client.get("/pg_copy/export/?export_id=../x").status_code == 400
+
+
+def test_export_signals(products):
+    progress, finished = [], []
+
+    def on_progress(sender, stats, **kwargs):
+        progress.append(stats.bytes)
+
+    def on_finished(sender, stats, **kwargs):
+        finished.append(stats.as_dict())
+
+    export_progress.connect(on_progress)
+    export_finished.connect(on_finished)
+    try:
+        stats = ExportStats(progress_interval=0)
+        list(
+            stream_copy(
+                "COPY (SELECT sku FROM pg_copy_product) TO STDOUT",
+                chunk_size=10,
+                stats=stats,
+            )
+        )
+    finally:
+        export_progress.disconnect(on_progress)
+        export_finished.disconnect(on_finished)
+
+    assert progress == [16, 34]
+    assert finished == [stats.as_dict()]
+    assert stats.rows == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_export_progress_running():
+    stats = ExportStats("running")
+    chunks = stream_copy(
+        "COPY (SELECT generate_series(1, 1000000)) TO STDOUT",
+        chunk_size=10,
+        stats=stats,
+    )
+    next(chunks)
+
+    def activity():
+        try:
+            return database_activity(stats.backend_pid)
+        finally:
+            connection.close()
+
+    try:
+        assert get_progress("running")["running"] is True
+        with ThreadPoolExecutor() as executor:
+            assert executor.submit(activity).result()["state"] == "active"
+    finally:
+        chunks.close()
+
+    assert get_progress("running")["error"] == "cancelled"
+
+
+def test_gzip_export(products, client):
+    expected = client.get("/pg_copy/export/").getvalue()
+
+    response = client.get("/pg_copy/export/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.get("Content-Encoding") == "gzip"
+    assert response.get("Vary") == "Accept-Encoding"
+    assert gzip.decompress(response.getvalue()) == expected
+
+
+def test_zstd_export(products, client):
+    zstandard = pytest.importorskip("zstandard")
+    expected = client.get("/pg_copy/export/").getvalue()
+
+    response = client.get(
+        "/pg_copy/export-binary/", headers={"Accept-Encoding": "gzip, zstd"}
+    )
+
+    assert response.get("Content-Encoding") == "zstd"
+    assert (
+        zstandard.ZstdDecompressor()
+        .decompressobj()
+        .decompress(response.getvalue())
+        == expected
+    )
+
+
+def test_export_not_compressed(products, client):
+    response = client.get(
+        "/pg_copy/export/", headers={"Accept-Encoding": "gzip;q=0, identity"}
+    )
+
+    assert not response.has_header("Content-Encoding")
+    assert response.get("Vary") == "Accept-Encoding"
+
+
+def test_compress_stream_blocks():
+    chunks = list(
+        compress_stream((b"x" * 100 for _ in range(100)), "gzip", block_size=1000)
+    )
+
+    assert gzip.decompress(b"".join(chunks)) == b"x" * 10_000
+
+
+def test_json_export(products, client):
+    response = client.get("/pg_copy/json/")
+
+    assert [row["SKU"] for row in json.loads(response.content)] == [
+        "HOME-001",
+        "ELEC-001",
+        "TOY-002",
+        "TOY-001",
+    ]
+
+
+def test_ndjson_export(products, client):
+    # things that FORMAT text would escape
+    Product.objects.filter(sku="TOY-001").update(
+        description='Tab\t, newline\n, backslash \\ & "quotes"'
+    )
+
+    response = client.get("/pg_copy/ndjson/")
+
+    assert response.streaming
+    lines = response.getvalue().decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == json.loads(
+        client.get("/pg_copy/json/").content
+    )
+    assert json.loads(lines[-1]) == {
+        "SKU": "TOY-001",
+        "Name": "Wooden Train Set",
+        "Description": 'Tab\t, newline\n, backslash \\ & "quotes"',
+        "Category": "Toys",
+        "Brand": "Acme",
+        "Price": 29.95,
+        "Currency": "USD",
+        "Stock Quantity": 0,
+        "Availability": "Preorder",
+        "Is Active?": "Yes",
+        "Last Updated": "1st Jan 2000 12:00 pm",
+        "Date Created": "2000-01-01T12:00:00",
+    }
+
+
+def test_json_stream_export(products, client):
+    response = client.get("/pg_copy/json-stream/")
+
+    assert response.streaming
+    assert json.loads(response.getvalue()) == json.loads(
+        client.get("/pg_copy/json/").content
+    )
+
+
+def test_json_stream_export_no_data(client):
+    response = client.get("/pg_copy/json-stream/")
+
+    assert response.getvalue() == b"[]"
+
+
+def test_json_array():
+    # rows split across chunks
+    chunks = [b'{"a": 1}\n{"a"', b": 2}", b"\n", b'{"a": 3}\n']
+
+    assert b"".join(json_array(chunks)) == b'[{"a": 1},{"a": 2},{"a": 3}]'
+
+
+def create_many_products(count):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO pg_copy_category (name) VALUES ('Bench');
+            INSERT INTO pg_copy_product
+                (sku, name, description, category_id, price, currency, stock_qty, availability, is_active, created_at, updated_at)
+            SELECT 'SKU-' || i, 'Product ' || i, repeat('Lorem ipsum ', 5), currval('pg_copy_category_id_seq'),
+                i %% 1000 + 0.95, 'USD', i %% 100, 'in_stock', i %% 2 = 0, now(), now()
+            FROM generate_series(1, %s) i
+            """,
+            [count],
+        )
+
+
+def backend_cpu_time():
+    """
+    CPU time used by this connection's backend process, only possible when Postgres is running locally.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_backend_pid()")
+        pid = cursor.fetchone()[0]
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            utime, stime = stat.read().rsplit(")", 1)[1].split()[11:13]
+    except OSError:
+        return float("nan")
+    return (int(utime) + int(stime)) / os.sysconf("SC_CLK_TCK")
+
+
+def measure(chunks):
+    db_cpu, app_cpu, wall = backend_cpu_time(), time.process_time(), time.perf_counter()
+    size = sum(len(chunk) for chunk in chunks)
+    return (
+        backend_cpu_time() - db_cpu,
+        time.process_time() - app_cpu,
+        time.perf_counter() - wall,
+        size,
+    )
+
+
+@benchmark
+def test_benchmark_binary_export():
+    create_many_products(500_000)
+    queryset = product_export_queryset()
+    sql = mogrify_queryset(queryset)
+    names, types = zip(*output_columns(queryset))
+
+    exports = [
+        (
+            "text csv",
+            stream_copy(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)"),
+        ),
+        (
+            "binary csv",
+            stream_encoded(
+                stream_copy_rows(f"COPY ({sql}) TO STDOUT WITH (FORMAT binary)", types),
+                names,
+                CSVEncoder(),
+            ),
+        ),
+    ]
+    for extension, encoder in ARROW_ENCODERS.items():
+        exports.append(
+            (
+                f"binary {extension}",
+                stream_encoded(
+                    stream_copy_rows(
+                        f"COPY ({sql}) TO STDOUT WITH (FORMAT binary)", types
+                    ),
+                    names,
+                    encoder(output_columns(queryset, modifiers=True)),
+                    ARROW_BATCH_SIZE,
+                ),
+            )
+        )
+
+    print()
+    print(f"{'':<16} {'db cpu':>8} {'app cpu':>8} {'wall':>8} {'MB':>8}")
+    for label, chunks in exports:
+        db_cpu, app_cpu, wall, size = measure(chunks)
+        print(
+            f"{label:<16} {db_cpu:>8.2f} {app_cpu:>8.2f} {wall:>8.2f} {size / 1e6:>8.1f}"
+        )
+
+
+@benchmark
+def test_benchmark_streaming_export(client):
+    create_many_products(100_000)
+
+    print()
+    print(f"{'':<12} {'wall':>8} {'peak MB':>8}")
+    for label, url in [
+        ("traditional", "/pg_copy/export-traditional/"),
+        ("streaming", "/pg_copy/export-streaming/"),
+    ]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = client.get(url)
+        for _ in response:
+            pass
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<12} {wall:>8.2f} {peak / 1e6:>8.1f}")
+
+
+@benchmark
+def test_benchmark_choice_display():
+    create_many_products(1_000_000)
+
+    print()
+    print(f"{'choices':>8} {'lookup':>8} {'db cpu':>8} {'wall':>8}")
+    for count in [5, 50, 500]:
+        choices = [(i, f"Choice {i}") for i in range(count)]
+        for lookup in ["case", "jsonb"]:
+            queryset = Product.objects.values(
+                label=ChoiceDisplay(
+                    Mod("pk", count), choices=choices, lookup=lookup
+                )
+            )
+            db_cpu, _, wall, _ = measure(
+                stream_copy(f"COPY ({mogrify_queryset(queryset)}) TO STDOUT")
+            )
+            print(f"{count:>8} {lookup:>8} {db_cpu:>8.2f} {wall:>8.2f}")
+
+
+@benchmark
+def test_benchmark_import():
+    count = 100_000
+    Category.objects.create(name="Bench")
+    rows = [
+        {
+            "sku": f"SKU-{i}",
+            "name": f"Product {i}",
+            "category__name": "Bench",
+            "price": "9.95",
+            "created_at": "2000-01-01 12:00:00+08",
+            "updated_at": "2000-01-01 12:00:00+08",
+        }
+        for i in range(count)
+    ]
+
+    print()
+    start = time.perf_counter()
+    category = Category.objects.get(name="Bench")
+    Product.objects.bulk_create(
+        Product(
+            sku=row["sku"],
+            name=row["name"],
+            category=category,
+            price=row["price"],
+            created_at=row["created_at"],
+            updated_at=row["updated_at"],
+        )
+        for row in rows
+    )
+    print(f"bulk_create  {time.perf_counter() - start:.2f}s")
+    Product.objects.all().delete()
+
+    start = time.perf_counter()
+    copy_import(Product, rows, unique_fields=["sku"])
+    print(f"copy_import  {time.perf_counter() - start:.2f}s")
+
+
+@benchmark
+@pytest.mark.django_db(transaction=True)
+def test_benchmark_parallel_copy():
+    create_many_products(1_000_000)
+    queryset = product_export_queryset()
+
+    print()
+    for slices in [1, 2, 4, 8]:
+        start = time.perf_counter()
+        size = sum(len(chunk) for chunk in parallel_copy(queryset, slices=slices))
+        print(
+            f"{slices} slices  {time.perf_counter() - start:.2f}s  {size / 1e6:.1f}MB"
+        )
+
+
+@benchmark
+def test_benchmark_compression():
+    create_many_products(300_000)
+    sql = mogrify_queryset(product_export_queryset())
+    data = b"".join(stream_copy(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)"))
+
+    print()
+    print(f"{len(data) / 1e6:.1f}MB of CSV")
+    print(f"{'codec':<8} {'level':>5} {'MB/s':>8} {'ratio':>6}")
+    for encoding, levels in [("gzip", [1, 6, 9]), ("zstd", [1, 3, 9, 19])]:
+        if encoding not in COMPRESSORS:
+            continue
+        for level in levels:
+            start = time.perf_counter()
+            size = sum(
+                len(chunk)
+                for chunk in compress_stream(
+                    (data[i : i + 65536] for i in range(0, len(data), 65536)),
+                    encoding,
+                    level,
+                )
+            )
+            elapsed = time.perf_counter() - start
+            print(
+                f"{encoding:<8} {level:>5} {len(data) / 1e6 / elapsed:>8.1f} "
+                f"{len(data) / size:>6.1f}"
+            )
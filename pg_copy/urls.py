@@ -1,10 +1,29 @@
 from django.urls import path
 
-from .views import export, export_traditional, json, json_traditional
+from .views import (
+    export,
+    export_arrow,
+    export_binary,
+    export_progress,
+    export_streaming,
+    export_traditional,
+    import_products,
+    json,
+    json_stream,
+    json_traditional,
+    ndjson,
+)
 
 urlpatterns = [
     path("export/", export),
+    path("export-binary/", export_binary),
+    path("export-arrow/", export_arrow),
+    path("export-progress/<str:export_id>/", export_progress),
+    path("export-streaming/", export_streaming),
     path("export-traditional/", export_traditional),
     path("json/", json),
     path("json-traditional/", json_traditional),
+    path("ndjson/", ndjson),
+    path("json-stream/", json_stream),
+    path("import/", import_products),
 ]
@@ -1,34 +1,70 @@
 import csv
+import re
+import uuid
+from itertools import islice
 from zoneinfo import ZoneInfo
 
 from django.core.exceptions import EmptyResultSet
 from django.db import connection
-from django.db.models import CharField, DateTimeField, F, Func, Value
+from django.db.models import CharField, DateTimeField, F, Func, JSONField, Value
 from django.db.models.sql.where import WhereNode
-from django.http import HttpResponse, JsonResponse
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.utils.choices import flatten_choices
 from django.utils.dateformat import DateFormat
+from django.utils.dates import MONTHS_3
+from django.utils.translation import gettext
+from django.views.decorators.http import require_POST
 
+from mogrify_queryset.cache import query_templates
+
+from .arrow import ARROW_BATCH_SIZE, ARROW_ENCODERS
+from .compression import compress_export
+from .encoders import ENCODERS, CSVEncoder, output_columns
+from .importer import copy_import, read_csv, read_ndjson
+from .instrumentation import ExportStats, database_activity, get_progress
 from .models import Product
+from .responses import (
+    CopyExportResponse,
+    EncodedCopyExportResponse,
+    json_array,
+    stream_copy,
+    stream_encoded,
+)
 
+# FORMAT text would escape the backslashes in JSON, instead use CSV with a quote & delimiter that can never appear in
+# JSON (control characters are always escaped) so that values are sent verbatim.
+JSON_COPY_OPTIONS = "FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02'"
 
-def mogrify_queryset(qs):
-    with connection.cursor() as cur:
-        try:
-            return cur.mogrify(*qs.query.sql_with_params())
+# row_to_json() per row as NDJSON
+NDJSON_COPY = (
+    f"COPY (SELECT row_to_json(t) FROM ({{}}) t) TO STDOUT WITH ({JSON_COPY_OPTIONS})"
+)
+
+EXPORT_ID_RE = re.compile(r"[\w-]{1,64}")
 
-        except EmptyResultSet:
-            # An EmptyResultSet means a filter was declared that's a logical contradiction
-            # (ie that will never be true), for eg foo__in=[]
-            #
-            # We still need a query with a compatible select clause; in order to do
-            # that we can clear the where clause and add "limit 0"
-            # It's not ideal as it doesn't show the originally requested where clause
-            # (ie if required for debugging purposes) but it functions equivalently
-            # if required to execute by itself or interpolated in a larger query.
 
-            query = qs.query.clone()
-            query.where = WhereNode()
-            return cur.mogrify(*query.sql_with_params()) + " LIMIT 0"
+def mogrify_queryset(qs):
+    try:
+        return query_templates.mogrify(qs.query)
+    except EmptyResultSet:
+        # An EmptyResultSet means a filter was declared that's a logical contradiction
+        # (ie that will never be true), for eg foo__in=[]
+        #
+        # We still need a query with a compatible select clause; in order to do
+        # that we can clear the where clause and add "limit 0"
+        # It's not ideal as it doesn't show the originally requested where clause
+        # (ie if required for debugging purposes) but it functions equivalently
+        # if required to execute by itself or interpolated in a larger query.
+
+        query = qs.query.clone()
+        query.where = WhereNode()
+        return query_templates.mogrify(query) + " LIMIT 0"
 
 
 class YesNo(Func):
@@ -37,26 +73,71 @@ class YesNo(Func):
     arity = 1
 
 
+def text_key(key):
+    """
+    key as Postgres casts it to text, for the keys of a jsonb lookup.
+    """
+    if isinstance(key, bool):
+        return "true" if key else "false"
+    if isinstance(key, (str, int)):
+        return str(key)
+    raise ValueError(f"Choices with {type(key).__name__} keys can't use lookup='jsonb'")
+
+
 class ChoiceDisplay(Func):
+    """
+    The display value of a choice, or '' if there isn't one. Choices are passed as params so labels are safely quoted.
+
+    lookup="case" uses a CASE with a branch per choice, evaluated in order for each row. For large sets of choices use
+    lookup="jsonb" which looks up a jsonb object of key -> label (a binary search) and is the same SQL regardless of the
+    choices. Its keys must be strings, integers or booleans, as other types don't cast to text in a fixed format.
+    """
+
     output_field = CharField()
+    arity = 1
 
-    def __init__(self, *args, choices, **kwargs):
-        self.template = "CASE"
-        self.template += "".join(
-            [f" WHEN %(expressions)s = '{key}' THEN '{val}'" for key, val in choices]
-        )
-        self.template += " ELSE '' END"
+    def __init__(self, *args, choices, lookup="case", **kwargs):
+        if lookup not in ("case", "jsonb"):
+            raise ValueError(f"Unknown lookup: {lookup}")
+        self.choices = [(key, str(label)) for key, label in flatten_choices(choices)]
+        self.lookup = lookup
+        if lookup == "jsonb":
+            self.labels = {text_key(key): label for key, label in self.choices}
         super().__init__(*args, **kwargs)
 
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = compiler.compile(self.source_expressions[0])
+        if self.lookup == "jsonb":
+            labels_sql, labels_params = compiler.compile(
+                Value(self.labels, output_field=JSONField())
+            )
+            return (
+                f"COALESCE({labels_sql} ->> ({sql})::text, '')",
+                [*labels_params, *params],
+            )
+        if not self.choices:
+            return "''", []
+        return (
+            f"CASE {sql} {' '.join(['WHEN %s THEN %s'] * len(self.choices))} ELSE '' END",
+            [*params, *(param for choice in self.choices for param in choice)],
+        )
+
 
 class ToChar(Func):
     function = "TO_CHAR"
     output_field = CharField()
 
 
+class LocalDateTimeField(DateTimeField):
+    # AT TIME ZONE converts a timestamptz to a timestamp (ie without time zone). It matters when the type is taken from
+    # the output field, eg for a binary COPY.
+    def db_type(self, connection):
+        return "timestamp"
+
+
 class AtTimeZone(Func):
     template = "%(expressions)s AT TIME ZONE '%(timezone)s'"
-    output_field = DateTimeField()
+    output_field = LocalDateTimeField()
     arity = 1
 
     def __init__(self, *args, timezone="UTC", **kwargs):
@@ -68,8 +149,8 @@ class AtTimeZone(Func):
         return super().as_sql(compiler, connection, template, **extra_context)
 
 
-def export(request):
-    export_queryset = Product.objects.values(
+def product_export_queryset():
+    return Product.objects.values(
         **{
             "SKU": F("sku"),
             "Name": F("name"),
@@ -93,20 +174,169 @@ def export(request):
         # Remember: references to columns must use the alias
     ).order_by("-Date Created")
 
-    with connection.cursor() as cursor:
-        # Optionally set the timezone for the session
-        # cursor.execute("SET TIME ZONE 'Hongkong'")
 
-        with cursor.copy(
-            "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(
-                mogrify_queryset(export_queryset)
-            )
-        ) as copy:
-            return HttpResponse(
-                copy,
-                content_type="text/csv",
-                headers={"Content-Disposition": 'attachment; filename="products.csv"'},
-            )
+@compress_export
+def export(request):
+    export_queryset = product_export_queryset()
+    # Clients may choose the id so that they can poll for progress before the response arrives
+    export_id = request.GET.get("export_id") or uuid.uuid4().hex
+    if not EXPORT_ID_RE.fullmatch(export_id):
+        return HttpResponseBadRequest("Invalid export_id")
+
+    # Stream the COPY rather than passing the Copy object to HttpResponse, which reads the entire export into memory
+    return CopyExportResponse(
+        "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)".format(
+            mogrify_queryset(export_queryset)
+        ),
+        content_type="text/csv",
+        headers={
+            "Content-Disposition": 'attachment; filename="products.csv"',
+            "X-Export-ID": export_id,
+        },
+        # measuring the time on the database costs another connection, only when asked for
+        stats=ExportStats(export_id, db_time=request.GET.get("db_time") == "1"),
+    )
+
+
+def export_progress(request, export_id):
+    progress = get_progress(export_id)
+    if progress is None:
+        raise Http404("No such export")
+    if progress["running"]:
+        progress["db"] = database_activity(progress["backend_pid"])
+    return JsonResponse(progress)
+
+
+@compress_export
+def export_binary(request):
+    """
+    Have Postgres send the raw binary values & do the formatting here, moving CPU off the database server.
+    """
+    export_format = request.GET.get("format", "csv")
+    if export_format not in ENCODERS:
+        return HttpResponseBadRequest(f"Unknown format: {export_format}")
+
+    export_queryset = product_export_queryset()
+    encoder = ENCODERS[export_format]()
+
+    return EncodedCopyExportResponse(
+        "COPY ({}) TO STDOUT WITH (FORMAT binary)".format(
+            mogrify_queryset(export_queryset)
+        ),
+        output_columns(export_queryset),
+        encoder,
+        headers={
+            "Content-Disposition": f'attachment; filename="products.{encoder.extension}"'
+        },
+    )
+
+
+def export_arrow(request):
+    """
+    Export as Arrow IPC or Parquet with native types, eg decimals & timestamps, so loading it needs no parsing.
+    """
+    export_format = request.GET.get("format", "parquet")
+    if export_format not in ARROW_ENCODERS:
+        return HttpResponseBadRequest(f"Unknown format: {export_format}")
+
+    export_queryset = product_export_queryset()
+    encoder = ARROW_ENCODERS[export_format](
+        output_columns(export_queryset, modifiers=True)
+    )
+
+    return EncodedCopyExportResponse(
+        "COPY ({}) TO STDOUT WITH (FORMAT binary)".format(
+            mogrify_queryset(export_queryset)
+        ),
+        output_columns(export_queryset),
+        encoder,
+        batch_size=ARROW_BATCH_SIZE,
+        headers={
+            "Content-Disposition": f'attachment; filename="products.{encoder.extension}"'
+        },
+    )
+
+
+EXPORT_HEADER = [
+    "SKU",
+    "Name",
+    "Description",
+    "Category",
+    "Brand",
+    "Price",
+    "Currency",
+    "Stock Quantity",
+    "Availability",
+    "Is Active?",
+    "Last Updated",
+    "Date Created",
+]
+
+
+def format_timestamps(timestamps, timezone):
+    """
+    Format a batch of timestamps as DateFormat's "jS M Y g:i a" would, with the translations looked up once per batch
+    rather than creating a DateFormat for each row.
+    """
+    months = {number: month.title() for number, month in MONTHS_3.items()}
+    am, pm = gettext("AM").lower(), gettext("PM").lower()
+    formatted = []
+    for timestamp in timestamps:
+        local = timestamp.astimezone(timezone)
+        day = local.day
+        suffix = (
+            "th" if 10 < day < 14 else {1: "st", 2: "nd", 3: "rd"}.get(day % 10, "th")
+        )
+        formatted.append(
+            f"{day}{suffix} {months[local.month]} {local.year} "
+            f"{local.hour % 12 or 12}:{local.minute:02} {am if local.hour < 12 else pm}"
+        )
+    return formatted
+
+
+def product_rows(products, timezone, batch_size):
+    products = iter(products)
+    while batch := list(islice(products, batch_size)):
+        last_updated = format_timestamps([p.updated_at for p in batch], timezone)
+        for product, updated in zip(batch, last_updated):
+            yield [
+                product.sku,
+                product.name,
+                product.description,
+                product.category.name,
+                product.brand.name if product.brand else "",
+                product.price,
+                product.currency,
+                product.stock_qty,
+                product.get_availability_display(),
+                "Yes" if product.is_active else "No",
+                updated,
+                product.created_at.astimezone(timezone).strftime("%Y-%m-%d %H:%M:%S"),
+            ]
+
+
+def export_streaming(request):
+    """
+    For exports that need formatting in Python: iterate with a server-side cursor & stream the CSV a batch at a time
+    rather than loading every product into memory.
+    """
+    batch_size = 2000
+    products = (
+        Product.objects.select_related("category", "brand")
+        .order_by("-created_at")
+        .iterator(chunk_size=batch_size)
+    )
+
+    return StreamingHttpResponse(
+        stream_encoded(
+            product_rows(products, ZoneInfo("Hongkong"), batch_size),
+            EXPORT_HEADER,
+            CSVEncoder(),
+            batch_size,
+        ),
+        content_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="products.csv"'},
+    )
 
 
 def export_traditional(request):
@@ -121,22 +351,7 @@ def export_traditional(request):
     )
 
     writer = csv.writer(response, lineterminator="\n")
-    writer.writerow(
-        [
-            "SKU",
-            "Name",
-            "Description",
-            "Category",
-            "Brand",
-            "Price",
-            "Currency",
-            "Stock Quantity",
-            "Availability",
-            "Is Active?",
-            "Last Updated",
-            "Date Created",
-        ]
-    )
+    writer.writerow(EXPORT_HEADER)
     for product in products:
         writer.writerow(
             [
@@ -165,36 +380,21 @@ def export_traditional(request):
     return response
 
 
+@compress_export
 def json(request):
-    export_queryset = Product.objects.values(
-        **{
-            "SKU": F("sku"),
-            "Name": F("name"),
-            "Description": F("description"),
-            "Category": F("category__name"),
-            "Brand": F("brand__name"),
-            "Price": F("price"),
-            "Currency": F("currency"),
-            "Stock Quantity": F("stock_qty"),
-            "Availability": ChoiceDisplay(Product.Availability.choices, "availability"),
-            "Is Active?": YesNo("is_active"),
-            "Last Updated": ToChar(
-                AtTimeZone("updated_at", timezone="Hongkong"),
-                # be careful with the PG formatting! eg MI vs MM
-                Value("FMDDth Mon YYYY FMHH:MI pm"),
-            ),
-            "Date Created": AtTimeZone("created_at", timezone="Hongkong"),
-        }
-        # Remember: references to columns must use the alias
-    ).order_by("-Date Created")
+    """
+    Export as a single JSON array built with jsonb_agg(). Postgres builds the entire array in memory as a single value
+    (which can't exceed 1GB) before sending anything - see ndjson() & json_stream() for larger exports.
+    """
+    export_queryset = product_export_queryset()
 
     with connection.cursor() as cursor:
         # Optionally set the timezone for the session
         # cursor.execute("SET TIME ZONE 'Hongkong'")
 
         with cursor.copy(
-            "COPY (SELECT jsonb_agg(t) FROM ({}) t) TO STDOUT WITH (FORMAT text)".format(
-                mogrify_queryset(export_queryset)
+            "COPY (SELECT jsonb_agg(t) FROM ({}) t) TO STDOUT WITH ({})".format(
+                mogrify_queryset(export_queryset), JSON_COPY_OPTIONS
             )
         ) as copy:
             return HttpResponse(
@@ -203,6 +403,31 @@ def json(request):
             )
 
 
+@compress_export
+def ndjson(request):
+    """
+    Stream one JSON object per line, the database & app only ever deal with a row at a time.
+    """
+    return CopyExportResponse(
+        NDJSON_COPY.format(mogrify_queryset(product_export_queryset())),
+        content_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="products.ndjson"'},
+    )
+
+
+@compress_export
+def json_stream(request):
+    """
+    Stream a JSON array for clients that can't handle NDJSON.
+    """
+    return StreamingHttpResponse(
+        json_array(
+            stream_copy(NDJSON_COPY.format(mogrify_queryset(product_export_queryset())))
+        ),
+        content_type="application/json",
+    )
+
+
 def json_traditional(request):
     hk_timezone = ZoneInfo("Hongkong")
     products = Product.objects.select_related("category", "brand").order_by(
@@ -235,3 +460,22 @@ def json_traditional(request):
         ],
         safe=False,
     )
+
+
+@require_POST
+def import_products(request):
+    """
+    Upsert products from a CSV or NDJSON upload, columns are field names with category__name & brand__name lookups.
+    """
+    file = request.FILES.get("file")
+    if file is None:
+        return HttpResponseBadRequest("No file uploaded")
+
+    if file.name.endswith((".ndjson", ".jsonl")):
+        rows = read_ndjson(file)
+    else:
+        rows = read_csv(file)
+
+    count = copy_import(Product, rows, unique_fields=["sku"])
+
+    return JsonResponse({"imported": count})
@@ -39,6 +39,8 @@ INSTALLED_APPS = [
     "yesno",
     "set_config",
     "count_estimate",
+    "mogrify_queryset",
+    "delayed_query",
     "pg_copy",
     "pg_cron",
     "specific_ordering",
@@ -20,4 +20,5 @@ from django.urls import path, include
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("", include("bulk_create_form.urls")),
+    path("pg_copy/", include("pg_copy.urls")),
 ]